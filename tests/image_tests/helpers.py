@@ -1,5 +1,11 @@
+import os
+from pathlib import Path
+
 import falcor
 
+# Suffix of second captures used for the statistical image comparison (see SECOND_CAPTURE_SUFFIX in tests/testing/core/config.py).
+SECOND_CAPTURE_SUFFIX = '.second'
+
 def render_frames(m, name, frames=[1], framerate=60, resolution=[640,360]):
     m.resizeFrameBuffer(*resolution)
     m.ui = False
@@ -17,3 +23,31 @@ def render_frames(m, name, frames=[1], framerate=60, resolution=[640,360]):
         if "IMAGE_TEST_RUN_ONLY" in falcor.__dict__:
             continue
         m.frameCapture.capture()
+
+def capture_output_dir(m):
+    # Mogwai stores output directories below its runtime directory relative to it (the falcor package is in <runtime>/python/falcor).
+    output_dir = Path(m.frameCapture.outputDir)
+    if not output_dir.is_absolute():
+        output_dir = Path(falcor.__file__).resolve().parents[2] / output_dir
+    return output_dir
+
+def render_second_capture(m, name, reset_passes=[], frames=[1], framerate=60, resolution=[640,360]):
+    '''
+    Render the frames of a previous render_frames() call again and capture them as second, independent captures
+    for the statistical image comparison ('statistical' in the IMAGE_TEST header). A capture <name>.<output>.<frame>.<ext>
+    gets the second capture <name>.<output>.<frame>.second.<ext>.
+    Passes seeding their random numbers from the number of frames they rendered (e.g. PathTracer) must not be reset,
+    so that the second capture uses different seeds. Passes accumulating frames (e.g. AccumulatePass) must be passed
+    in reset_passes to restart accumulation.
+    '''
+    for render_pass in reset_passes:
+        render_pass.reset()
+
+    capture_name = name + SECOND_CAPTURE_SUFFIX
+    render_frames(m, capture_name, frames, framerate, resolution)
+    m.frameCapture.baseFilename = name
+
+    # Rename <name>.second.<output>.<frame>.<ext> to <name>.<output>.<frame>.second.<ext>.
+    for capture_file in capture_output_dir(m).glob(capture_name + '.*'):
+        original = Path(name + capture_file.name[len(capture_name):])
+        os.replace(capture_file, capture_file.with_name(original.stem + SECOND_CAPTURE_SUFFIX + original.suffix))
@@ -1,10 +1,11 @@
 IMAGE_TEST = {
-    "device_types": ["d3d12", "vulkan"]
+    "device_types": ["d3d12", "vulkan"],
+    "statistical": {"outputs": ["*.ToneMapper.dst.*", "*.PathTracer.color.*"]}
 }
 
 import sys
 sys.path.append('..')
-from helpers import render_frames
+from helpers import render_frames, render_second_capture
 from graphs.PathTracer import PathTracer as g
 from falcor import *
 
@@ -13,6 +14,7 @@ m.loadScene('Arcade/Arcade.pyscene')
 
 # default
 g["PathTracer"].set_properties({"useSER": False})
-render_frames(m, 'default', frames=[128])
+render_frames(m, 'default', frames=[32])
+render_second_capture(m, 'default', reset_passes=[g["AccumulatePass"]], frames=[32])
 
 exit()
@@ -0,0 +1,210 @@
+'''
+Script for benchmarking the servers of view_image_tests under concurrent load.
+
+A synthetic results tree (runs containing tests with large images) is written
+to a temporary directory and served by each selected server in turn. A number
+of client threads, each using its own persistent connection, then request a mix
+of HTML pages, API pages and images for a fixed duration. The throughput and
+latency percentiles are reported per server and request kind.
+'''
+
+import os
+import sys
+import json
+import time
+import random
+import socket
+import argparse
+import tempfile
+import threading
+import http.client
+from types import SimpleNamespace
+from pathlib import Path
+
+import libs.bottle as bottle
+
+import view_image_tests as viewer
+from core import config
+
+# Relative frequencies of the request kinds sent by the clients.
+REQUEST_MIX = {
+    'index': 1,
+    'api_runs': 4,
+    'run': 1,
+    'api_tests': 4,
+    'test': 2,
+    'image': 4
+}
+
+
+def write_json(path, data):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with open(path, 'w') as f:
+        json.dump(data, f, indent=4)
+
+
+def create_results(root_dir, run_count, test_count, image_size):
+    '''
+    Create a synthetic results tree in root_dir.
+    Image files contain random data of image_size bytes, they are only transferred, never decoded.
+    All images are hard links of a single file (if supported) to keep the tree small.
+    Returns an environment for the viewer database and the list of (run_dir, test_dir, image_name) of all images.
+    '''
+    images = []
+    image_file = root_dir / 'image.exr'
+    image_file.write_bytes(os.urandom(image_size))
+    def write_image(path):
+        try:
+            os.link(image_file, path)
+        except OSError:
+            path.write_bytes(image_file.read_bytes())
+    for i in range(run_count):
+        run_dir = f'master/bench-Release/{i:04d}'
+        run_path = root_dir / 'results' / run_dir
+        tests = []
+        for j in range(test_count):
+            test_dir = f'test_{j:03d}_vulkan'
+            ref_dir = root_dir / 'refs' / 'master' / test_dir
+            name = 'frame.exr'
+            (run_path / test_dir).mkdir(parents=True, exist_ok=True)
+            write_image(run_path / test_dir / name)
+            if i == 0:
+                ref_dir.mkdir(parents=True, exist_ok=True)
+                write_image(ref_dir / name)
+            failed = (i + j) % 7 == 0
+            write_json(run_path / test_dir / 'report.json', {
+                'name': test_dir,
+                'ref_dir': str(ref_dir),
+                'images': [{ 'name': name, 'success': not failed, 'error': 0.1 if failed else 0.0, 'tolerance': 0.0 }],
+                'result': 'FAILED' if failed else 'PASSED',
+                'messages': [],
+                'duration': 1.0,
+                'tags': ['bench']
+            })
+            tests.append(test_dir)
+            images.append((run_dir, test_dir, name))
+        write_json(run_path / 'report.json', {
+            'date': f'2024-01-01T00:{i // 60 % 60:02d}:{i % 60:02d}.000000',
+            'result': 'PASSED',
+            'tests': tests,
+            'duration': float(test_count)
+        })
+
+    env = SimpleNamespace(
+        project_dir=root_dir,
+        image_tests_result_dir='${project_dir}/results/${branch}/${build_config}/${build_id}',
+        image_tests_ref_dir='${project_dir}/refs/${branch}'
+    )
+    return env, images
+
+
+def free_port(host):
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+        s.bind((host, 0))
+        return s.getsockname()[1]
+
+
+def start_server(server, host, port, workers):
+    '''
+    Run a viewer server in a daemon thread and wait until it accepts connections.
+    '''
+    options = { 'workers': workers } if server == 'threaded' else {}
+    threading.Thread(target=bottle.run, kwargs=dict(server=viewer.SERVERS[server], host=host, port=port, quiet=True, **options), name=server, daemon=True).start()
+    for _ in range(100):
+        try:
+            socket.create_connection((host, port), timeout=1).close()
+            return
+        except OSError:
+            time.sleep(0.1)
+    raise RuntimeError(f'Server {server} did not start')
+
+
+def request_path(kind, rng, images):
+    run_dir, test_dir, name = rng.choice(images)
+    return {
+        'index': '/',
+        'api_runs': f'/api/runs?limit={config.VIEWER_PAGE_SIZE}&offset={rng.randrange(2) * config.VIEWER_PAGE_SIZE}',
+        'run': f'/{run_dir}',
+        'api_tests': f'/api/runs/{run_dir}/tests?limit={config.VIEWER_PAGE_SIZE}',
+        'test': f'/{run_dir}/{test_dir}',
+        'image': f'/result/{run_dir}/{test_dir}/{name}'
+    }[kind]
+
+
+def run_client(host, port, images, deadline, seed, stats):
+    rng = random.Random(seed)
+    kinds = [kind for kind, weight in REQUEST_MIX.items() for _ in range(weight)]
+    connection = http.client.HTTPConnection(host, port, timeout=60)
+    while time.perf_counter() < deadline:
+        kind = rng.choice(kinds)
+        path = request_path(kind, rng, images)
+        start = time.perf_counter()
+        try:
+            connection.request('GET', path, headers={ 'Accept-Encoding': 'gzip' })
+            response = connection.getresponse()
+            size = len(response.read())
+            if response.status != 200:
+                raise RuntimeError(f'{path}: {response.status} {response.reason}')
+            stats.append((kind, time.perf_counter() - start, size, None))
+        except (OSError, http.client.HTTPException, RuntimeError) as e:
+            stats.append((kind, time.perf_counter() - start, 0, str(e)))
+            connection.close()
+    connection.close()
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(p / 100 * len(values)))] if values else 0
+
+
+def benchmark(server, host, images, clients, duration, workers):
+    port = free_port(host)
+    start_server(server, host, port, workers)
+    stats = []
+    deadline = time.perf_counter() + duration
+    threads = [threading.Thread(target=run_client, args=(host, port, images, deadline, i, stats)) for i in range(clients)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+
+    errors = [error for _, _, _, error in stats if error != None]
+    print(f'\n{server}: {len(stats)} requests in {elapsed:.1f}s, {len(stats) / elapsed:.1f} requests/s, {sum(s[2] for s in stats) / elapsed / 1024 ** 2:.1f} MB/s, {len(errors)} errors')
+    print(f'  {"kind":<10} {"count":>7} {"p50 (ms)":>9} {"p90 (ms)":>9} {"p99 (ms)":>9} {"max (ms)":>9}')
+    for kind in list(REQUEST_MIX.keys()) + ['all']:
+        latencies = [s[1] * 1000 for s in stats if kind == 'all' or s[0] == kind]
+        print(f'  {kind:<10} {len(latencies):>7} {percentile(latencies, 50):>9.1f} {percentile(latencies, 90):>9.1f} {percentile(latencies, 99):>9.1f} {max(latencies, default=0):>9.1f}')
+    for error in sorted(set(errors))[0:5]:
+        print(f'  error: {error}')
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Utility for benchmarking the view_image_tests servers.")
+    parser.add_argument('--servers', type=str, nargs='+', choices=viewer.SERVERS.keys(), help='Servers to benchmark (default: all)', default=list(viewer.SERVERS.keys()))
+    parser.add_argument('--host', type=str, action='store', help='Server hostname', default='127.0.0.1')
+    parser.add_argument('--clients', type=int, action='store', help='Number of concurrent clients', default=16)
+    parser.add_argument('--duration', type=float, action='store', help='Duration in seconds of each benchmark', default=10.0)
+    parser.add_argument('--workers', type=int, action='store', help=f'Number of worker threads of the threaded server (default: {config.VIEWER_SERVER_WORKERS})', default=config.VIEWER_SERVER_WORKERS)
+    parser.add_argument('--runs', type=int, action='store', help='Number of synthetic runs', default=100)
+    parser.add_argument('--tests', type=int, action='store', help='Number of tests per synthetic run', default=20)
+    parser.add_argument('--image-size', type=float, action='store', help='Size in MB of synthetic images', default=8.0)
+
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory(prefix='viewer-benchmark-') as tmp_dir:
+        root_dir = Path(tmp_dir)
+        print(f'Creating {args.runs} runs with {args.tests} tests in {root_dir}')
+        env, images = create_results(root_dir, args.runs, args.tests, int(args.image_size * 1024 ** 2))
+
+        viewer.database = viewer.Database(env)
+        viewer.database.index.refresh()
+
+        for server in args.servers:
+            benchmark(server, args.host, images, args.clients, args.duration, args.workers)
+
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
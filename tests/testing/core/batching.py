@@ -0,0 +1,62 @@
+'''
+Module for grouping image tests into scene batches.
+
+Many tests load the same scene (e.g. Arcade/Arcade.pyscene), each starting its
+own Mogwai process. Tests loading the same set of scenes (as detected by static
+analysis of the test scripts) on the same device type are grouped into batches,
+which are run in a single Mogwai process executing the test scripts in sequence.
+'''
+
+import math
+from pathlib import Path
+
+from . import dependencies
+
+
+def scene_key(test, project_dir):
+    '''
+    Return the sorted tuple of scenes loaded by a test (resolved to files where possible),
+    or None if the test does not load any scenes statically.
+    '''
+    deps = dependencies.collect_dependencies(test.script_file)
+    scenes = set()
+    for scene, cwd in deps['scenes']:
+        scene_file = dependencies.resolve_scene(scene, cwd, project_dir)
+        scenes.add(scene_file.as_posix() if scene_file else scene)
+    return tuple(sorted(scenes)) if len(scenes) > 0 else None
+
+
+def split_evenly(items, max_size):
+    '''
+    Split a list into the minimal number of chunks of at most max_size items with sizes differing by at most one.
+    '''
+    count = math.ceil(len(items) / max_size)
+    return [items[i::count] for i in range(count)]
+
+
+def group_tests(tests, project_dir, max_size):
+    '''
+    Group tests by device type and loaded scenes.
+    Returns a tuple containing a list of batches (list of (name, tests) tuples with at least two tests each)
+    and a list of the remaining tests that are run individually.
+    Skipped tests and tests not loading any scenes are never batched.
+    '''
+    groups = {}
+    singles = []
+    for test in tests:
+        key = scene_key(test, project_dir) if not test.skipped else None
+        if key == None:
+            singles.append(test)
+            continue
+        groups.setdefault((test.device_type, key), []).append(test)
+
+    batches = []
+    for (device_type, scenes), group in sorted(groups.items()):
+        if len(group) < 2 or max_size < 2:
+            singles += group
+            continue
+        group = sorted(group, key=lambda t: t.name)
+        for chunk in split_evenly(group, max_size):
+            batches.append((f'batch{len(batches) + 1}_{Path(scenes[0]).stem}_{device_type}', chunk))
+
+    return batches, singles
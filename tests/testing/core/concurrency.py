@@ -0,0 +1,158 @@
+'''
+Module implementing adaptive control of the number of parallel Mogwai processes.
+
+The controller follows an AIMD (additive increase, multiplicative decrease)
+policy. The number of slots is evaluated in windows of at least
+PARALLEL_AUTO_INTERVAL seconds containing at least one completed test per
+slot. The number of slots is decreased multiplicatively if tests timed out
+(evaluated immediately), the host is overloaded (load average or available
+memory) or the throughput of completed tests dropped after the last increase.
+Otherwise it is increased by one slot. Every change is logged together with the signals that caused it, so that the
+policy can be tuned offline.
+'''
+
+import os
+import json
+import time
+import threading
+
+from . import config, resources
+
+
+class AdaptiveConcurrency:
+    '''
+    Controls the number of slots within [min_slots, max_slots].
+    '''
+
+    def __init__(self, initial_slots, min_slots=config.PARALLEL_AUTO_MIN, max_slots=config.PARALLEL_AUTO_MAX, interval=config.PARALLEL_AUTO_INTERVAL, print_func=print):
+        self.max_slots = max_slots or os.cpu_count() or 1
+        self.min_slots = max(1, min(min_slots, self.max_slots))
+        self.slots = max(self.min_slots, min(initial_slots, self.max_slots))
+        self.interval = interval
+        self.print_func = print_func
+        self.log_file = None
+        self.changes = []
+
+        self.mutex = threading.Lock()
+        self.start_time = time.time()
+        self.slot_time = 0.0
+        self.last_update_time = self.start_time
+        self.window_start_time = self.start_time
+        self.window_completed = 0
+        self.window_timeouts = 0
+        self.last_throughput = None
+        self.last_action = None
+
+    def start(self, log_file=None):
+        '''
+        Start a new run, logging changes to log_file (JSON lines) if given.
+        '''
+        with self.mutex:
+            self.log_file = log_file
+            if log_file:
+                log_file.parent.mkdir(parents=True, exist_ok=True)
+                log_file.write_text('')
+            self.start_time = time.time()
+            self.slot_time = 0.0
+            self.last_update_time = self.start_time
+            self.window_start_time = self.start_time
+            self.window_completed = 0
+            self.window_timeouts = 0
+
+    def completed(self, count=1):
+        '''
+        Account for completed tests.
+        '''
+        with self.mutex:
+            self.window_completed += count
+
+    def timed_out(self):
+        '''
+        Account for a test that timed out.
+        '''
+        with self.mutex:
+            self.window_timeouts += 1
+
+    def average_slots(self):
+        '''
+        Return the average number of slots since the start of the run.
+        '''
+        with self.mutex:
+            now = time.time()
+            elapsed = now - self.start_time
+            if elapsed <= 0:
+                return self.slots
+            return (self.slot_time + (now - self.last_update_time) * self.slots) / elapsed
+
+    def update(self):
+        '''
+        Evaluate the current window and adjust the number of slots.
+        Returns the number of slots.
+        '''
+        with self.mutex:
+            now = time.time()
+            self.slot_time += (now - self.last_update_time) * self.slots
+            self.last_update_time = now
+
+            elapsed = now - self.window_start_time
+            load = resources.load_average()
+            memory = resources.available_memory()
+
+            # Timeouts are acted upon immediately, other signals once per window. A window contains at least
+            # as many completed tests as there are slots, to not measure the throughput on too few samples.
+            if self.window_timeouts == 0 and (elapsed < self.interval or self.window_completed < self.slots):
+                return self.slots
+
+            throughput = self.window_completed / elapsed if elapsed > 0 else 0.0
+            signals = {
+                'throughput': throughput,
+                'completed': self.window_completed,
+                'timeouts': self.window_timeouts,
+                'timeout_rate': self.window_timeouts / self.window_completed if self.window_completed > 0 else 0.0,
+                'load': load,
+                'available_memory': memory
+            }
+
+            reason = None
+            if self.window_timeouts > 0:
+                reason = f'{self.window_timeouts} tests timed out'
+            elif memory != None and memory < config.PARALLEL_AUTO_MIN_MEMORY:
+                reason = f'available memory {memory / 2**20:.0f} MB'
+            elif load != None and load > config.PARALLEL_AUTO_MAX_LOAD:
+                reason = f'load average {load:.2f} per CPU'
+            elif self.last_action == 'increase' and self.last_throughput != None and throughput < self.last_throughput * (1.0 - config.PARALLEL_AUTO_THROUGHPUT_TOLERANCE):
+                reason = f'throughput dropped from {self.last_throughput:.3f} to {throughput:.3f} tests/s'
+
+            if reason:
+                action = 'decrease'
+                new_slots = max(self.min_slots, min(self.slots - 1, int(self.slots * config.PARALLEL_AUTO_DECREASE_FACTOR)))
+            else:
+                action = 'increase'
+                new_slots = min(self.max_slots, self.slots + 1)
+                reason = f'throughput {throughput:.3f} tests/s'
+
+            self.window_start_time = now
+            self.window_completed = 0
+            self.window_timeouts = 0
+            self.last_throughput = throughput
+            self.last_action = action if new_slots != self.slots else None
+
+            if new_slots != self.slots:
+                self.log_change(now, new_slots, action, reason, signals)
+                self.slots = new_slots
+            return self.slots
+
+    def log_change(self, now, new_slots, action, reason, signals):
+        change = {
+            'time': now - self.start_time,
+            'old_slots': self.slots,
+            'new_slots': new_slots,
+            'action': action,
+            'reason': reason
+        }
+        change.update(signals)
+        self.changes.append(change)
+        self.print_func(f'Concurrency {action}d from {self.slots} to {new_slots} slots ({reason})')
+        if self.log_file:
+            with open(self.log_file, 'a') as f:
+                f.write(json.dumps(change) + '\n')
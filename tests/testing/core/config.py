@@ -16,19 +16,189 @@ DEFAULT_TOLERANCE = 0.0
 # Default image test timeout.
 DEFAULT_TIMEOUT = 600
 
+# Default resource weight of an image test (number of parallel slots occupied).
+DEFAULT_WEIGHT = 1
+
+# Estimated duration (in seconds) of image tests without previous runs.
+DEFAULT_DURATION_ESTIMATE = 60.0
+
+# File containing the historical durations of image tests used for balancing shards (written by merge_reports).
+# All agents running shards of a run need to see the same durations to get a consistent partition.
+SHARD_DURATIONS_FILE = "tests/data/image_test_durations.json"
+
+# Environment variable passing the harness address to persistent Mogwai workers.
+WORKER_ADDRESS_ENV = "FALCOR_TEST_WORKER"
+
+# Timeout (in seconds) for a persistent Mogwai worker to start up and connect.
+WORKER_STARTUP_TIMEOUT = 300
+
+# Number of jobs after which a persistent Mogwai worker is recycled.
+WORKER_MAX_JOBS = 50
+
+# Maximum number of tests run in a single Mogwai process when batching tests by scene.
+BATCH_MAX_TESTS = 8
+
+# File written to the output directory of every test run in a scene batch, containing the result of the test script.
+BATCH_RESULT_FILE = "batch_result.json"
+
+# Maximum size (in bytes) of the stdout/stderr log files of a Mogwai process before they are rotated.
+OUTPUT_LOG_MAX_BYTES = 16 * 1024 * 1024
+
+# Number of rotated stdout/stderr log files kept per Mogwai process.
+OUTPUT_LOG_BACKUP_COUNT = 2
+
+# Number of lines of stderr of a failed Mogwai process included in the test report.
+OUTPUT_ERROR_LINES = 100
+
+# Time (in seconds) to wait for the stdout/stderr pipes of a terminated process to be closed.
+# Pipes stay open if they have been inherited by a process started by the terminated process.
+OUTPUT_PIPE_TIMEOUT = 10
+
 # Default number of processes (it will be this or # of CPUs, whichever is lower)
 DEFAULT_PROCESS_COUNT = 4
 
+# Default bounds for the number of processes with --parallel auto (the maximum defaults to the number of CPUs).
+PARALLEL_AUTO_MIN = 1
+PARALLEL_AUTO_MAX = None
+
+# Minimum interval (in seconds) between adjustments of the number of processes with --parallel auto.
+PARALLEL_AUTO_INTERVAL = 20.0
+
+# The number of processes is decreased if the load average per CPU exceeds this value ...
+PARALLEL_AUTO_MAX_LOAD = 1.5
+
+# ... or the available memory (in bytes) drops below this value ...
+PARALLEL_AUTO_MIN_MEMORY = 2 * 1024 ** 3
+
+# ... or the throughput (completed tests per second) dropped by more than this fraction after the last increase.
+PARALLEL_AUTO_THROUGHPUT_TOLERANCE = 0.1
+
+# Factor applied to the number of processes when decreasing it (multiplicative decrease).
+PARALLEL_AUTO_DECREASE_FACTOR = 0.5
+
+# File in the result directory logging the changes of the number of processes with --parallel auto (JSON lines).
+CONCURRENCY_LOG_FILE = "concurrency.jsonl"
+
 IMAGE_TESTS_DIR = "tests/image_tests"
 
 # Supported image extensions.
 IMAGE_EXTENSIONS = ['.png', '.jpg', '.tga', '.bmp', '.pfm', '.exr']
 
+# Default image comparison backend ('auto' uses NumPy if available and falls back to ImageCompare).
+DEFAULT_COMPARE_BACKEND = 'auto'
+
+# File (relative to the cache directory) caching pixel digests of reference images.
+REFERENCE_DIGESTS_FILE = 'reference_digests.json'
+
+# File (relative to the cache directory) caching file digests of reference images moved into or pulled into the reference store.
+REF_STORE_DIGESTS_FILE = 'ref_store_digests.json'
+
+# Directory (relative to the cache directory) for caching decoded reference images.
+DECODED_CACHE_DIR = "decoded_refs"
+
+# Maximum size (in bytes) of the decoded reference image cache.
+DECODED_CACHE_MAX_BYTES = 16 * 1024 ** 3
+
+# Manifest file in reference directories mapping image paths to the digests of the objects in the reference store.
+REF_MANIFEST_FILE = 'manifest.json'
+
+# Method used for linking reference directories to objects in the reference store ('hardlink' or 'symlink').
+# Symbolic links are used if hard links are not supported, files are copied if neither is supported.
+REF_LINK_MODE = 'hardlink'
+
+# Number of threads used for scanning and copying files when mirroring reference directories.
+MIRROR_THREADS = 16
+
+# Tolerance (in seconds) for comparing modification times when mirroring, as file systems differ in resolution.
+MIRROR_MTIME_TOLERANCE = 2.0
+
 # Suffix to use for error images.
 ERROR_IMAGE_SUFFIX = '.error.png'
 
+# Size (in pixels) of the square tiles used for localizing image comparison errors.
+COMPARE_TILE_SIZE = 32
+
+# Number of tiles with the largest error recorded in the report of an image.
+COMPARE_WORST_TILES = 5
+
+# Suffixes (inserted before the extension) of images providing the variance estimate for statistical comparison:
+# a per-pixel variance image of the estimate or a second, independent capture of the same image.
+VARIANCE_IMAGE_SUFFIX = '.variance'
+SECOND_CAPTURE_SUFFIX = '.second'
+
+# Default options of the statistical image comparison (enabled by the 'statistical' entry in the IMAGE_TEST header).
+# variance: 'capture' (estimate from a second capture) or 'image' (per-pixel variance image)
+# tile_size: size of the square tiles tested in pixels
+# fdr: false discovery rate controlled over all tiles of an image
+# outputs: file name patterns (fnmatch) of the images compared statistically, e.g. ['*.ToneMapper.dst.*'];
+#          other images (e.g. deterministic outputs such as normals) are compared against the tolerance
+STATISTICAL_COMPARE_DEFAULTS = { 'variance': 'capture', 'tile_size': 16, 'fdr': 0.01, 'outputs': ['*'] }
+
 PYTHON_TESTS_DIR = "tests/python_tests"
 
+# File in the result directory logging the results of tests as soon as they complete (JSON lines).
+RESULT_LOG_FILE = "results.jsonl"
+
+# Minimum interval (in seconds) between rewrites of the run reports of an incomplete run (results.jsonl is always up to date).
+REPORT_WRITE_INTERVAL = 1.0
+
+# Directory for caches used by the testing infrastructure.
+CACHE_DIR = "tests/data/cache"
+
+# File (relative to the cache directory) containing the index of image test results used by view_image_tests.
+VIEWER_INDEX_FILE = "viewer_index.db"
+
+# Interval (in seconds) for refreshing the index of image test results in view_image_tests.
+VIEWER_INDEX_REFRESH_INTERVAL = 10.0
+
+# Default and maximum number of runs or tests returned per page by the view_image_tests API.
+VIEWER_PAGE_SIZE = 100
+VIEWER_MAX_PAGE_SIZE = 1000
+
+# Directory (relative to the cache directory) for caching image previews shown by view_image_tests.
+PREVIEW_CACHE_DIR = "previews"
+
+# Maximum size (in bytes) of the image preview cache.
+PREVIEW_CACHE_MAX_BYTES = 2 * 1024 ** 3
+
+# Default and maximum size (in pixels, of the larger side) of image previews.
+PREVIEW_SIZE = 128
+PREVIEW_MAX_SIZE = 1024
+
+# Quality of image previews encoded as WebP (0-100).
+PREVIEW_WEBP_QUALITY = 85
+
+# Directory (relative to the cache directory) for caching metric maps shown in the compare view of view_image_tests.
+METRIC_CACHE_DIR = "metric_maps"
+
+# Maximum size (in bytes) of the metric map cache.
+METRIC_CACHE_MAX_BYTES = 4 * 1024 ** 3
+
+# Number of worker threads of the threaded view_image_tests server.
+VIEWER_SERVER_WORKERS = 16
+
+# Time (in seconds) after which idle keep-alive connections to the threaded view_image_tests server are closed.
+VIEWER_KEEP_ALIVE_TIMEOUT = 5.0
+
+# Compression level (1-9) of gzip compressed responses of the threaded view_image_tests server.
+VIEWER_GZIP_LEVEL = 6
+
+# Directory containing render pass sources.
+RENDER_PASSES_DIR = "Source/RenderPasses"
+
+# Project relative directories in which changed files only affect the image tests
+# statically depending on them. Changes to files outside these directories affect all tests.
+DEPENDENCY_SCOPED_DIRS = ["Source/RenderPasses/", "tests/image_tests/", "tests/python_tests/", "docs/"]
+
+# Patterns of changed files that never affect image tests.
+DEPENDENCY_IGNORED_FILES = ["*.md"]
+
+# Directories in the build directory that are included in the fingerprint of incremental image tests.
+INCREMENTAL_BUILD_DIRS = ['plugins', 'shaders']
+
+# File (relative to the cache directory) caching file digests of the inputs of incremental image tests.
+INCREMENTAL_DIGESTS_FILE = 'incremental_digests.json'
+
 # Build configurations.
 BUILD_CONFIGS = {
     # Temporary build configurations combining a CMake preset and build type.
@@ -0,0 +1,445 @@
+'''
+Module for statically analyzing the dependencies of image test scripts.
+
+Scripts are parsed using the ast module and never executed, so this works
+without importing falcor. The dependencies of all tests (scripts, imported
+modules, scene files, asset files and render pass sources) are combined into a reverse
+index mapping source paths to tests, which is used to select the tests
+affected by a set of changed files. Scripts executed by tests (e.g. the render
+graphs in scripts/ loaded using exec(open(PATH).read())) are analyzed like
+imported modules. Tests with dynamic loads that cannot be resolved statically
+are conservatively affected by every change.
+'''
+
+import os
+import re
+import ast
+import threading
+from pathlib import Path
+
+from . import config
+
+
+def parse_script(script_file):
+    '''
+    Parse a python script and return the AST (or None if the script cannot be parsed).
+    '''
+    try:
+        return ast.parse(Path(script_file).read_text('utf-8'), filename=str(script_file))
+    except (OSError, SyntaxError, ValueError):
+        return None
+
+
+def string_constants(tree):
+    '''
+    Return a dictionary of all module level names that are assigned a string constant.
+    '''
+    constants = {}
+    for node in tree.body:
+        if isinstance(node, ast.Assign) and isinstance(node.value, ast.Constant) and isinstance(node.value.value, str):
+            for target in node.targets:
+                if isinstance(target, ast.Name):
+                    constants[target.id] = node.value.value
+    return constants
+
+
+def eval_string(node, constants):
+    '''
+    Evaluate a string expression (constant, name of a string constant or os.path.abspath() of either).
+    Returns None if the expression cannot be evaluated statically.
+    '''
+    if isinstance(node, ast.Constant) and isinstance(node.value, str):
+        return node.value
+    if isinstance(node, ast.Name):
+        return constants.get(node.id, None)
+    if isinstance(node, ast.Call) and isinstance(node.func, ast.Attribute) and node.func.attr == 'abspath' and len(node.args) == 1:
+        return eval_string(node.args[0], constants)
+    return None
+
+
+def is_method_call(node, name):
+    '''
+    Check if a node is a call to a method (or function) with the given name.
+    '''
+    if not isinstance(node, ast.Call):
+        return False
+    if isinstance(node.func, ast.Attribute):
+        return node.func.attr == name
+    if isinstance(node.func, ast.Name):
+        return node.func.id == name
+    return False
+
+
+def search_dirs(tree, script_dir):
+    '''
+    Return the module search directories of a script.
+    These are the script directory and all directories added using sys.path.append().
+    '''
+    dirs = [script_dir]
+    constants = string_constants(tree)
+    for node in ast.walk(tree):
+        if is_method_call(node, 'append') and isinstance(node.func.value, ast.Attribute) and node.func.value.attr == 'path' and len(node.args) == 1:
+            path = eval_string(node.args[0], constants)
+            if path != None:
+                dirs.append((script_dir / path).resolve())
+    return dirs
+
+
+def find_module(name, dirs):
+    '''
+    Find the source file of a module in a list of search directories.
+    Returns None for modules that are not found (e.g. falcor or standard library modules).
+    '''
+    parts = name.split('.')
+    for d in dirs:
+        module_file = Path(d, *parts).with_suffix('.py')
+        if module_file.is_file():
+            return module_file.resolve()
+        package_file = Path(d, *parts) / '__init__.py'
+        if package_file.is_file():
+            return package_file.resolve()
+    return None
+
+
+def resolve_file(path, dirs):
+    '''
+    Resolve a (relative) path to an existing file in a list of directories.
+    Returns None if the file is not found.
+    '''
+    for d in dirs:
+        try:
+            file = Path(d) / path
+            if file.is_file():
+                return file.resolve()
+        except (OSError, ValueError):
+            pass
+    return None
+
+
+def opened_file(node, constants):
+    '''
+    Return the path of the file read by an expression like open(PATH).read() or compile(open(PATH).read(), ...).
+    Returns None if the expression does not read a file with a statically known path.
+    '''
+    if is_method_call(node, 'read') and isinstance(node.func, ast.Attribute):
+        return opened_file(node.func.value, constants)
+    if is_method_call(node, 'compile') and len(node.args) > 0:
+        return opened_file(node.args[0], constants)
+    if is_method_call(node, 'open') and isinstance(node.func, ast.Name) and len(node.args) > 0:
+        return eval_string(node.args[0], constants)
+    return None
+
+
+def is_asset_string(value):
+    '''
+    Check if a string constant looks like a file path (e.g. a texture or environment map loaded by a script).
+    '''
+    return 0 < len(value) < 260 and Path(value).suffix != '' and not any(c in value for c in '\n\r\t*?<>|"')
+
+
+def analyze_script(script_file, cwd=None):
+    '''
+    Analyze a single script.
+    Relative paths are resolved against the working directory cwd (the script directory by default).
+    Returns a dictionary containing the local modules imported, the scripts executed (exec(open(PATH).read()),
+    m.script(PATH) or runpy.run_path(PATH)), the scene paths loaded, the render passes created, the strings
+    that may refer to asset files and descriptions of dynamic loads that cannot be resolved statically.
+    '''
+    script_file = Path(script_file).resolve()
+    cwd = Path(cwd) if cwd else script_file.parent
+    result = { 'modules': [], 'scripts': [], 'scenes': [], 'passes': [], 'assets': [], 'dynamic': [] }
+
+    tree = parse_script(script_file)
+    if tree == None:
+        result['dynamic'].append(f'{script_file}: cannot parse script')
+        return result
+
+    dirs = search_dirs(tree, script_file.parent)
+    constants = string_constants(tree)
+
+    def add(key, value):
+        if not value in result[key]:
+            result[key].append(value)
+
+    def add_script(node, path):
+        file = resolve_file(path, [cwd, script_file.parent]) if path != None else None
+        if file:
+            add('scripts', file)
+        else:
+            add('dynamic', f'{script_file}:{node.lineno}: cannot resolve script' + (f' "{path}"' if path != None else ''))
+
+    for node in ast.walk(tree):
+        names = []
+        if isinstance(node, ast.Import):
+            names = [alias.name for alias in node.names]
+        elif isinstance(node, ast.ImportFrom) and node.module and node.level == 0:
+            names = [node.module]
+        elif (is_method_call(node, 'import_module') or is_method_call(node, '__import__')) and len(node.args) > 0:
+            name = eval_string(node.args[0], constants)
+            if name == None:
+                add('dynamic', f'{script_file}:{node.lineno}: cannot resolve imported module')
+            else:
+                names = [name]
+        for name in names:
+            module_file = find_module(name, dirs)
+            if module_file and module_file != script_file:
+                add('modules', module_file)
+
+        if is_method_call(node, 'exec') and isinstance(node.func, ast.Name) and len(node.args) > 0:
+            add_script(node, opened_file(node.args[0], constants))
+
+        if (is_method_call(node, 'script') and isinstance(node.func, ast.Attribute) or is_method_call(node, 'run_path')) and len(node.args) > 0:
+            add_script(node, eval_string(node.args[0], constants))
+
+        if is_method_call(node, 'loadScene') and len(node.args) > 0:
+            scene = eval_string(node.args[0], constants)
+            if scene != None:
+                add('scenes', scene)
+            else:
+                add('dynamic', f'{script_file}:{node.lineno}: cannot resolve scene')
+
+        if is_method_call(node, 'createPass') and len(node.args) > 0:
+            name = eval_string(node.args[0], constants)
+            if name != None:
+                add('passes', name)
+            else:
+                add('dynamic', f'{script_file}:{node.lineno}: cannot resolve render pass')
+
+        if isinstance(node, ast.Constant) and isinstance(node.value, str) and is_asset_string(node.value):
+            add('assets', node.value)
+
+    return result
+
+
+# Results of collect_dependencies() by script file, validated by the modification times and sizes of the analyzed files.
+dependency_cache = {}
+dependency_cache_mutex = threading.Lock()
+
+
+def file_stamp(path):
+    try:
+        st = os.stat(path)
+        return (st.st_mtime_ns, st.st_size)
+    except OSError:
+        return None
+
+
+def collect_dependencies(script_file):
+    '''
+    Collect the dependencies of a script, following imports of local modules and executed scripts recursively.
+    Returns a dictionary containing the list of module files, the list of executed script files, a list of
+    (scene, directory) tuples, where directory is the working directory of the script that loads the scene,
+    the list of render passes created, a list of (path, directory) tuples of strings that may refer to asset
+    files (see resolve_assets()) and a list of descriptions of dynamic loads that cannot be resolved statically.
+    A script with dynamic loads may depend on any file.
+    Results are cached, scripts are only analyzed again if one of the analyzed files changed.
+    '''
+    script_file = Path(script_file).resolve()
+    with dependency_cache_mutex:
+        cached = dependency_cache.get(script_file, None)
+    if cached and all(file_stamp(f) == stamp for f, stamp in cached[0].items()):
+        return { key: list(value) for key, value in cached[1].items() }
+
+    # Modules and executed scripts run in the working directory of the test, which is the test script directory.
+    cwd = script_file.parent
+    deps = { 'modules': [], 'scripts': [], 'scenes': [], 'passes': [], 'assets': [], 'dynamic': [] }
+    pending = [script_file]
+    visited = {}
+
+    while len(pending) > 0:
+        module_file = pending.pop(0)
+        if module_file in visited:
+            continue
+        visited[module_file] = file_stamp(module_file)
+
+        result = analyze_script(module_file, cwd)
+        for key in ['modules', 'scripts']:
+            for f in result[key]:
+                if not f in deps[key] and f != script_file:
+                    deps[key].append(f)
+                    pending.append(f)
+        for scene in result['scenes']:
+            if not (scene, cwd) in deps['scenes']:
+                deps['scenes'].append((scene, cwd))
+        for asset in result['assets']:
+            if not (asset, cwd) in deps['assets']:
+                deps['assets'].append((asset, cwd))
+        for key in ['passes', 'dynamic']:
+            deps[key] += [v for v in result[key] if not v in deps[key]]
+
+    with dependency_cache_mutex:
+        dependency_cache[script_file] = (visited, deps)
+    return { key: list(value) for key, value in deps.items() }
+
+
+def media_dirs(project_dir):
+    '''
+    Return the list of directories scenes are searched in (same as Falcor's data directories).
+    '''
+    dirs = [Path(project_dir) / 'media']
+    folders = os.environ.get('FALCOR_MEDIA_FOLDERS', None)
+    if folders:
+        dirs += [Path(f) for f in folders.split(';') if f != '']
+    return dirs
+
+
+def resolve_scene(scene, cwd, project_dir):
+    '''
+    Resolve a scene path to a file.
+    Returns None if the scene file cannot be found.
+    '''
+    for d in [cwd] + media_dirs(project_dir):
+        path = Path(d) / scene
+        if path.is_file():
+            return path.resolve()
+    return None
+
+
+def scene_files(scene_file):
+    '''
+    Return a list of files making up a scene.
+    For python scene files, this includes all files referenced by string constants in the script.
+    '''
+    files = [scene_file]
+    if scene_file.suffix == '.pyscene':
+        tree = parse_script(scene_file)
+        if tree:
+            for node in ast.walk(tree):
+                if isinstance(node, ast.Constant) and isinstance(node.value, str) and len(node.value) < 260:
+                    try:
+                        path = scene_file.parent / node.value
+                        if path.is_file() and not path.resolve() in files:
+                            files.append(path.resolve())
+                    except (OSError, ValueError):
+                        pass
+    return files
+
+
+def resolve_assets(deps, project_dir):
+    '''
+    Resolve the asset strings of collected dependencies (see collect_dependencies()) to existing files,
+    excluding scripts, modules and scenes (which are tracked separately).
+    '''
+    known = set(deps['modules'] + deps['scripts'])
+    for scene, cwd in deps['scenes']:
+        known.add(resolve_scene(scene, cwd, project_dir))
+    files = []
+    for asset, cwd in deps['assets']:
+        file = resolve_file(asset, [cwd] + media_dirs(project_dir))
+        if file and not file in known and not file in files:
+            files.append(file)
+    return files
+
+
+def render_pass_sources(project_dir):
+    '''
+    Find the source locations of all render passes by looking for FALCOR_PLUGIN_CLASS declarations.
+    Returns a dictionary mapping render pass names to lists of project relative source paths.
+    Paths ending with '/' denote directory trees, all other paths denote single files.
+    '''
+    passes_dir = Path(project_dir) / config.RENDER_PASSES_DIR
+    regex = re.compile(r'FALCOR_PLUGIN_CLASS\(\s*\w+\s*,\s*"(\w+)"')
+    sources = {}
+
+    for header in passes_dir.glob('**/*.h'):
+        try:
+            names = regex.findall(header.read_text('utf-8', errors='replace'))
+        except OSError:
+            continue
+        if len(names) == 0:
+            continue
+
+        # A render pass depends on the directory containing its header. If the pass is part of a
+        # plugin containing multiple passes, it also depends on the files in the plugin root directory.
+        plugin_dir = passes_dir / header.relative_to(passes_dir).parts[0]
+        paths = [header.parent.relative_to(project_dir).as_posix() + '/']
+        if header.parent != plugin_dir:
+            paths += [f.relative_to(project_dir).as_posix() for f in sorted(plugin_dir.iterdir()) if f.is_file()]
+
+        for name in names:
+            sources[name] = paths
+
+    return sources
+
+
+class DependencyIndex:
+    '''
+    Reverse index mapping source paths to the tests depending on them.
+    '''
+
+    def __init__(self, project_dir, tests):
+        self.project_dir = Path(project_dir).resolve()
+        self.test_names = [t.name for t in tests]
+        self.index = {}
+        # Tests with dynamic loads that cannot be resolved statically (test name -> descriptions of the loads).
+        self.dynamic = {}
+
+        pass_sources = render_pass_sources(self.project_dir)
+
+        for test in tests:
+            deps = collect_dependencies(test.script_file)
+            if len(deps['dynamic']) > 0:
+                self.dynamic[test.name] = deps['dynamic']
+            paths = [test.script_file] + deps['modules'] + deps['scripts'] + resolve_assets(deps, self.project_dir)
+            for scene, cwd in deps['scenes']:
+                scene_file = resolve_scene(scene, cwd, self.project_dir)
+                if scene_file:
+                    paths += scene_files(scene_file)
+
+            for path in paths:
+                self.add(self.relative_path(path), test.name)
+            for name in deps['passes']:
+                for path in pass_sources.get(name, []):
+                    self.add(path, test.name)
+
+    def relative_path(self, path):
+        '''
+        Return a project relative path (or an absolute path for files outside of the project).
+        '''
+        path = Path(path).resolve()
+        try:
+            return path.relative_to(self.project_dir).as_posix()
+        except ValueError:
+            return path.as_posix()
+
+    def add(self, path, test_name):
+        if not path in self.index:
+            self.index[path] = []
+        if not test_name in self.index[path]:
+            self.index[path].append(test_name)
+
+    def reverse_index(self):
+        '''
+        Return the reverse index as a dictionary mapping source paths to lists of test names.
+        '''
+        return { path: sorted(names) for path, names in sorted(self.index.items()) }
+
+    def affected_tests(self, changed_files):
+        '''
+        Determine the tests affected by a list of project relative changed files.
+        Returns a tuple containing the set of affected test names and a list of changed files
+        that affect all tests (files without a known scope, e.g. Falcor core sources).
+        Tests with dynamic loads (see self.dynamic) are affected by every change.
+        '''
+        affected = set()
+        global_files = []
+
+        for changed_file in changed_files:
+            if any(Path(changed_file).match(pattern) for pattern in config.DEPENDENCY_IGNORED_FILES):
+                continue
+            affected.update(self.dynamic.keys())
+
+            matched = False
+            for path, names in self.index.items():
+                if changed_file == path or (path.endswith('/') and changed_file.startswith(path)):
+                    affected.update(names)
+                    matched = True
+
+            # Files in scoped directories only affect the tests explicitly depending on them.
+            if not matched and not any(changed_file.startswith(d) for d in config.DEPENDENCY_SCOPED_DIRS):
+                global_files.append(changed_file)
+
+        if len(global_files) > 0:
+            affected = set(self.test_names)
+
+        return affected, global_files
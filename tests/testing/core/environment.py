@@ -79,7 +79,8 @@ class Environment:
                     'properties': {
                         'result_dir': { 'type': str },
                         'ref_dir': { 'type': str },
-                        'remote_ref_dir': { 'type': str, 'optional': True }
+                        'remote_ref_dir': { 'type': str, 'optional': True },
+                        'ref_objects_dir': { 'type': str, 'optional': True }
                     }
                 }
             }
@@ -105,6 +106,7 @@ class Environment:
         self.image_tests_result_dir = env['image_tests']['result_dir']
         self.image_tests_ref_dir = env['image_tests']['ref_dir']
         self.image_tests_remote_ref_dir = env['image_tests'].get('remote_ref_dir', None)
+        self.image_tests_ref_objects_dir = env['image_tests'].get('ref_objects_dir', None)
         self.python_tests_dir = self.project_dir / config.PYTHON_TESTS_DIR
 
         self.build_config = build_config
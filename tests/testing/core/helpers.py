@@ -4,10 +4,22 @@ Module with various helpers functions.
 
 import os
 import re
+import json
+import time
+import hashlib
+import tempfile
+import threading
+import contextlib
 import subprocess
 import socket
+from pathlib import Path
 from urllib.parse import urlparse
 
+if os.name == 'nt':
+    import msvcrt
+else:
+    import fcntl
+
 def get_git_head_branch(path):
     '''
     Return the git HEAD branch name by reading from .git/HEAD file.
@@ -50,14 +62,142 @@ def get_vcs_root(path):
     print("Error. Unknown VCS root `" + url[0] + "`")
     return url[0].lower()
 
-def mirror_folders(src_dir, dst_dir):
+def get_git_changed_files(path, ref):
+    '''
+    Return the list of files (relative to the repository root) that changed since the given git ref.
+    This includes uncommitted changes and untracked files.
+    Raises RuntimeError if git fails (e.g. unknown ref).
+    '''
+    files = []
+    for args in [['git', 'diff', '--name-only', ref], ['git', 'ls-files', '--others', '--exclude-standard']]:
+        process = subprocess.run(args, cwd=path, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        if process.returncode != 0:
+            raise RuntimeError(f'"{" ".join(args)}" failed: {process.stderr.decode("utf-8", errors="replace").strip()}')
+        files += [f for f in process.stdout.decode('utf-8').splitlines() if f != '' and not f in files]
+    return files
+
+def write_file_atomic(path, data):
+    '''
+    Atomically write a string to a file.
+    The data is written to a uniquely named temporary file which then replaces the file,
+    so that concurrent writers never interleave and readers never see partial files.
+    '''
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_file = None
+    try:
+        with tempfile.NamedTemporaryFile('w', encoding='utf-8', dir=path.parent, prefix='.' + path.name + '.', suffix='.tmp', delete=False) as f:
+            tmp_file = f.name
+            f.write(data)
+        os.replace(tmp_file, path)
+    except BaseException:
+        if tmp_file and os.path.exists(tmp_file):
+            os.unlink(tmp_file)
+        raise
+
+def write_json_file(path, data, indent=None, sort_keys=False):
+    '''
+    Atomically write data to a JSON file (see write_file_atomic).
+    '''
+    write_file_atomic(path, json.dumps(data, indent=indent, sort_keys=sort_keys))
+
+@contextlib.contextmanager
+def file_lock(lock_file):
     '''
-    Mirror contents from src_dir to dst_dir.
+    Context manager holding an exclusive lock on lock_file (created if missing) to synchronize processes.
+    The lock is released when the process exits, so crashed processes do not leave stale locks behind.
+    Locks are not reentrant and do not synchronize threads of the same process.
     '''
-    if os.name != 'nt':
-        raise RuntimeError('mirror_folders() is not implemented for this OS')
+    lock_file = Path(lock_file)
+    lock_file.parent.mkdir(parents=True, exist_ok=True)
+    with open(lock_file, 'a+') as f:
+        if os.name == 'nt':
+            # Lock the first byte, msvcrt.locking() has no blocking mode without a retry limit.
+            f.seek(0)
+            while True:
+                try:
+                    msvcrt.locking(f.fileno(), msvcrt.LK_NBLCK, 1)
+                    break
+                except OSError:
+                    time.sleep(0.1)
+        else:
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            if os.name == 'nt':
+                f.seek(0)
+                msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
+            else:
+                fcntl.flock(f.fileno(), fcntl.LOCK_UN)
 
-    args = ["Robocopy.exe", str(src_dir), str(dst_dir), "/MIR", "/FFT", "/Z", "/XA:H", "/W:5", "/np"]
-    process = subprocess.Popen(args, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
-    output = process.communicate()[0]
-    return process.returncode <= 7, output.decode('ascii')
+class FileCache:
+    '''
+    Cache of values computed from files (e.g. digests or parsed headers).
+    Entries are keyed by path, modification time and size and can be persisted to a JSON file.
+    Values need to be JSON serializable.
+    '''
+
+    def __init__(self, cache_file=None):
+        self.cache_file = cache_file
+        self.mutex = threading.Lock()
+        self.entries = {}
+        self.dirty = False
+
+        if cache_file and Path(cache_file).exists():
+            try:
+                with open(cache_file) as f:
+                    self.entries = json.load(f)
+            except (OSError, ValueError):
+                self.entries = {}
+
+    def get(self, path):
+        '''
+        Return the cached value for a file or None if not cached or outdated.
+        '''
+        st = os.stat(path)
+        with self.mutex:
+            entry = self.entries.get(str(path))
+        if entry and entry[0] == st.st_mtime_ns and entry[1] == st.st_size:
+            return entry[2]
+        return None
+
+    def put(self, path, value):
+        '''
+        Store the value for a file.
+        '''
+        st = os.stat(path)
+        with self.mutex:
+            self.entries[str(path)] = [st.st_mtime_ns, st.st_size, value]
+            self.dirty = True
+
+    def save(self):
+        '''
+        Write the cache to disk (if it has been modified).
+        '''
+        with self.mutex:
+            if not self.cache_file or not self.dirty:
+                return
+            try:
+                write_json_file(self.cache_file, self.entries)
+                self.dirty = False
+            except OSError:
+                pass
+
+def file_digest(path, digest_cache=None):
+    '''
+    Compute the BLAKE2 digest of the contents of a file.
+    If a digest cache is given, it is used to avoid rehashing unchanged files.
+    '''
+    if digest_cache:
+        digest = digest_cache.get(path)
+        if digest:
+            return digest
+    h = hashlib.blake2b(digest_size=16)
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            h.update(block)
+    digest = h.hexdigest()
+    if digest_cache:
+        digest_cache.put(path, digest)
+    return digest
@@ -0,0 +1,758 @@
+'''
+Module for comparing images.
+
+Images are compared in-process using NumPy. The metrics and error heat maps
+are computed exactly like the ImageCompare tool does (same precision and same
+order of operations), so results are identical to running ImageCompare.
+Images that cannot be decoded in-process (or if NumPy is not available) are
+compared by running the ImageCompare executable instead.
+
+Errors are computed in bands of tile rows, recording the mean and maximum error
+of every tile, so that the tiles with the largest errors can be reported. The
+total error is accumulated across bands in the same order as in ImageCompare.
+As per-pixel errors are non-negative, a comparison can stop early once the
+partial error exceeds the tolerance if only the pass/fail result is needed.
+
+Before computing a metric, the decoded pixels of the result image are hashed
+and compared against the (cached) hash of the reference image. Identical
+images are reported with zero error without decoding the reference image,
+unless the reference contains non-finite pixels (which always fail).
+Decoded reference images can be cached as float32 .npy files keyed by the
+digest of the image file, which are memory-mapped instead of decoding the
+reference again (see DecodedImageCache).
+
+Images of Monte Carlo renderers can alternatively be compared statistically,
+which allows rendering with fewer samples than needed for a hard error
+threshold. The mean difference of every tile is tested against the noise level
+(z-test), with the variance estimated from a second, independent capture or a
+per-pixel variance image, and the false discovery rate over all tiles is
+controlled using the Benjamini-Hochberg procedure. The comparison fails if any
+tile differs significantly.
+'''
+
+import os
+import math
+import time
+import tempfile
+import struct
+import zlib
+import hashlib
+import threading
+import subprocess
+import multiprocessing
+import concurrent.futures
+from pathlib import Path
+
+from . import config
+from .helpers import FileCache, file_digest
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+try:
+    from PIL import Image as PILImage
+except ImportError:
+    PILImage = None
+
+try:
+    import pyexr
+except ImportError:
+    pyexr = None
+
+# Available comparison backends.
+BACKENDS = ['auto', 'numpy', 'exe']
+
+# Available error metrics.
+METRICS = ['mse', 'rmse', 'mae', 'mape']
+
+# Image modes that are decoded using PIL (8-bit per channel formats).
+PIL_MODES = ['1', 'L', 'LA', 'P', 'PA', 'RGB', 'RGBA']
+
+# Colors used for the error heat map (same as in ImageCompare).
+HEAT_MAP_COLORS = [
+    [0.0, 0.0, 1.0], # blue
+    [0.0, 1.0, 1.0], # teal
+    [0.0, 1.0, 0.0], # green
+    [1.0, 1.0, 0.0], # yellow
+    [1.0, 0.0, 0.0], # red
+]
+
+
+class UnsupportedImageError(Exception):
+    '''
+    Raised if an image cannot be decoded in-process.
+    '''
+    pass
+
+
+def is_numpy_available():
+    '''
+    Check if the NumPy backend is available.
+    '''
+    return np != None
+
+
+def load_pfm(path):
+    '''
+    Load a PFM image and return it as a float32 array of shape (height, width, channels).
+    '''
+    with open(path, 'rb') as f:
+        tokens = []
+        # Header consists of 4 whitespace separated tokens.
+        while len(tokens) < 4:
+            line = f.readline()
+            if not line:
+                raise UnsupportedImageError(f'Invalid PFM header in "{path}"')
+            tokens += line.split()
+        try:
+            magic, width, height, scale = tokens[0], int(tokens[1]), int(tokens[2]), float(tokens[3])
+        except ValueError:
+            raise UnsupportedImageError(f'Invalid PFM header in "{path}"')
+        if width <= 0 or height <= 0:
+            raise UnsupportedImageError(f'Invalid PFM header in "{path}"')
+        if magic == b'PF':
+            channels = 3
+        elif magic == b'Pf':
+            channels = 1
+        else:
+            raise UnsupportedImageError(f'Invalid PFM header in "{path}"')
+        dtype = '<f4' if scale < 0 else '>f4'
+        data = np.fromfile(f, dtype=dtype, count=width * height * channels)
+    if data.size != width * height * channels:
+        raise UnsupportedImageError(f'Truncated PFM file "{path}"')
+    # PFM stores scanlines bottom to top.
+    return np.flipud(data.reshape(height, width, channels)).astype(np.float32)
+
+
+def load_pil(path):
+    '''
+    Load an 8-bit image using PIL and return it as a uint8 array of shape (height, width, 4).
+    '''
+    if PILImage == None:
+        raise UnsupportedImageError('PIL is not available')
+    with PILImage.open(path) as image:
+        if image.mode not in PIL_MODES:
+            raise UnsupportedImageError(f'Unsupported image mode "{image.mode}" in "{path}"')
+        return np.asarray(image.convert('RGBA'))
+
+
+def load_exr(path):
+    '''
+    Load an EXR image using pyexr and return it as a float32 array of shape (height, width, channels).
+    '''
+    if pyexr == None:
+        raise UnsupportedImageError('pyexr is not available')
+    data = pyexr.read(str(path))
+    if data.ndim == 2:
+        data = data[:, :, np.newaxis]
+    return data.astype(np.float32, copy=False)
+
+
+def load_image(path):
+    '''
+    Load an image and return it as a float32 RGBA array of shape (height, width, 4).
+    The conversion to RGBA float matches FreeImage_ConvertToRGBAF() used by ImageCompare.
+    Raises UnsupportedImageError if the image cannot be decoded in-process.
+    '''
+    if np == None:
+        raise UnsupportedImageError('NumPy is not available')
+
+    suffix = Path(path).suffix.lower()
+    if suffix in ['.png', '.tga', '.bmp']:
+        return load_pil(path).astype(np.float32) / np.float32(255)
+    elif suffix in ['.exr', '.pfm']:
+        data = load_exr(path) if suffix == '.exr' else load_pfm(path)
+        height, width, channels = data.shape
+        image = np.ones((height, width, 4), dtype=np.float32)
+        if channels == 1:
+            image[:, :, 0:3] = data
+        elif channels in [3, 4]:
+            image[:, :, 0:channels] = data
+        else:
+            raise UnsupportedImageError(f'Unsupported number of channels ({channels}) in "{path}"')
+        return image
+    else:
+        # JPEG decoding is not guaranteed to match FreeImage.
+        raise UnsupportedImageError(f'Unsupported image format "{suffix}"')
+
+
+def channel_errors(metric, a, b):
+    '''
+    Compute the per-channel error of a metric in double precision.
+    Arguments are float32 arrays, intermediate results are rounded like in ImageCompare.
+    '''
+    diff = a - b
+    if metric == 'mse' or metric == 'mae':
+        return (diff * diff).astype(np.float64)
+    elif metric == 'rmse':
+        return (diff * diff).astype(np.float64) / ((a * a).astype(np.float64) + 1e-3)
+    elif metric == 'mape':
+        return np.abs(diff.astype(np.float64) / (a.astype(np.float64) + 1e-3))
+    else:
+        raise ValueError(f'Unknown error metric "{metric}"')
+
+
+def compute_error_map(metric, image_a, image_b, alpha=False):
+    '''
+    Compute the per-pixel error (in double precision) between two RGBA float32 images.
+    '''
+    channels = 4 if alpha else 3
+    errors = channel_errors(metric, image_a[:, :, 0:channels], image_b[:, :, 0:channels])
+    # Accumulate channels in order to get identical rounding.
+    error_map = errors[:, :, 0].copy()
+    for c in range(1, channels):
+        error_map += errors[:, :, c]
+    if metric == 'mape':
+        # ImageCompare scales every pixel (not the total) to percent.
+        error_map *= 100.0
+    return error_map / channels
+
+
+def compute_error(metric, error_map):
+    '''
+    Compute the total error from a per-pixel error map.
+    '''
+    count = error_map.size
+    if count == 0:
+        return float('nan')
+    # Sum sequentially (np.sum uses pairwise summation) to match ImageCompare.
+    error = np.add.accumulate(error_map.ravel())[-1] / count
+    return float(error)
+
+
+def generate_heat_map(error_map):
+    '''
+    Generate an RGBA8 heat map visualizing a per-pixel error map.
+    '''
+    error_map = error_map.astype(np.float32)
+    min_value = error_map.min()
+    max_value = error_map.max()
+    value_range = max(np.float32(1e-5), max_value - min_value)
+    t = np.clip((error_map - min_value) / value_range, np.float32(0), np.float32(1))
+    c = np.clip(np.floor(t * np.float32(4)).astype(np.int32), 0, 3)
+    f = (t * np.float32(4) - c.astype(np.float32))[:, :, np.newaxis]
+    colors = np.array(HEAT_MAP_COLORS, dtype=np.float32)
+    lo = colors[c]
+    hi = colors[c + 1]
+    rgb = lo + f * (hi - lo)
+    heat_map = np.full(error_map.shape + (4,), 255, dtype=np.uint8)
+    heat_map[:, :, 0:3] = np.clip((rgb * np.float32(255)).astype(np.int32), 0, 255)
+    return heat_map
+
+
+def encode_png(data):
+    '''
+    Encode an 8-bit RGB or RGBA array of shape (height, width, channels) as PNG.
+    '''
+    height, width, channels = data.shape
+    color_type = { 3: 2, 4: 6 }[channels]
+
+    def chunk(tag, payload):
+        return struct.pack('>I', len(payload)) + tag + payload + struct.pack('>I', zlib.crc32(tag + payload) & 0xffffffff)
+
+    # Prefix every scanline with filter type 0 (none).
+    raw = np.zeros((height, 1 + width * channels), dtype=np.uint8)
+    raw[:, 1:] = data.reshape(height, width * channels)
+
+    return b''.join([
+        b'\x89PNG\r\n\x1a\n',
+        chunk(b'IHDR', struct.pack('>IIBBBBB', width, height, 8, color_type, 0, 0, 0)),
+        chunk(b'IDAT', zlib.compress(raw.tobytes(), 6)),
+        chunk(b'IEND', b'')
+    ])
+
+
+def encode_exr(data):
+    '''
+    Encode a float RGB array of shape (height, width, 3) as OpenEXR image with half float channels (ZIP compressed).
+    Values are clamped to the range of half floats.
+    '''
+    height, width, _ = data.shape
+    # Channels are stored in alphabetical order.
+    half = np.clip(data, -65504, 65504).astype('<f2')[:, :, ::-1]
+
+    def attribute(name, type, value):
+        return name.encode() + b'\0' + type.encode() + b'\0' + struct.pack('<i', len(value)) + value
+
+    channels = b''.join(name + b'\0' + struct.pack('<iB3xii', 1, 0, 1, 1) for name in [b'B', b'G', b'R']) + b'\0'
+    window = struct.pack('<iiii', 0, 0, width - 1, height - 1)
+    header = b''.join([
+        struct.pack('<ii', 20000630, 2),
+        attribute('channels', 'chlist', channels),
+        attribute('compression', 'compression', bytes([3])), # ZIP_COMPRESSION (blocks of 16 scanlines)
+        attribute('dataWindow', 'box2i', window),
+        attribute('displayWindow', 'box2i', window),
+        attribute('lineOrder', 'lineOrder', bytes([0])),
+        attribute('pixelAspectRatio', 'float', struct.pack('<f', 1.0)),
+        attribute('screenWindowCenter', 'v2f', struct.pack('<ff', 0.0, 0.0)),
+        attribute('screenWindowWidth', 'float', struct.pack('<f', 1.0)),
+        b'\0'
+    ])
+
+    lines_per_block = 16
+    chunks = []
+    for y in range(0, height, lines_per_block):
+        # Scanlines store all values of a channel consecutively.
+        raw = np.ascontiguousarray(half[y:y + lines_per_block].transpose(0, 2, 1)).view(np.uint8).reshape(-1)
+        # Separate low and high bytes and store differences of consecutive bytes (see OpenEXR ImfZip.cpp).
+        reordered = np.concatenate([raw[0::2], raw[1::2]])
+        predicted = reordered.copy()
+        predicted[1:] = (reordered[1:].astype(np.int16) - reordered[:-1].astype(np.int16) + 128).astype(np.uint8)
+        compressed = zlib.compress(predicted.tobytes(), 6)
+        payload = compressed if len(compressed) < raw.size else raw.tobytes()
+        chunks.append(struct.pack('<ii', y, len(payload)) + payload)
+
+    offset = len(header) + 8 * len(chunks)
+    offsets = []
+    for chunk in chunks:
+        offsets.append(offset)
+        offset += len(chunk)
+    return header + struct.pack(f'<{len(offsets)}Q', *offsets) + b''.join(chunks)
+
+
+def write_png(path, data):
+    '''
+    Write an 8-bit RGB or RGBA array of shape (height, width, channels) to a PNG file.
+    '''
+    with open(path, 'wb') as f:
+        f.write(encode_png(data))
+
+
+def pixel_digest(image):
+    '''
+    Compute a digest of the decoded pixel data (including the resolution) of an image.
+    '''
+    h = hashlib.blake2b(digest_size=16)
+    h.update(struct.pack('<III', *image.shape))
+    h.update(np.ascontiguousarray(image).data)
+    return h.hexdigest()
+
+
+def tile_sums(values, tile_size, ufunc=None):
+    '''
+    Sum a 2D array over square tiles (tiles at the right and bottom edge may be smaller).
+    Another reduction (e.g. np.maximum) can be used by passing a ufunc.
+    Returns a tuple containing the tile sums and the number of pixels per tile.
+    '''
+    ufunc = ufunc or np.add
+    height, width = values.shape
+    rows = np.arange(0, height, tile_size)
+    cols = np.arange(0, width, tile_size)
+    sums = ufunc.reduceat(ufunc.reduceat(values, rows, axis=0), cols, axis=1)
+    counts = np.outer(np.diff(np.append(rows, height)), np.diff(np.append(cols, width)))
+    return sums, counts
+
+
+def worst_tiles(tile_values, shape, tile_size, count, fields):
+    '''
+    Return the count tiles with the largest (non-zero) values as a list of dictionaries containing the tile
+    coordinates (x, y, width, height) in pixels and the per-tile values of all arrays in fields (a dictionary
+    mapping names to arrays of the same shape as tile_values).
+    '''
+    height, width = shape[0:2]
+    order = np.argsort(-tile_values, axis=None, kind='stable')[0:count]
+    tiles = []
+    for row, col in zip(*np.unravel_index(order, tile_values.shape)):
+        if not tile_values[row, col] > 0:
+            break
+        x, y = int(col * tile_size), int(row * tile_size)
+        tile = { 'x': x, 'y': y, 'width': min(tile_size, width - x), 'height': min(tile_size, height - y) }
+        for name, values in fields.items():
+            tile[name] = float(values[row, col])
+        tiles.append(tile)
+    return tiles
+
+
+def compare_tiled(metric, tolerance, image_a, image_b, tile_size=config.COMPARE_TILE_SIZE, early_exit=False, alpha=False):
+    '''
+    Compare two RGBA float32 images in bands of tile rows.
+    The total error is identical to compute_error() of the full error map. If early_exit is True, the
+    comparison stops as soon as the tolerance is exceeded by the partial error, in which case the error
+    is a lower bound and the error map and tile errors only cover the bands compared so far.
+    Returns a tuple containing the success flag, the error, the per-pixel error map, the per-tile mean
+    and maximum errors and a flag indicating if the comparison stopped early.
+    '''
+    height, width = image_a.shape[0:2]
+    count = height * width
+    threshold = float(np.float32(tolerance))
+
+    total = np.float64(0.0)
+    error_maps = []
+    tile_means = []
+    tile_maxs = []
+    stopped = False
+    for y in range(0, height, tile_size):
+        band = compute_error_map(metric, image_a[y:y + tile_size], image_b[y:y + tile_size], alpha)
+        # Continue the sequential sum of the previous bands to get identical rounding.
+        total = np.add.accumulate(np.concatenate(([total], band.ravel())))[-1]
+        error_maps.append(band)
+        sums, counts = tile_sums(band, tile_size)
+        maxs, _ = tile_sums(band, tile_size, np.maximum)
+        tile_means.append(sums / counts)
+        tile_maxs.append(maxs)
+        # Errors are non-negative, so the partial error is a lower bound of the total error (nans always fail).
+        if early_exit and y + tile_size < height and not total / count <= threshold:
+            stopped = True
+            break
+
+    # ImageCompare parses the threshold as a 32-bit float and treats nans and infs as errors.
+    error = float(total / count) if count > 0 else float('nan')
+    success = np.isfinite(error) and error <= threshold and not stopped
+    error_map = np.concatenate(error_maps) if len(error_maps) > 0 else np.zeros((0, width))
+    tile_means = np.concatenate(tile_means) if len(tile_means) > 0 else np.zeros((0, 0))
+    tile_maxs = np.concatenate(tile_maxs) if len(tile_maxs) > 0 else np.zeros((0, 0))
+    return success, error, error_map, tile_means, tile_maxs, stopped
+
+
+def benjamini_hochberg(p_values, fdr):
+    '''
+    Return a mask of rejected null hypotheses, controlling the false discovery rate at level fdr.
+    '''
+    p = p_values.ravel()
+    order = np.argsort(p, kind='stable')
+    thresholds = fdr * np.arange(1, p.size + 1) / p.size
+    below = np.nonzero(p[order] <= thresholds)[0]
+    rejected = np.zeros(p.size, dtype=bool)
+    if below.size > 0:
+        rejected[order[0:below[-1] + 1]] = True
+    return rejected.reshape(p_values.shape)
+
+
+def second_capture_variance(image, second_image):
+    '''
+    Estimate the per-pixel variance of an image from a second, independent capture.
+    '''
+    diff = image.astype(np.float64) - second_image
+    return diff * diff / 2.0
+
+
+def statistical_test(image_a, image_b, variance_a, variance_b, tile_size, fdr):
+    '''
+    Test if two noisy RGBA float32 images have the same expected value.
+    The mean difference of the RGB channels is tested per tile using a two-sided z-test, with the variance
+    given per pixel and channel for both images. Tiles differing significantly are determined with false
+    discovery rate control. Returns a tuple containing the success flag, the z-scores, p-values and
+    rejection mask of the tiles.
+    '''
+    diff = (image_b[:, :, 0:3].astype(np.float64) - image_a[:, :, 0:3]).mean(axis=2)
+    # Channels are not independent, the variance of their mean is bounded assuming perfect correlation.
+    sigma = np.sqrt(np.maximum(variance_a[:, :, 0:3].astype(np.float64) + variance_b[:, :, 0:3], 0.0)).mean(axis=2)
+    diff_sums, counts = tile_sums(diff, tile_size)
+    variance_sums, _ = tile_sums(sigma * sigma, tile_size)
+
+    # Tiles without noise only pass if they are identical. Non-finite pixels always fail.
+    mean = diff_sums / counts
+    std = np.sqrt(variance_sums) / counts
+    with np.errstate(divide='ignore', invalid='ignore'):
+        z = np.where(std > 0, np.abs(mean) / std, np.where(mean == 0, 0.0, np.inf))
+    z = np.where(np.isnan(z), np.inf, z)
+    p = np.vectorize(math.erfc, otypes=[np.float64])(z / math.sqrt(2.0))
+
+    rejected = benjamini_hochberg(p, fdr)
+    return not rejected.any(), z, p, rejected
+
+
+def companion_file(image_file, suffix):
+    '''
+    Return the path of an image accompanying image_file (e.g. its variance image), named <stem><suffix><extension>.
+    '''
+    image_file = Path(image_file)
+    return image_file.with_name(image_file.stem + suffix + image_file.suffix)
+
+
+def load_variance(image_file, image, mode, load=load_image):
+    '''
+    Load the per-pixel variance estimate of an image, either from a variance image ('image' mode)
+    or estimated from a second capture ('capture' mode). Returns None if not available.
+    Images are loaded using the given load function.
+    '''
+    if mode == 'image':
+        variance_file = companion_file(image_file, config.VARIANCE_IMAGE_SUFFIX)
+        return load(variance_file) if variance_file.exists() else None
+    elif mode == 'capture':
+        second_file = companion_file(image_file, config.SECOND_CAPTURE_SUFFIX)
+        if not second_file.exists():
+            return None
+        second_image = load(second_file)
+        if second_image.shape != image.shape:
+            raise UnsupportedImageError(f'Second capture "{second_file}" has a different resolution')
+        return second_capture_variance(image, second_image)
+    else:
+        raise ValueError(f'Unknown variance estimate "{mode}"')
+
+
+class DecodedImageCache:
+    '''
+    Cache of decoded images stored as float32 .npy files in cache_dir.
+    Entries are keyed by the digest of the image file contents, so regenerated or pulled images are
+    decoded again automatically (file digests are cached by path, modification time and size).
+    Cached images are memory-mapped read-only. The least recently used entries are removed when the
+    cache exceeds max_bytes (see prune()).
+    '''
+
+    def __init__(self, cache_dir, max_bytes=config.DECODED_CACHE_MAX_BYTES):
+        self.cache_dir = Path(cache_dir)
+        self.max_bytes = max_bytes
+        self.file_digests = FileCache(self.cache_dir / 'file_digests.json')
+        self.hits = 0
+        self.misses = 0
+
+    def entry_file(self, digest):
+        return self.cache_dir / digest[0:2] / f'{digest}.npy'
+
+    def load(self, path):
+        '''
+        Load an image (see load_image()) from the cache, decoding and caching it if not cached.
+        '''
+        entry_file = self.entry_file(file_digest(path, self.file_digests))
+        try:
+            image = np.load(entry_file, mmap_mode='r')
+            # Mark the entry as recently used.
+            os.utime(entry_file)
+            self.hits += 1
+            return image
+        except (OSError, ValueError):
+            pass
+
+        image = load_image(path)
+        self.misses += 1
+        try:
+            # Write to a temporary file first so that concurrent readers never see partial entries.
+            entry_file.parent.mkdir(parents=True, exist_ok=True)
+            fd, tmp_file = tempfile.mkstemp(dir=entry_file.parent, suffix='.tmp')
+            with os.fdopen(fd, 'wb') as f:
+                np.save(f, image)
+            os.replace(tmp_file, entry_file)
+        except OSError:
+            pass
+        return image
+
+    def prune(self):
+        '''
+        Remove the least recently used entries until the cache fits into max_bytes.
+        '''
+        entries = []
+        for entry_file in self.cache_dir.glob('*/*.npy'):
+            try:
+                st = entry_file.stat()
+                entries.append((st.st_mtime, st.st_size, entry_file))
+            except OSError:
+                pass
+        total_size = sum(size for _, size, _ in entries)
+        for _, size, entry_file in sorted(entries):
+            if total_size <= self.max_bytes:
+                break
+            entry_file.unlink(missing_ok=True)
+            total_size -= size
+
+    def save(self):
+        self.file_digests.save()
+        self.prune()
+
+
+class ImageComparator:
+    '''
+    Compares pairs of images on a thread pool.
+    '''
+
+    def __init__(self, image_compare_exe, backend='auto', thread_count=None, digest_cache=None, use_hash=True, early_exit=False, decoded_cache=None):
+        '''
+        If early_exit is True, comparisons without an error image stop as soon as the image is known to fail.
+        If decoded_cache is given (see DecodedImageCache), decoded reference images are cached.
+        '''
+        if not backend in BACKENDS:
+            raise ValueError(f'Unknown image comparison backend "{backend}"')
+        if backend == 'numpy' and not is_numpy_available():
+            raise RuntimeError('NumPy is not available for in-process image comparison')
+        if backend == 'auto':
+            backend = 'numpy' if is_numpy_available() else 'exe'
+
+        self.image_compare_exe = image_compare_exe
+        self.backend = backend
+        self.thread_count = thread_count or multiprocessing.cpu_count()
+        self.executor = concurrent.futures.ThreadPoolExecutor(self.thread_count, thread_name_prefix='compare')
+        self.digest_cache = digest_cache or FileCache()
+        self.use_hash = use_hash
+        self.early_exit = early_exit
+        self.decoded_cache = decoded_cache
+        self.identical_heat_maps = {}
+        self.identical_heat_maps_mutex = threading.Lock()
+
+    def shutdown(self):
+        self.executor.shutdown(wait=True)
+        self.digest_cache.save()
+        if self.decoded_cache:
+            self.decoded_cache.save()
+
+    def load_reference(self, ref_file):
+        '''
+        Load a reference image, using the decoded image cache if available.
+        '''
+        if self.decoded_cache:
+            return self.decoded_cache.load(ref_file)
+        return load_image(ref_file)
+
+    def write_identical_heat_map(self, error_file, shape):
+        '''
+        Write the heat map for two identical images (uniformly blue).
+        Encoded heat maps are cached per resolution.
+        '''
+        key = shape[0:2]
+        with self.identical_heat_maps_mutex:
+            data = self.identical_heat_maps.get(key)
+        if data == None:
+            data = encode_png(generate_heat_map(np.zeros(key, dtype=np.float64)))
+            with self.identical_heat_maps_mutex:
+                self.identical_heat_maps[key] = data
+        with open(error_file, 'wb') as f:
+            f.write(data)
+
+    def compare_exe(self, ref_file, result_file, tolerance, error_file, metric, add_process):
+        '''
+        Compare two images by running ImageCompare.
+        '''
+        args = [str(self.image_compare_exe), '-m', metric, '-t', str(tolerance), str(ref_file), str(result_file)]
+        if error_file:
+            args += ['-e', str(error_file)]
+        p = subprocess.Popen(args, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        if add_process and not add_process(p):
+            return { 'success': False, 'error': None, 'backend': 'exe', 'method': 'metric', 'message': 'Process killed due to global exit' }
+        outs, errs = p.communicate()
+        try:
+            error = float(outs.strip())
+        except ValueError:
+            return { 'success': False, 'error': None, 'backend': 'exe', 'method': 'metric', 'message': errs.decode('utf-8', errors='replace').strip() }
+        return { 'success': p.returncode == 0, 'error': error, 'backend': 'exe', 'method': 'metric', 'message': None }
+
+    def reference_digest(self, ref_file):
+        '''
+        Return the pixel digest of a reference image, a flag indicating if all its pixels are finite
+        and the decoded image (None if the digest was cached).
+        '''
+        entry = self.digest_cache.get(ref_file)
+        if isinstance(entry, list) and len(entry) == 2:
+            return entry[0], entry[1], None
+        image = self.load_reference(ref_file)
+        digest = pixel_digest(image)
+        finite = bool(np.isfinite(image).all())
+        self.digest_cache.put(ref_file, [digest, finite])
+        return digest, finite, image
+
+    def compare_numpy(self, ref_file, result_file, tolerance, error_file, metric):
+        '''
+        Compare two images in-process.
+        '''
+        image_a = None
+        image_b = load_image(result_file)
+
+        # Fast path: identical pixels have zero error for every metric, unless they contain nans or infs
+        # (which ImageCompare reports as errors, as nan - nan is nan).
+        if self.use_hash:
+            ref_digest, ref_finite, image_a = self.reference_digest(ref_file)
+            if ref_finite and ref_digest == pixel_digest(image_b):
+                if error_file:
+                    self.write_identical_heat_map(error_file, image_b.shape)
+                return { 'success': True, 'error': 0.0, 'backend': 'numpy', 'method': 'hash', 'message': None }
+
+        if image_a is None:
+            image_a = self.load_reference(ref_file)
+        if image_a.shape != image_b.shape:
+            return { 'success': False, 'error': None, 'backend': 'numpy', 'method': 'metric', 'message': 'Cannot compare images with different resolutions.' }
+        tile_size = config.COMPARE_TILE_SIZE
+        success, error, error_map, tile_means, tile_maxs, stopped = compare_tiled(metric, tolerance, image_a, image_b, tile_size, self.early_exit and not error_file)
+        if error_file:
+            write_png(error_file, generate_heat_map(error_map))
+        return {
+            'success': bool(success),
+            'error': error,
+            'backend': 'numpy',
+            'method': 'metric',
+            'message': None,
+            'early_exit': stopped,
+            'worst_tiles': worst_tiles(tile_means, image_a.shape, tile_size, config.COMPARE_WORST_TILES, { 'mean_error': tile_means, 'max_error': tile_maxs })
+        }
+
+    def compare_statistical(self, ref_file, result_file, error_file, options):
+        '''
+        Compare two noisy images in-process using a statistical test (see statistical_test()).
+        The variance of the reference is assumed to be equal to the variance of the result if not available.
+        The error is the largest z-score of all tiles.
+        '''
+        image_a = None
+        image_b = load_image(result_file)
+        if self.use_hash:
+            ref_digest, ref_finite, image_a = self.reference_digest(ref_file)
+            if ref_finite and ref_digest == pixel_digest(image_b):
+                if error_file:
+                    self.write_identical_heat_map(error_file, image_b.shape)
+                return { 'success': True, 'error': 0.0, 'backend': 'numpy', 'method': 'hash', 'message': None }
+
+        if image_a is None:
+            image_a = self.load_reference(ref_file)
+        if image_a.shape != image_b.shape:
+            return { 'success': False, 'error': None, 'backend': 'numpy', 'method': 'statistical', 'message': 'Cannot compare images with different resolutions.' }
+
+        variance_b = load_variance(result_file, image_b, options['variance'])
+        if variance_b is None:
+            return { 'success': False, 'error': None, 'backend': 'numpy', 'method': 'statistical', 'message': f'Variance estimate ({options["variance"]}) of the result image is missing.' }
+        variance_a = load_variance(ref_file, image_a, options['variance'], self.load_reference)
+        if variance_a is None:
+            variance_a = variance_b
+
+        success, z, p, rejected = statistical_test(image_a, image_b, variance_a, variance_b, options['tile_size'], options['fdr'])
+        if error_file:
+            write_png(error_file, generate_heat_map(compute_error_map('mse', image_a, image_b)))
+        tile_size = options['tile_size']
+        return {
+            'success': bool(success),
+            'error': float(z.max()),
+            'backend': 'numpy',
+            'method': 'statistical',
+            'message': None,
+            'tiles': int(z.size),
+            'rejected_tiles': int(rejected.sum()),
+            'min_p_value': float(p.min()),
+            'worst_tiles': worst_tiles(z, image_a.shape, tile_size, config.COMPARE_WORST_TILES, { 'z_score': z, 'p_value': p })
+        }
+
+    def compare(self, ref_file, result_file, tolerance, error_file=None, metric='mse', add_process=None, statistical=None):
+        '''
+        Compare a result image against a reference image.
+        If statistical contains the options of the statistical comparison, the images are compared
+        using a statistical test instead of an error threshold (only supported by the numpy backend).
+        Returns a dictionary containing the success flag, the error, the backend and method
+        (hash, metric or statistical) used, the time spent comparing and an optional message.
+        '''
+        start_time = time.time()
+        result = None
+        if statistical != None:
+            try:
+                if self.backend != 'numpy':
+                    raise UnsupportedImageError('statistical comparison requires the numpy backend')
+                result = self.compare_statistical(ref_file, result_file, error_file, statistical)
+            except (UnsupportedImageError, OSError, ValueError) as e:
+                result = { 'success': False, 'error': None, 'backend': self.backend, 'method': 'statistical', 'message': f'Cannot compare images statistically ({e}).' }
+        elif self.backend == 'numpy':
+            try:
+                result = self.compare_numpy(ref_file, result_file, tolerance, error_file, metric)
+            except UnsupportedImageError:
+                pass
+            except (OSError, ValueError) as e:
+                # Decoders raise ValueError for some malformed files.
+                result = { 'success': False, 'error': None, 'backend': 'numpy', 'method': 'metric', 'message': f'Cannot load image ({e}).' }
+        if result == None:
+            result = self.compare_exe(ref_file, result_file, tolerance, error_file, metric, add_process)
+        result['time'] = time.time() - start_time
+        return result
+
+    def compare_batch(self, jobs, metric='mse', add_process=None):
+        '''
+        Compare a batch of images in parallel.
+        Each job is a tuple (ref_file, result_file, tolerance, error_file, statistical), where statistical
+        contains the options of the statistical comparison or is None.
+        Returns a list of results in the same order as the jobs.
+        '''
+        futures = [self.executor.submit(self.compare, ref_file, result_file, tolerance, error_file, metric, add_process, statistical) for ref_file, result_file, tolerance, error_file, statistical in jobs]
+        return [future.result() for future in futures]
@@ -0,0 +1,168 @@
+'''
+Module for incremental image test runs.
+
+Every test is fingerprinted by hashing all inputs that affect its results:
+the test script, imported local modules (e.g. graphs/*.py), executed scripts
+(e.g. scripts/*.py), loaded scene files, asset files referenced by the scripts,
+the Falcor binaries (including plugins and shaders), the reference images,
+the device type and the tolerance. If the fingerprint matches the one recorded
+for the last passing run of the test, the results of that run are reused.
+Tests with dynamic loads that cannot be resolved statically are always run.
+'''
+
+import json
+import shutil
+import hashlib
+import threading
+from pathlib import Path
+
+from . import config, dependencies, helpers
+
+
+def hash_json(data):
+    '''
+    Compute a digest of a JSON serializable object.
+    '''
+    return hashlib.blake2b(json.dumps(data, sort_keys=True).encode('utf-8'), digest_size=16).hexdigest()
+
+
+class Fingerprinter:
+    '''
+    Computes fingerprints of image tests.
+    '''
+
+    def __init__(self, env, digest_cache):
+        self.env = env
+        self.digest_cache = digest_cache
+        self.binaries_digest = None
+        self.binaries_mutex = threading.Lock()
+
+    def relative_path(self, path):
+        '''
+        Return a path relative to the project directory (if possible) for stable fingerprints.
+        '''
+        try:
+            return Path(path).relative_to(self.env.project_dir).as_posix()
+        except ValueError:
+            return Path(path).as_posix()
+
+    def file_digests(self, files):
+        '''
+        Return a dictionary mapping (project relative) file paths to digests.
+        '''
+        return { self.relative_path(f): helpers.file_digest(f, self.digest_cache) for f in files }
+
+    def directory_digests(self, directory):
+        '''
+        Return a dictionary mapping (project relative) file paths of all files in a directory tree to digests.
+        '''
+        if not directory.is_dir():
+            return {}
+        return self.file_digests(sorted(f for f in directory.rglob('*') if f.is_file()))
+
+    def get_binaries_digest(self):
+        '''
+        Return the digest of the Falcor binaries (computed once).
+        '''
+        with self.binaries_mutex:
+            if self.binaries_digest == None:
+                files = [f for f in [self.env.mogwai_exe, self.env.build_dir / config.FALCOR_LIB] if f.exists()]
+                digests = self.file_digests(files)
+                for d in config.INCREMENTAL_BUILD_DIRS:
+                    digests.update(self.directory_digests(self.env.build_dir / d))
+                self.binaries_digest = hash_json(digests)
+            return self.binaries_digest
+
+    def fingerprint(self, test, ref_dir):
+        '''
+        Compute the fingerprint of a test.
+        Returns None if the test has dynamic loads (its inputs are not known), so its results are never reused.
+        '''
+        deps = dependencies.collect_dependencies(test.script_file)
+        if len(deps['dynamic']) > 0:
+            return None
+
+        scenes = {}
+        for scene, cwd in deps['scenes']:
+            scene_file = dependencies.resolve_scene(scene, cwd, self.env.project_dir)
+            scenes[scene] = self.file_digests(dependencies.scene_files(scene_file)) if scene_file else None
+
+        test_ref_dir = ref_dir / test.test_dir
+        refs = self.file_digests(sorted(test_ref_dir / f for f in test.collect_images(test_ref_dir))) if test_ref_dir.exists() else {}
+
+        return hash_json({
+            'script': self.file_digests([test.script_file]),
+            'modules': self.file_digests(deps['modules']),
+            'scripts': self.file_digests(deps['scripts']),
+            'assets': self.file_digests(dependencies.resolve_assets(deps, self.env.project_dir)),
+            'scenes': scenes,
+            'binaries': self.get_binaries_digest(),
+            'refs': refs,
+            'device_type': test.device_type,
+            'tolerance': test.tolerance
+        })
+
+
+class IncrementalIndex:
+    '''
+    Index of fingerprints and result directories of the last passing run of each test.
+    '''
+
+    def __init__(self, index_file):
+        self.index_file = index_file
+        self.mutex = threading.Lock()
+        self.entries = {}
+
+        if Path(index_file).exists():
+            try:
+                with open(index_file) as f:
+                    self.entries = json.load(f)
+            except (OSError, ValueError):
+                self.entries = {}
+
+    def lookup(self, test, fingerprint):
+        '''
+        Return the report of the last passing run of a test if it has a matching fingerprint, or None otherwise.
+        '''
+        if fingerprint == None:
+            return None
+        with self.mutex:
+            entry = self.entries.get(test.name, None)
+        if not entry or entry['fingerprint'] != fingerprint:
+            return None
+        report_file = Path(entry['result_dir']) / 'report.json'
+        try:
+            with open(report_file) as f:
+                report = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if report.get('result', None) != 'PASSED' or report.get('fingerprint', None) != fingerprint:
+            return None
+        return report, Path(entry['result_dir'])
+
+    def record(self, test, fingerprint, result_dir):
+        '''
+        Record the fingerprint and result directory of a passing test run (tests without fingerprint are not recorded).
+        '''
+        if fingerprint == None:
+            return
+        with self.mutex:
+            self.entries[test.name] = { 'fingerprint': fingerprint, 'result_dir': str(result_dir) }
+
+    def save(self):
+        '''
+        Write the index to disk.
+        '''
+        with self.mutex:
+            helpers.write_json_file(self.index_file, self.entries, indent=4)
+
+
+def reuse_results(src_dir, dst_dir):
+    '''
+    Copy the results of a previous run of a test to a new result directory (if different).
+    '''
+    if Path(src_dir).resolve() == Path(dst_dir).resolve():
+        return
+    if dst_dir.exists():
+        shutil.rmtree(dst_dir)
+    shutil.copytree(src_dir, dst_dir)
@@ -0,0 +1,197 @@
+'''
+Module for computing per-pixel metric maps of result and reference images (used by view_image_tests).
+
+The compare view shows maps of the L1, L2, MAPE, MRSE, SMAPE and SSIM metrics.
+Instead of computing them in the browser, the maps are computed with NumPy
+using the same definitions as the Jeri viewer (image A is the reference, image B
+the result) and stored as half float EXR images in a cache directory, keyed by
+the digests of both image files. All maps of an image pair are computed at once,
+either on request or ahead of time for the failed images of a run (see
+precompute_run()).
+'''
+
+import os
+import json
+import tempfile
+import threading
+from pathlib import Path
+
+from . import config
+from .helpers import FileCache, file_digest
+from .image_compare import np, load_image, encode_exr, UnsupportedImageError
+
+# Version of the metric computation, changing it invalidates cached maps.
+METRIC_MAPS_VERSION = 1
+
+# Metrics for which maps are computed (names as used by Jeri).
+METRICS = ['L1', 'L2', 'MAPE', 'MRSE', 'SMAPE', 'SSIM']
+
+# Radius of the square window used for computing SSIM (same as Jeri).
+SSIM_WINDOW_RADIUS = 2
+
+
+def is_available():
+    '''
+    Check if metric maps can be computed.
+    '''
+    return np != None
+
+
+def window_sums(values, radius):
+    '''
+    Sum values of shape (height, width) over square windows, clamping lookups to the image border.
+    '''
+    size = 2 * radius + 1
+    padded = np.pad(values.astype(np.float64), radius, mode='edge')
+    integral = np.zeros((padded.shape[0] + 1, padded.shape[1] + 1), dtype=np.float64)
+    integral[1:, 1:] = padded.cumsum(axis=0).cumsum(axis=1)
+    return integral[size:, size:] - integral[:-size, size:] - integral[size:, :-size] + integral[:-size, :-size]
+
+
+def ssim_map(a, b):
+    '''
+    Compute 1 - SSIM of the luminance of two RGB images over (2 * SSIM_WINDOW_RADIUS + 1)^2 windows.
+    '''
+    luminance = np.array([0.2126, 0.7152, 0.0722], dtype=np.float32)
+    la = a @ luminance
+    lb = b @ luminance
+    radius = SSIM_WINDOW_RADIUS
+    n = float((2 * radius + 1) ** 2)
+    c1 = 0.01 ** 2
+    c2 = 0.03 ** 2
+    a_mean = window_sums(la, radius) / n
+    b_mean = window_sums(lb, radius) / n
+    # Jeri normalizes (co)variances by n + 1.
+    a_var = (window_sums(la * la, radius) - n * a_mean * a_mean) / (n + 1)
+    b_var = (window_sums(lb * lb, radius) - n * b_mean * b_mean) / (n + 1)
+    ab_covar = (window_sums(la * lb, radius) - n * a_mean * b_mean) / (n + 1)
+    ssim = ((2 * a_mean * b_mean + c1) * (2 * ab_covar + c2)) / ((a_mean * a_mean + b_mean * b_mean + c1) * (a_var + b_var + c2))
+    return np.repeat((1 - ssim).astype(np.float32)[:, :, np.newaxis], 3, axis=2)
+
+
+def compute_metric_maps(ref_image, result_image):
+    '''
+    Compute the maps of all metrics for a pair of RGBA images of the same shape.
+    Returns a dictionary mapping metric names to float32 RGB arrays.
+    '''
+    a = ref_image[:, :, 0:3]
+    b = result_image[:, :, 0:3]
+    diff = a - b
+    return {
+        'L1': np.abs(diff),
+        'L2': diff * diff,
+        'MAPE': np.abs(diff) / (np.abs(b) + np.float32(1e-2)),
+        'MRSE': diff * diff / (b * b + np.float32(1e-4)),
+        'SMAPE': np.float32(2) * np.abs(diff) / (np.abs(a) + np.abs(b) + np.float32(2e-2)),
+        'SSIM': ssim_map(a, b)
+    }
+
+
+class MetricMapCache:
+    '''
+    Cache of metric maps stored as EXR images in cache_dir.
+    The least recently used maps are removed when the cache exceeds max_bytes (see prune()).
+    '''
+
+    def __init__(self, cache_dir, max_bytes=config.METRIC_CACHE_MAX_BYTES):
+        self.cache_dir = Path(cache_dir)
+        self.max_bytes = max_bytes
+        self.file_digests = FileCache(self.cache_dir / 'file_digests.json')
+        self.mutex = threading.Lock()
+        self.pair_locks = {}
+
+    def pair_key(self, ref_file, result_file):
+        return f'{file_digest(ref_file, self.file_digests)}-{file_digest(result_file, self.file_digests)}'
+
+    def entry_file(self, pair_key, metric):
+        return self.cache_dir / pair_key[0:2] / f'{pair_key}-{metric}-v{METRIC_MAPS_VERSION}.exr'
+
+    def pair_lock(self, pair_key):
+        # Concurrent requests for maps of the same pair wait for a single computation.
+        with self.mutex:
+            return self.pair_locks.setdefault(pair_key, threading.Lock())
+
+    def get(self, ref_file, result_file, metric):
+        '''
+        Return a tuple containing the map file of a metric (computing the maps of all metrics if not cached) and its key.
+        Raises UnsupportedImageError if the images cannot be decoded or have different sizes.
+        '''
+        pair_key = self.pair_key(ref_file, result_file)
+        entry_file = self.entry_file(pair_key, metric)
+        with self.pair_lock(pair_key):
+            if entry_file.exists():
+                # Mark the entry as recently used.
+                os.utime(entry_file)
+            else:
+                self.compute(ref_file, result_file, pair_key)
+        return entry_file, entry_file.name
+
+    def compute(self, ref_file, result_file, pair_key):
+        ref_image = load_image(ref_file)
+        result_image = load_image(result_file)
+        if ref_image.shape != result_image.shape:
+            raise UnsupportedImageError(f'Image sizes do not match ({ref_image.shape[1]}x{ref_image.shape[0]} and {result_image.shape[1]}x{result_image.shape[0]})')
+        for metric, data in compute_metric_maps(ref_image, result_image).items():
+            entry_file = self.entry_file(pair_key, metric)
+            # Write to a temporary file first so that concurrent readers never see partial entries.
+            entry_file.parent.mkdir(parents=True, exist_ok=True)
+            fd, tmp_file = tempfile.mkstemp(dir=entry_file.parent, suffix='.tmp')
+            with os.fdopen(fd, 'wb') as f:
+                f.write(encode_exr(data))
+            os.replace(tmp_file, entry_file)
+
+    def prune(self):
+        '''
+        Remove the least recently used maps until the cache fits into max_bytes.
+        '''
+        entries = []
+        for entry_file in self.cache_dir.glob('*/*.exr'):
+            try:
+                st = entry_file.stat()
+                entries.append((st.st_mtime, st.st_size, entry_file))
+            except OSError:
+                pass
+        total_size = sum(size for _, size, _ in entries)
+        for _, size, entry_file in sorted(entries):
+            if total_size <= self.max_bytes:
+                break
+            entry_file.unlink(missing_ok=True)
+            total_size -= size
+        with self.mutex:
+            self.pair_locks = { k: v for k, v in self.pair_locks.items() if v.locked() }
+
+    def save(self):
+        self.file_digests.save()
+        self.prune()
+
+
+def precompute_run(cache, run_dir, failed_only=True):
+    '''
+    Compute the metric maps of the images of all tests in a run directory (only failed images by default).
+    Returns a tuple containing the number of image pairs processed and a list of error messages.
+    '''
+    run_dir = Path(run_dir)
+    count = 0
+    errors = []
+    for report_file in sorted(run_dir.glob('*/**/report.json')):
+        try:
+            with open(report_file) as f:
+                test = json.load(f)
+        except (OSError, ValueError):
+            continue
+        if not isinstance(test, dict) or not 'ref_dir' in test:
+            continue
+        for image in test.get('images', []):
+            if failed_only and image.get('success', False):
+                continue
+            ref_file = Path(test['ref_dir']) / image['name']
+            result_file = report_file.parent / image['name']
+            if not ref_file.exists() or not result_file.exists():
+                continue
+            try:
+                cache.get(ref_file, result_file, METRICS[0])
+                count += 1
+            except (UnsupportedImageError, OSError, ValueError) as e:
+                errors.append(f'{result_file}: {e}')
+    cache.save()
+    return count, errors
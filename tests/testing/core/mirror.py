@@ -0,0 +1,177 @@
+'''
+Module implementing mirroring of directory trees (e.g. pushing and pulling reference images).
+
+The destination tree is made identical to the source tree by transferring only
+files that differ and deleting extraneous files and directories. Files are
+considered unchanged if their size and modification time match (within
+MIRROR_MTIME_TOLERANCE, as file systems store modification times with
+different resolution). If both trees contain a manifest mapping file paths to
+digests (see refstore), files listed with the same digest are considered
+unchanged regardless of their modification time, and files listed with
+different digests are always transferred.
+
+Both scanning and copying are done on a thread pool, as the cost is dominated
+by the latency of file system operations on network mounts. Files are copied
+to a temporary file next to the destination and renamed, so that the
+destination never contains partially written files (and links to shared files
+are replaced instead of written through). The manifest is transferred last.
+Hidden files (starting with '.') are ignored, except for temporary files left
+behind by interrupted runs, which are deleted.
+'''
+
+import os
+import json
+import shutil
+import tempfile
+import concurrent.futures
+from pathlib import Path
+
+from . import config
+
+# Suffix of temporary files written while copying.
+TMP_SUFFIX = '.mirror-tmp'
+
+
+def scan_dir(dir):
+    '''
+    Scan a single directory.
+    Returns a tuple containing a dictionary mapping file names to (size, mtime_ns) and a list of subdirectory names.
+    '''
+    files = {}
+    dirs = []
+    with os.scandir(dir) as it:
+        for entry in it:
+            if entry.name.startswith('.') and not entry.name.endswith(TMP_SUFFIX):
+                continue
+            if entry.is_dir(follow_symlinks=False):
+                dirs.append(entry.name)
+            else:
+                st = entry.stat()
+                files[entry.name] = (st.st_size, st.st_mtime_ns)
+    return files, dirs
+
+
+def scan_tree(root, executor):
+    '''
+    Scan a directory tree, scanning directories in parallel.
+    Returns a tuple containing a dictionary mapping relative file paths (posix) to (size, mtime_ns)
+    and a set of relative directory paths. Returns empty results if root does not exist.
+    '''
+    root = Path(root)
+    files = {}
+    dirs = set()
+    if not root.is_dir():
+        return files, dirs
+    pending = { executor.submit(scan_dir, root): '' }
+    while pending:
+        done, _ = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+        for future in done:
+            rel_dir = pending.pop(future)
+            dir_files, dir_dirs = future.result()
+            for name, info in dir_files.items():
+                files[f'{rel_dir}{name}'] = info
+            for name in dir_dirs:
+                rel_subdir = f'{rel_dir}{name}'
+                dirs.add(rel_subdir)
+                pending[executor.submit(scan_dir, root / rel_subdir)] = rel_subdir + '/'
+    return files, dirs
+
+
+def load_manifest(dir, manifest_file):
+    try:
+        with open(Path(dir) / manifest_file) as f:
+            manifest = json.load(f)
+        return manifest if isinstance(manifest, dict) else {}
+    except (OSError, ValueError):
+        return {}
+
+
+def is_unchanged(rel_path, src_info, dst_info, src_manifest, dst_manifest):
+    if dst_info == None:
+        return False
+    src_digest = src_manifest.get(rel_path, None)
+    dst_digest = dst_manifest.get(rel_path, None)
+    if src_digest and dst_digest:
+        return src_digest == dst_digest and src_info[0] == dst_info[0]
+    return src_info[0] == dst_info[0] and abs(src_info[1] - dst_info[1]) <= config.MIRROR_MTIME_TOLERANCE * 1e9
+
+
+def copy_file(src, dst):
+    '''
+    Copy a file (including its modification time) by writing a temporary file and renaming it.
+    '''
+    dst.parent.mkdir(parents=True, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=dst.parent, prefix='.' + dst.name + '.', suffix=TMP_SUFFIX)
+    os.close(fd)
+    try:
+        shutil.copy2(src, tmp_path)
+        os.replace(tmp_path, dst)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.unlink(tmp_path)
+        raise
+    return dst.stat().st_size
+
+
+def mirror_folders(src_dir, dst_dir, threads=config.MIRROR_THREADS, manifest_file=config.REF_MANIFEST_FILE):
+    '''
+    Mirror contents from src_dir to dst_dir.
+    Returns a tuple containing a success flag and a log of the operation.
+    '''
+    src_dir = Path(src_dir)
+    dst_dir = Path(dst_dir)
+    if not src_dir.is_dir():
+        return False, f'Source directory "{src_dir}" does not exist.'
+
+    errors = []
+    with concurrent.futures.ThreadPoolExecutor(threads) as executor:
+        src_files, src_dirs = scan_tree(src_dir, executor)
+        dst_files, dst_dirs = scan_tree(dst_dir, executor)
+
+        # Temporary files of interrupted runs are never part of the source.
+        src_files = { p: info for p, info in src_files.items() if not p.endswith(TMP_SUFFIX) }
+
+        src_manifest = load_manifest(src_dir, manifest_file) if manifest_file in src_files else {}
+        dst_manifest = load_manifest(dst_dir, manifest_file) if manifest_file in dst_files else {}
+        changed = [p for p, info in src_files.items() if not is_unchanged(p, info, dst_files.get(p, None), src_manifest, dst_manifest)]
+        unchanged_count = len(src_files) - len(changed)
+
+        # Copy changed files, the manifest is copied last to not describe files that have not been copied yet.
+        copy_manifest = manifest_file in changed
+        if copy_manifest:
+            changed.remove(manifest_file)
+        copied_count = 0
+        copied_bytes = 0
+        def copy_all(paths):
+            nonlocal copied_count, copied_bytes
+            futures = { executor.submit(copy_file, src_dir / p, dst_dir / p): p for p in paths }
+            for future in concurrent.futures.as_completed(futures):
+                try:
+                    copied_bytes += future.result()
+                    copied_count += 1
+                except OSError as e:
+                    errors.append(f'Failed to copy "{futures[future]}": {e}')
+        copy_all(changed)
+        if copy_manifest and not errors:
+            copy_all([manifest_file])
+
+        # Delete extraneous files.
+        extraneous = [p for p in dst_files if not p in src_files]
+        futures = { executor.submit(os.unlink, dst_dir / p): p for p in extraneous }
+        for future in concurrent.futures.as_completed(futures):
+            try:
+                future.result()
+            except OSError as e:
+                errors.append(f'Failed to delete "{futures[future]}": {e}')
+
+    # Delete extraneous directories (including hidden files in them).
+    for rel_dir in sorted(dst_dirs - src_dirs):
+        if not (dst_dir / rel_dir).exists():
+            continue
+        try:
+            shutil.rmtree(dst_dir / rel_dir)
+        except OSError as e:
+            errors.append(f'Failed to delete directory "{rel_dir}": {e}')
+
+    summary = f'{copied_count} files copied ({copied_bytes / 2**20:.1f} MB), {unchanged_count} unchanged, {len(extraneous)} extraneous files deleted'
+    return len(errors) == 0, '\n'.join([summary] + errors)
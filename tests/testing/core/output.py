@@ -0,0 +1,136 @@
+'''
+Module for capturing the output of child processes with bounded memory.
+
+The stdout and stderr pipes of a process are read line by line on reader
+threads and written to rotating log files, so that verbose processes (e.g.
+shader compilation logs in debug builds) neither fill up memory nor disk.
+Only the last lines of stderr are kept in memory for reporting errors, and an
+optional tail function receives every line as it arrives (used for live output
+in verbose mode).
+'''
+
+import os
+import time
+import threading
+import collections
+from pathlib import Path
+
+from . import config
+
+# Maximum length (in bytes) of a line read at once. Longer lines are split.
+MAX_LINE_LENGTH = 64 * 1024
+
+
+class RotatingLog:
+    '''
+    Log file that is rotated when it exceeds a maximum size.
+    Rotated files are renamed to <file>.1 ... <file>.<backup_count>, the oldest one is deleted.
+    '''
+
+    def __init__(self, path, max_bytes=config.OUTPUT_LOG_MAX_BYTES, backup_count=config.OUTPUT_LOG_BACKUP_COUNT):
+        self.path = Path(path)
+        self.max_bytes = max_bytes
+        self.backup_count = backup_count
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        # Remove rotated files of a previous run.
+        for index in range(1, backup_count + 1):
+            self.backup_path(index).unlink(missing_ok=True)
+        self.file = open(self.path, 'wb')
+        self.size = 0
+
+    def backup_path(self, index):
+        return self.path.with_name(f'{self.path.name}.{index}')
+
+    def rotate(self):
+        self.file.close()
+        if self.backup_count > 0:
+            self.backup_path(self.backup_count).unlink(missing_ok=True)
+            for index in range(self.backup_count - 1, 0, -1):
+                if self.backup_path(index).exists():
+                    os.replace(self.backup_path(index), self.backup_path(index + 1))
+            os.replace(self.path, self.backup_path(1))
+        self.file = open(self.path, 'wb')
+        self.size = 0
+
+    def write(self, data):
+        if self.size > 0 and self.size + len(data) > self.max_bytes:
+            self.rotate()
+        self.file.write(data)
+        self.size += len(data)
+
+    def close(self):
+        self.file.close()
+
+
+class OutputCapture:
+    '''
+    Captures the stdout and stderr pipes of a process.
+    Output is written to <log_dir>/<prefix>stdout.txt and <log_dir>/<prefix>stderr.txt (rotated),
+    the last error_line_count lines of stderr are kept in error_lines. If tail is given,
+    it is called with the stream name and the decoded line for every line of output.
+    '''
+
+    def __init__(self, log_dir, prefix='', error_line_count=config.OUTPUT_ERROR_LINES, tail=None):
+        self.log_dir = Path(log_dir)
+        self.prefix = prefix
+        self.error_lines = collections.deque(maxlen=error_line_count)
+        self.error_line_total = 0
+        self.tail = tail
+        self.threads = []
+
+    def log_file(self, name):
+        return self.log_dir / f'{self.prefix}{name}.txt'
+
+    def start(self, p):
+        '''
+        Start reading the pipes of the process p.
+        '''
+        for name, stream in [('stdout', p.stdout), ('stderr', p.stderr)]:
+            if stream != None:
+                thread = threading.Thread(target=self.read_stream, args=(name, stream), daemon=True)
+                thread.start()
+                self.threads.append(thread)
+
+    def read_stream(self, name, stream):
+        log = RotatingLog(self.log_file(name))
+        try:
+            for line in iter(lambda: stream.readline(MAX_LINE_LENGTH), b''):
+                log.write(line)
+                if name == 'stderr' or self.tail:
+                    text = line.decode('utf-8', errors='replace').rstrip()
+                    if name == 'stderr':
+                        self.error_lines.append(text)
+                        self.error_line_total += 1
+                    if self.tail:
+                        self.tail(name, text)
+        finally:
+            log.close()
+            stream.close()
+
+    def join(self, timeout=None):
+        '''
+        Wait for the pipes to be closed (i.e. the process and its children exited).
+        Returns False if the pipes are still open after the timeout.
+        '''
+        deadline = time.time() + timeout if timeout != None else None
+        for thread in self.threads:
+            thread.join(max(0, deadline - time.time()) if deadline != None else None)
+        return not any(thread.is_alive() for thread in self.threads)
+
+    def mark(self):
+        '''
+        Return a marker of the current position in stderr (see errors()).
+        '''
+        return self.error_line_total
+
+    def errors(self, since=0):
+        '''
+        Return the captured lines of stderr after the marker since (all lines by default),
+        noting that earlier lines have been dropped if the buffer is full.
+        '''
+        count = self.error_line_total - since
+        lines = list(self.error_lines)
+        errors = lines[len(lines) - min(count, len(lines)):] if count > 0 else []
+        if count > len(errors):
+            errors.insert(0, f'(showing last {len(errors)} of {count} lines of stderr, see {self.log_file("stderr")} for full output)')
+        return errors
@@ -0,0 +1,89 @@
+'''
+Module implementing pipeline stages for image tests.
+
+Running an image test consists of generating images (bound by Mogwai and the
+GPU) and comparing them against references (bound by the CPU). A stage is a
+pool of threads processing items from a queue, which allows comparing the
+images of one test while the images of the next test are being generated.
+Stages keep track of the time their threads are busy and the time items wait
+in the queue, which is used to report whether a run is limited by generation
+or by comparison.
+'''
+
+import time
+import queue
+import threading
+
+
+class Stage:
+    '''
+    Pool of threads processing items from a queue.
+    The result of func(item) is put into the output queue.
+    '''
+
+    def __init__(self, name, thread_count, func, output):
+        self.name = name
+        self.thread_count = thread_count
+        self.func = func
+        self.output = output
+        self.input = queue.Queue()
+
+        self.mutex = threading.Lock()
+        self.busy_time = 0.0
+        self.wait_time = 0.0
+        self.item_count = 0
+        self.errors = []
+
+        self.threads = [threading.Thread(target=self.worker, name=f'{name}_{i}', daemon=True) for i in range(thread_count)]
+        for thread in self.threads:
+            thread.start()
+
+    def put(self, item):
+        '''
+        Queue an item for processing.
+        '''
+        self.input.put((time.time(), item))
+
+    def close(self):
+        '''
+        Wait for all queued items to be processed and stop the threads.
+        Raises the first exception raised by func (if any).
+        '''
+        for _ in self.threads:
+            self.input.put(None)
+        for thread in self.threads:
+            thread.join()
+        if len(self.errors) > 0:
+            raise self.errors[0]
+
+    def worker(self):
+        while True:
+            entry = self.input.get()
+            if entry == None:
+                break
+            queue_time, item = entry
+            start_time = time.time()
+            try:
+                self.output.put(self.func(item))
+            except Exception as e:
+                with self.mutex:
+                    self.errors.append(e)
+            end_time = time.time()
+            with self.mutex:
+                self.busy_time += end_time - start_time
+                self.wait_time += start_time - queue_time
+                self.item_count += 1
+
+    def stats(self, wall_time):
+        '''
+        Return a dictionary containing the utilization of the threads over wall_time seconds
+        and the average time items waited in the queue.
+        '''
+        with self.mutex:
+            return {
+                'threads': self.thread_count,
+                'items': self.item_count,
+                'busy_time': self.busy_time,
+                'utilization': self.busy_time / (self.thread_count * wall_time) if wall_time > 0 else 0.0,
+                'average_wait_time': self.wait_time / self.item_count if self.item_count > 0 else 0.0
+            }
@@ -0,0 +1,171 @@
+'''
+Module for generating downsampled previews of test images (used by view_image_tests).
+
+Previews are 8-bit PNG (or WebP if PIL supports it) images whose larger side
+is at most the requested size. Images are downsampled by averaging blocks of
+pixels in linear space (8-bit images are sRGB decoded first). HDR images (EXR,
+PFM) are clamped to [0, 1], matching the default display of the compare view,
+and non-finite pixels are shown black. Previews are
+stored in a cache directory, keyed by the digest of the source file contents,
+the size and the format, so that previews of regenerated images are updated
+automatically while unchanged images (e.g. references shared by many runs) are
+only processed once.
+'''
+
+import os
+import io
+import tempfile
+from pathlib import Path
+
+from . import config
+from .helpers import FileCache, file_digest
+from .image_compare import np, PILImage, load_image, encode_png, UnsupportedImageError
+
+# Version of the preview generation, changing it invalidates cached previews.
+PREVIEW_VERSION = 2
+
+# Image formats in which previews can be generated, with their MIME types.
+FORMATS = { 'png': 'image/png', 'webp': 'image/webp' }
+
+# Image extensions for which previews can be generated.
+PREVIEW_EXTENSIONS = ['.png', '.tga', '.bmp', '.exr', '.pfm']
+
+# Image extensions containing HDR (linear) data.
+HDR_EXTENSIONS = ['.exr', '.pfm']
+
+
+def is_available():
+    '''
+    Check if previews can be generated.
+    '''
+    return np != None
+
+
+def is_webp_available():
+    if PILImage == None:
+        return False
+    try:
+        from PIL import features
+        return features.check('webp')
+    except (ImportError, ValueError):
+        return False
+
+
+def srgb_decode(srgb):
+    return np.where(srgb <= np.float32(0.04045), srgb / np.float32(12.92), np.power((srgb + np.float32(0.055)) / np.float32(1.055), np.float32(2.4)))
+
+
+def srgb_encode(linear):
+    linear = np.clip(linear, np.float32(0), np.float32(1))
+    return np.where(linear <= np.float32(0.0031308), linear * np.float32(12.92), np.float32(1.055) * np.power(linear, np.float32(1 / 2.4)) - np.float32(0.055))
+
+
+def downsample(image, size):
+    '''
+    Downsample an image of shape (height, width, channels) by an integer factor so that both sides are at most size pixels.
+    Pixels are averaged in blocks, partial blocks at the right and bottom borders are averaged over their valid pixels.
+    '''
+    height, width, channels = image.shape
+    factor = max(1, -(-max(height, width) // size))
+    if factor == 1:
+        return image
+    out_height = -(-height // factor)
+    out_width = -(-width // factor)
+    padded = np.zeros((out_height * factor, out_width * factor, channels), dtype=np.float32)
+    padded[0:height, 0:width] = image
+    weights = np.zeros((out_height * factor, out_width * factor, 1), dtype=np.float32)
+    weights[0:height, 0:width] = 1
+    sums = padded.reshape(out_height, factor, out_width, factor, channels).sum(axis=(1, 3))
+    counts = weights.reshape(out_height, factor, out_width, factor, 1).sum(axis=(1, 3))
+    return sums / counts
+
+
+def make_preview(path, size):
+    '''
+    Generate a preview of an image and return it as an 8-bit RGBA array.
+    Raises UnsupportedImageError if the image cannot be decoded.
+    '''
+    image = load_image(path)
+    hdr = Path(path).suffix.lower() in HDR_EXTENSIONS
+    if not hdr:
+        image[:, :, 0:3] = srgb_decode(image[:, :, 0:3])
+    image = downsample(image, size)
+    rgba = np.empty(image.shape, dtype=np.float32)
+    rgba[:, :, 0:3] = srgb_encode(image[:, :, 0:3])
+    # Alpha of HDR captures typically does not contain coverage, so HDR previews are opaque.
+    rgba[:, :, 3] = 1 if hdr else np.clip(image[:, :, 3], 0, 1)
+    # Clamping keeps nans, which have no defined 8-bit value.
+    rgba = np.nan_to_num(rgba, nan=0.0)
+    return (rgba * np.float32(255) + np.float32(0.5)).astype(np.uint8)
+
+
+def encode_preview(data, format):
+    if format == 'webp':
+        output = io.BytesIO()
+        PILImage.fromarray(data, 'RGBA').save(output, format='WEBP', quality=config.PREVIEW_WEBP_QUALITY)
+        return output.getvalue()
+    return encode_png(data)
+
+
+class PreviewCache:
+    '''
+    Cache of image previews stored in cache_dir.
+    The least recently used previews are removed when the cache exceeds max_bytes (see prune()).
+    '''
+
+    def __init__(self, cache_dir, max_bytes=config.PREVIEW_CACHE_MAX_BYTES):
+        self.cache_dir = Path(cache_dir)
+        self.max_bytes = max_bytes
+        self.file_digests = FileCache(self.cache_dir / 'file_digests.json')
+
+    def preview_key(self, path, size, format):
+        '''
+        Return the key identifying a preview (also used as entity tag).
+        '''
+        return f'{file_digest(path, self.file_digests)}-{size}-v{PREVIEW_VERSION}.{format}'
+
+    def entry_file(self, key):
+        return self.cache_dir / key[0:2] / key
+
+    def get(self, path, size=config.PREVIEW_SIZE, format='png'):
+        '''
+        Return a tuple containing the preview file of an image (generated if not cached) and its key.
+        Raises UnsupportedImageError if the image cannot be decoded.
+        '''
+        key = self.preview_key(path, size, format)
+        entry_file = self.entry_file(key)
+        if entry_file.exists():
+            # Mark the entry as recently used.
+            os.utime(entry_file)
+            return entry_file, key
+
+        data = encode_preview(make_preview(path, size), format)
+        # Write to a temporary file first so that concurrent requests never see partial entries.
+        entry_file.parent.mkdir(parents=True, exist_ok=True)
+        fd, tmp_file = tempfile.mkstemp(dir=entry_file.parent, suffix='.tmp')
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_file, entry_file)
+        return entry_file, key
+
+    def prune(self):
+        '''
+        Remove the least recently used previews until the cache fits into max_bytes.
+        '''
+        entries = []
+        for entry_file in self.cache_dir.glob('*/*-v*.*'):
+            try:
+                st = entry_file.stat()
+                entries.append((st.st_mtime, st.st_size, entry_file))
+            except OSError:
+                pass
+        total_size = sum(size for _, size, _ in entries)
+        for _, size, entry_file in sorted(entries):
+            if total_size <= self.max_bytes:
+                break
+            entry_file.unlink(missing_ok=True)
+            total_size -= size
+
+    def save(self):
+        self.file_digests.save()
+        self.prune()
@@ -0,0 +1,314 @@
+'''
+Module implementing a content-addressed store for reference images.
+
+Reference trees (one per branch and build configuration) mostly contain
+identical images. With a store, every image is kept once as an object named by
+the digest of its contents (objects/<xx>/<digest><extension>) and reference
+trees only contain links to the objects. A manifest in the root of each tree
+maps relative image paths to digests, and the store keeps a list of the trees
+it has been used for, so that unreferenced objects can be garbage collected.
+
+Objects are never modified in place. Trees are never
+written through their links either: generating references removes the tree
+before writing new images and pulling replaces files using temporary files.
+
+Storing, pulling and garbage collection hold a lock file in the objects
+directory for their whole duration, so that processes sharing a store never
+lose tree registrations and garbage collection never sees objects of a tree
+that is not registered yet.
+'''
+
+import os
+import json
+import shutil
+import hashlib
+import tempfile
+import threading
+import contextlib
+from pathlib import Path
+
+from . import config
+from .helpers import file_digest, file_lock, write_json_file
+
+# Lock file (in the objects directory) synchronizing processes using the store.
+LOCK_FILE = '.lock'
+
+
+def is_image(path):
+    return path.suffix.lower() in config.IMAGE_EXTENSIONS and not str(path).endswith(config.ERROR_IMAGE_SUFFIX)
+
+
+def list_files(tree_dir):
+    '''
+    List all files in a tree (relative paths), excluding the manifest.
+    '''
+    tree_dir = Path(tree_dir)
+    files = []
+    for root, dirs, names in os.walk(tree_dir):
+        for name in names:
+            path = Path(root) / name
+            if path.parent == tree_dir and name == config.REF_MANIFEST_FILE:
+                continue
+            files.append(path.relative_to(tree_dir))
+    return sorted(files)
+
+
+def load_manifest(tree_dir):
+    '''
+    Load the manifest of a tree or return None if not available.
+    '''
+    try:
+        with open(Path(tree_dir) / config.REF_MANIFEST_FILE) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def write_manifest(tree_dir, manifest):
+    write_json_file(Path(tree_dir) / config.REF_MANIFEST_FILE, manifest, indent=1, sort_keys=True)
+
+
+def replace_atomic(path, create):
+    '''
+    Replace path with a file created by create(tmp_path) in the same directory.
+    '''
+    path.parent.mkdir(parents=True, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=path.parent, prefix='.', suffix='.tmp')
+    os.close(fd)
+    os.unlink(tmp_path)
+    try:
+        create(Path(tmp_path))
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.lexists(tmp_path):
+            os.unlink(tmp_path)
+        raise
+
+
+class ObjectStore:
+    '''
+    Store of image objects shared by reference trees.
+    link_mode is 'hardlink' or 'symlink'. If links are not supported (e.g. the tree is on a different
+    file system), files are copied instead.
+    '''
+
+    def __init__(self, objects_dir, link_mode=config.REF_LINK_MODE):
+        if not link_mode in ['hardlink', 'symlink']:
+            raise ValueError(f'Unknown link mode "{link_mode}"')
+        self.objects_dir = Path(objects_dir)
+        self.link_mode = link_mode
+        self.trees_file = self.objects_dir / 'trees.json'
+        self.mutex = threading.Lock()
+
+    @contextlib.contextmanager
+    def lock(self):
+        '''
+        Context manager for exclusive access to the store (across threads and processes).
+        '''
+        with self.mutex:
+            with file_lock(self.objects_dir / LOCK_FILE):
+                yield
+
+    def object_file(self, digest, suffix):
+        return self.objects_dir / digest[0:2] / (digest + suffix.lower())
+
+    def add_object(self, source, digest):
+        '''
+        Add the contents of file source as an object (unless it exists) and return the object file.
+        '''
+        object_file = self.object_file(digest, source.suffix)
+        if not object_file.exists():
+            replace_atomic(object_file, lambda tmp_path: shutil.copyfile(source, tmp_path))
+        return object_file
+
+    def fetch_object(self, source):
+        '''
+        Add the contents of file source as an object, computing its digest (see helpers.file_digest) while copying,
+        so that the file is only read once. Returns a tuple containing the digest and a flag indicating if the object is new.
+        '''
+        self.objects_dir.mkdir(parents=True, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=self.objects_dir, prefix='.', suffix='.tmp')
+        try:
+            h = hashlib.blake2b(digest_size=16)
+            with open(source, 'rb') as src, os.fdopen(fd, 'wb') as dst:
+                for block in iter(lambda: src.read(1 << 20), b''):
+                    h.update(block)
+                    dst.write(block)
+            digest = h.hexdigest()
+            object_file = self.object_file(digest, source.suffix)
+            if object_file.exists():
+                return digest, False
+            object_file.parent.mkdir(parents=True, exist_ok=True)
+            os.replace(tmp_path, object_file)
+            return digest, True
+        finally:
+            if os.path.exists(tmp_path):
+                os.unlink(tmp_path)
+
+    def link(self, object_file, path):
+        '''
+        Replace path with a link to object_file (or a copy if links are not supported).
+        '''
+        def create(tmp_path):
+            if self.link_mode == 'hardlink':
+                try:
+                    os.link(object_file, tmp_path)
+                    return
+                except OSError:
+                    pass
+            try:
+                os.symlink(object_file.resolve(), tmp_path)
+                return
+            except OSError:
+                pass
+            shutil.copyfile(object_file, tmp_path)
+        replace_atomic(path, create)
+
+    def is_linked(self, path, object_file):
+        try:
+            return os.path.samefile(path, object_file) or (path.is_symlink() and Path(os.readlink(path)) == object_file.resolve())
+        except OSError:
+            return False
+
+    def store_tree(self, tree_dir, digest_cache=None):
+        '''
+        Move all images of a tree into the store, replacing them with links, and write the manifest of the tree.
+        Returns a tuple containing the number of images and the number of images that were not in the store yet.
+        '''
+        tree_dir = Path(tree_dir)
+        manifest = {}
+        new_count = 0
+        with self.lock():
+            for rel_path in list_files(tree_dir):
+                path = tree_dir / rel_path
+                if not is_image(path):
+                    continue
+                digest = file_digest(path, digest_cache)
+                object_file = self.object_file(digest, path.suffix)
+                if not object_file.exists():
+                    new_count += 1
+                object_file = self.add_object(path, digest)
+                if not self.is_linked(path, object_file):
+                    self.link(object_file, path)
+                manifest[rel_path.as_posix()] = digest
+            write_manifest(tree_dir, manifest)
+            self.add_tree(tree_dir)
+        return len(manifest), new_count
+
+    def pull_tree(self, remote_dir, tree_dir, digest_cache=None):
+        '''
+        Mirror a remote tree into tree_dir, only transferring images that are not in the store yet.
+        Images are identified by the manifest of the remote tree. Without a manifest, the digests of remote
+        images are looked up in digest_cache (see helpers.FileCache, keyed by size and modification time) and
+        only images missing from the cache are read, hashing them while copying them into the store.
+        Other files are copied if their size or modification time differ. Extraneous files and directories are deleted.
+        Returns a tuple containing the number of images and the number of images transferred.
+        '''
+        remote_dir = Path(remote_dir)
+        tree_dir = Path(tree_dir)
+        remote_manifest = load_manifest(remote_dir) or {}
+        remote_files = list_files(remote_dir)
+
+        manifest = {}
+        transferred = 0
+        with self.lock():
+            for rel_path in remote_files:
+                src = remote_dir / rel_path
+                dst = tree_dir / rel_path
+                if is_image(src):
+                    digest = remote_manifest.get(rel_path.as_posix(), None) or (digest_cache.get(src) if digest_cache else None)
+                    if digest == None:
+                        digest, is_new = self.fetch_object(src)
+                        if digest_cache:
+                            digest_cache.put(src, digest)
+                        transferred += 1 if is_new else 0
+                    object_file = self.object_file(digest, src.suffix)
+                    if not object_file.exists():
+                        self.add_object(src, digest)
+                        transferred += 1
+                    if not self.is_linked(dst, object_file):
+                        self.link(object_file, dst)
+                    manifest[rel_path.as_posix()] = digest
+                else:
+                    src_stat = src.stat()
+                    try:
+                        dst_stat = dst.stat()
+                        unchanged = dst_stat.st_size == src_stat.st_size and dst_stat.st_mtime_ns == src_stat.st_mtime_ns
+                    except OSError:
+                        unchanged = False
+                    if not unchanged:
+                        replace_atomic(dst, lambda tmp_path: shutil.copy2(src, tmp_path))
+
+            # Delete extraneous files and the directories left empty.
+            if tree_dir.exists():
+                remote_set = set(remote_files)
+                for rel_path in list_files(tree_dir):
+                    if not rel_path in remote_set:
+                        (tree_dir / rel_path).unlink()
+                for root, dirs, names in os.walk(tree_dir, topdown=False):
+                    if Path(root) != tree_dir and not os.listdir(root):
+                        os.rmdir(root)
+
+            tree_dir.mkdir(parents=True, exist_ok=True)
+            write_manifest(tree_dir, manifest)
+            self.add_tree(tree_dir)
+        return len(manifest), transferred
+
+    def load_trees(self):
+        try:
+            with open(self.trees_file) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return []
+
+    def register_tree(self, tree_dir):
+        '''
+        Add a tree to the list of trees using the store.
+        '''
+        with self.lock():
+            self.add_tree(tree_dir)
+
+    def add_tree(self, tree_dir):
+        '''
+        Add a tree to the list of trees using the store (the store needs to be locked).
+        '''
+        trees = self.load_trees()
+        tree = str(Path(tree_dir).resolve())
+        if not tree in trees:
+            trees.append(tree)
+            write_json_file(self.trees_file, sorted(trees), indent=1)
+
+    def gc(self, dry_run=False):
+        '''
+        Remove objects not referenced by the manifest of any registered tree.
+        Trees without a manifest are unregistered. Hard linked objects are always kept, as they may be
+        used by a tree whose manifest is outdated.
+        Returns a tuple containing the number of removed objects and the number of bytes freed.
+        '''
+        with self.lock():
+            trees = []
+            referenced = set()
+            for tree in self.load_trees():
+                manifest = load_manifest(tree)
+                if manifest == None:
+                    continue
+                trees.append(tree)
+                referenced.update(manifest.values())
+
+            removed_count = 0
+            removed_bytes = 0
+            for object_file in self.objects_dir.glob('*/*'):
+                if object_file.name.startswith('.') or object_file.stem in referenced:
+                    continue
+                st = object_file.stat()
+                if st.st_nlink > 1:
+                    continue
+                removed_count += 1
+                removed_bytes += st.st_size
+                if not dry_run:
+                    object_file.unlink()
+
+            if not dry_run and self.trees_file.exists():
+                write_json_file(self.trees_file, sorted(trees), indent=1)
+
+        return removed_count, removed_bytes
@@ -0,0 +1,102 @@
+'''
+Module for writing image test run reports.
+
+Test results are appended to a JSON lines log (results.jsonl) as soon as they
+are available, and the run report and XML report are periodically rewritten
+from the results. This way, the results of a run are not lost if the harness
+is killed, and an interrupted run can be resumed from the log. Reports are
+written atomically (see helpers.write_file_atomic).
+'''
+
+import os
+import json
+from pathlib import Path
+from xml.etree import ElementTree as ET
+
+from . import helpers
+
+# Results of tests that have completed (as stored in the result log).
+TERMINAL_RESULTS = ['PASSED', 'FAILED', 'SKIPPED']
+
+
+def write_json(path, data):
+    '''
+    Write a JSON file atomically.
+    '''
+    helpers.write_json_file(path, data, indent=4)
+
+
+def write_xml_testsuite(xml_file, testcases):
+    '''
+    Write an XML (JUnit) report containing a single test suite with the given testcase elements atomically.
+    The counters of the test suite are computed from the testcases.
+    '''
+    testcases = list(testcases)
+    count = lambda tag: sum(1 for t in testcases if t.find(tag) != None)
+    testsuites = ET.Element("testsuites")
+    suite = ET.SubElement(testsuites, "testsuite", name="Image Tests", tests=str(len(testcases)), failures=str(count('failure')), errors=str(count('error')), skipped=str(count('skipped')))
+    suite.set('time', '%.3f' % sum(float(t.get('time', 0)) for t in testcases))
+    suite.extend(testcases)
+    helpers.write_file_atomic(xml_file, ET.tostring(testsuites, encoding='unicode'))
+
+
+def write_xml_report(xml_file, results):
+    '''
+    Write an XML (JUnit) report atomically.
+    Results are dictionaries containing the name, elapsed time, result string and messages of a test.
+    '''
+    testcases = []
+    for result in results:
+        testcase = ET.Element("testcase", name=result["name"], time="%.3f" % result["elapsed_time"])
+        if result["result"] == 'SKIPPED':
+            ET.SubElement(testcase, "skipped")
+        elif result["result"] == 'FAILED':
+            ET.SubElement(testcase, "failure", message="\n".join(result["messages"]))
+        testcases.append(testcase)
+    write_xml_testsuite(xml_file, testcases)
+
+
+class ResultLog:
+    '''
+    Append-only log of test results stored as JSON lines.
+    Every result is flushed to disk immediately.
+    '''
+
+    def __init__(self, log_file):
+        self.log_file = Path(log_file)
+
+    def load(self):
+        '''
+        Load all results with a terminal result from the log.
+        An incomplete last line (written while the harness was killed) is ignored.
+        Returns a dictionary mapping test names to results (later results override earlier ones).
+        '''
+        results = {}
+        try:
+            with open(self.log_file, encoding='utf-8') as f:
+                for line in f:
+                    try:
+                        result = json.loads(line)
+                    except ValueError:
+                        continue
+                    if isinstance(result, dict) and result.get('result', None) in TERMINAL_RESULTS:
+                        results[result['name']] = result
+        except OSError:
+            pass
+        return results
+
+    def clear(self):
+        '''
+        Start a new empty log.
+        '''
+        self.log_file.parent.mkdir(parents=True, exist_ok=True)
+        open(self.log_file, 'w').close()
+
+    def append(self, result):
+        '''
+        Append a result to the log.
+        '''
+        with open(self.log_file, 'a', encoding='utf-8') as f:
+            f.write(json.dumps(result) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
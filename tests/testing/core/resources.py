@@ -0,0 +1,215 @@
+'''
+Module for measuring the resource usage of child processes.
+
+The usage of a process is reported as a dictionary containing the peak resident
+set size in bytes ('peak_rss') and the user and system CPU time in seconds
+('user_time', 'system_time'). On POSIX systems the usage of terminated
+processes is taken from os.wait4(), on Windows it is queried from the process
+handle. The usage of running processes (e.g. persistent workers) is read from
+/proc on Linux. The module also provides host signals (load average, available
+memory) used for adapting the number of parallel processes.
+'''
+
+import os
+import sys
+import time
+import threading
+import subprocess
+
+from . import config
+
+if os.name == 'nt':
+    import ctypes
+    from ctypes import wintypes
+
+# Interval (in seconds) for polling processes for termination.
+POLL_INTERVAL = 0.02
+
+
+def read_stream(stream, chunks):
+    chunks.append(stream.read())
+    stream.close()
+
+
+def communicate(p, timeout=None, output=None):
+    '''
+    Wait for a process to terminate while reading its stdout/stderr pipes, similar to Popen.communicate().
+    If output is given (see output.OutputCapture), the pipes are read by it instead of being buffered in memory.
+    Returns a tuple containing the stdout data, stderr data (both None if output is given) and the resource
+    usage of the process (None if not available). Raises subprocess.TimeoutExpired if the process does not
+    terminate within the timeout, in which case the process is still running and needs to be killed by the
+    caller (using Popen.kill() and Popen.wait(), the pipes are owned by reader threads at this point).
+    '''
+    if output == None:
+        outputs = { 'stdout': [], 'stderr': [] }
+        readers = []
+        for name, stream in [('stdout', p.stdout), ('stderr', p.stderr)]:
+            if stream != None:
+                readers.append(threading.Thread(target=read_stream, args=(stream, outputs[name]), daemon=True))
+                readers[-1].start()
+    else:
+        output.start(p)
+
+    if os.name == 'nt':
+        p.wait(timeout=timeout)
+        usage = windows_usage(p)
+    else:
+        usage = wait_posix(p, timeout)
+
+    # Do not wait indefinitely for pipes held open by processes started by the process.
+    if output != None:
+        closed = output.join(config.OUTPUT_PIPE_TIMEOUT)
+    else:
+        deadline = time.time() + config.OUTPUT_PIPE_TIMEOUT
+        for reader in readers:
+            reader.join(max(0, deadline - time.time()))
+        closed = not any(reader.is_alive() for reader in readers)
+    if not closed:
+        print(f'Warning: Output pipes of process {p.pid} are still open {config.OUTPUT_PIPE_TIMEOUT} s after it exited (inherited by a child process?), output may be incomplete.')
+    if output != None:
+        return None, None, usage
+
+    outs = b''.join(outputs['stdout']) if p.stdout != None else None
+    errs = b''.join(outputs['stderr']) if p.stderr != None else None
+    return outs, errs, usage
+
+
+def wait_posix(p, timeout):
+    '''
+    Reap a process using os.wait4() to get its resource usage.
+    '''
+    deadline = time.time() + timeout if timeout != None else None
+    while True:
+        try:
+            pid, status, rusage = os.wait4(p.pid, os.WNOHANG)
+        except ChildProcessError:
+            # The process has already been reaped (e.g. by Popen.poll()).
+            p.wait()
+            return None
+        if pid != 0:
+            p.returncode = os.waitstatus_to_exitcode(status)
+            # ru_maxrss is reported in kilobytes on Linux and in bytes on macOS.
+            peak_rss = rusage.ru_maxrss if sys.platform == 'darwin' else rusage.ru_maxrss * 1024
+            return { 'peak_rss': peak_rss, 'user_time': rusage.ru_utime, 'system_time': rusage.ru_stime }
+        if deadline != None and time.time() > deadline:
+            raise subprocess.TimeoutExpired(p.args, timeout)
+        time.sleep(POLL_INTERVAL)
+
+
+def windows_usage(p):
+    '''
+    Query the resource usage of a terminated process on Windows.
+    Returns None if the usage cannot be queried.
+    '''
+    class PROCESS_MEMORY_COUNTERS(ctypes.Structure):
+        _fields_ = [
+            ('cb', wintypes.DWORD),
+            ('PageFaultCount', wintypes.DWORD),
+            ('PeakWorkingSetSize', ctypes.c_size_t),
+            ('WorkingSetSize', ctypes.c_size_t),
+            ('QuotaPeakPagedPoolUsage', ctypes.c_size_t),
+            ('QuotaPagedPoolUsage', ctypes.c_size_t),
+            ('QuotaPeakNonPagedPoolUsage', ctypes.c_size_t),
+            ('QuotaNonPagedPoolUsage', ctypes.c_size_t),
+            ('PagefileUsage', ctypes.c_size_t),
+            ('PeakPagefileUsage', ctypes.c_size_t)
+        ]
+
+    try:
+        # Popen keeps the process handle open until it is destroyed.
+        handle = wintypes.HANDLE(int(p._handle))
+        creation, exit, kernel, user = wintypes.FILETIME(), wintypes.FILETIME(), wintypes.FILETIME(), wintypes.FILETIME()
+        if not ctypes.windll.kernel32.GetProcessTimes(handle, ctypes.byref(creation), ctypes.byref(exit), ctypes.byref(kernel), ctypes.byref(user)):
+            return None
+        counters = PROCESS_MEMORY_COUNTERS()
+        counters.cb = ctypes.sizeof(counters)
+        if not ctypes.windll.psapi.GetProcessMemoryInfo(handle, ctypes.byref(counters), counters.cb):
+            return None
+    except (AttributeError, OSError):
+        return None
+
+    # FILETIME values are in units of 100 ns.
+    filetime_seconds = lambda t: ((t.dwHighDateTime << 32) + t.dwLowDateTime) * 1e-7
+    return { 'peak_rss': counters.PeakWorkingSetSize, 'user_time': filetime_seconds(user), 'system_time': filetime_seconds(kernel) }
+
+
+def process_usage(pid):
+    '''
+    Read the resource usage of a running process from /proc (Linux only).
+    The peak resident set size covers the lifetime of the process.
+    Returns None if the usage cannot be read.
+    '''
+    try:
+        with open(f'/proc/{pid}/stat') as f:
+            # Skip the command name, which may contain spaces.
+            fields = f.read().rsplit(')', 1)[1].split()
+        with open(f'/proc/{pid}/status') as f:
+            status = dict(line.split(':', 1) for line in f if ':' in line)
+        ticks = os.sysconf('SC_CLK_TCK')
+        return {
+            'peak_rss': int(status['VmHWM'].split()[0]) * 1024,
+            'user_time': int(fields[11]) / ticks,
+            'system_time': int(fields[12]) / ticks
+        }
+    except (OSError, ValueError, KeyError, IndexError, AttributeError):
+        return None
+
+
+def usage_delta(before, after):
+    '''
+    Return the usage of a running process between two measurements (the peak resident set size is kept as is).
+    '''
+    if before == None or after == None:
+        return None
+    return {
+        'peak_rss': after['peak_rss'],
+        'user_time': after['user_time'] - before['user_time'],
+        'system_time': after['system_time'] - before['system_time']
+    }
+
+
+def load_average():
+    '''
+    Return the 1 minute load average divided by the number of CPUs, or None if not available (Windows).
+    '''
+    try:
+        return os.getloadavg()[0] / (os.cpu_count() or 1)
+    except (AttributeError, OSError):
+        return None
+
+
+def available_memory():
+    '''
+    Return the amount of memory (in bytes) available for starting new processes without swapping,
+    or None if not available.
+    '''
+    if os.name == 'nt':
+        class MEMORYSTATUSEX(ctypes.Structure):
+            _fields_ = [
+                ('dwLength', wintypes.DWORD),
+                ('dwMemoryLoad', wintypes.DWORD),
+                ('ullTotalPhys', ctypes.c_ulonglong),
+                ('ullAvailPhys', ctypes.c_ulonglong),
+                ('ullTotalPageFile', ctypes.c_ulonglong),
+                ('ullAvailPageFile', ctypes.c_ulonglong),
+                ('ullTotalVirtual', ctypes.c_ulonglong),
+                ('ullAvailVirtual', ctypes.c_ulonglong),
+                ('ullAvailExtendedVirtual', ctypes.c_ulonglong)
+            ]
+        try:
+            status = MEMORYSTATUSEX()
+            status.dwLength = ctypes.sizeof(status)
+            if not ctypes.windll.kernel32.GlobalMemoryStatusEx(ctypes.byref(status)):
+                return None
+            return status.ullAvailPhys
+        except (AttributeError, OSError):
+            return None
+
+    try:
+        with open('/proc/meminfo') as f:
+            for line in f:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) * 1024
+    except (OSError, ValueError, IndexError):
+        pass
+    return None
@@ -0,0 +1,340 @@
+'''
+Module implementing an SQLite index of image test results (used by view_image_tests).
+
+The index contains the runs found in the result directory, the tests of each
+run and the images of each test, so that pages can be rendered without walking
+and parsing the result directory on every request. The index is updated
+incrementally: report files are only parsed if their modification time or size
+changed since they were indexed, and runs whose report disappeared are removed.
+The tests of a run are located using the list of tests in the run report (falling
+back to searching the run directory for older reports).
+'''
+
+import re
+import json
+import time
+import functools
+import sqlite3
+import threading
+from pathlib import Path
+
+# Version of the database schema, the index is rebuilt if it changes.
+SCHEMA_VERSION = 2
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT);
+CREATE TABLE IF NOT EXISTS runs (
+    run_dir TEXT PRIMARY KEY,
+    mtime_ns INTEGER,
+    size INTEGER,
+    date TEXT,
+    result TEXT,
+    duration REAL,
+    test_count INTEGER,
+    report TEXT
+);
+CREATE TABLE IF NOT EXISTS tests (
+    run_dir TEXT,
+    test_dir TEXT,
+    mtime_ns INTEGER,
+    size INTEGER,
+    name TEXT,
+    result TEXT,
+    duration REAL,
+    image_count INTEGER,
+    failed_image_count INTEGER,
+    max_error REAL,
+    tags TEXT,
+    report TEXT,
+    PRIMARY KEY (run_dir, test_dir)
+);
+CREATE TABLE IF NOT EXISTS images (
+    run_dir TEXT,
+    test_dir TEXT,
+    name TEXT,
+    success INTEGER,
+    error REAL,
+    tolerance REAL,
+    PRIMARY KEY (run_dir, test_dir, name)
+);
+CREATE INDEX IF NOT EXISTS runs_date ON runs (date);
+'''
+
+# Columns for sorting runs and tests by key (sorting by error sorts by the largest image error of a test).
+RUN_SORT_COLUMNS = { 'date': 'date', 'name': 'run_dir', 'duration': 'duration', 'result': 'result' }
+TEST_SORT_COLUMNS = { 'name': 'test_dir', 'duration': 'duration', 'error': 'max_error', 'result': 'result' }
+
+
+def load_json(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def file_stat(path):
+    '''
+    Return the modification time and size of a file or None if it does not exist.
+    '''
+    try:
+        st = path.stat()
+        return st.st_mtime_ns, st.st_size
+    except OSError:
+        return None
+
+
+@functools.lru_cache(maxsize=64)
+def compile_regex(pattern):
+    return re.compile(pattern)
+
+
+def regexp(pattern, value):
+    '''
+    Implementation of the SQL REGEXP operator (searches value for pattern).
+    '''
+    return value != None and compile_regex(pattern).search(value) != None
+
+
+def path_part(path, index):
+    '''
+    Return a component of a posix path (used for filtering runs by the tags making up the run directory).
+    '''
+    parts = path.split('/')
+    return parts[index] if index < len(parts) else None
+
+
+def image_error(image):
+    error = image.get('error', None)
+    return error if isinstance(error, (int, float)) else None
+
+
+class ResultIndex:
+    '''
+    Index of the runs in result_dir, stored in the SQLite database db_file.
+    run_glob is the glob pattern (relative to result_dir) matching the run report files.
+    '''
+
+    def __init__(self, db_file, result_dir, run_glob):
+        self.result_dir = Path(result_dir)
+        self.run_glob = run_glob
+        self.mutex = threading.Lock()
+        self.refresh_mutex = threading.Lock()
+        self.refresh_count = 0
+        self.thread = None
+
+        Path(db_file).parent.mkdir(parents=True, exist_ok=True)
+        self.db = sqlite3.connect(str(db_file), check_same_thread=False)
+        self.db.row_factory = sqlite3.Row
+        self.db.create_function('REGEXP', 2, regexp, deterministic=True)
+        self.db.create_function('PATH_PART', 2, path_part, deterministic=True)
+        with self.mutex, self.db:
+            self.db.execute('PRAGMA journal_mode=WAL')
+            self.db.executescript(SCHEMA)
+            meta = dict(self.db.execute('SELECT key, value FROM meta').fetchall())
+            if meta.get('version', None) != str(SCHEMA_VERSION) or meta.get('result_dir', None) != str(self.result_dir):
+                # Rebuild the index if the schema or the result directory changed.
+                for table in ['runs', 'tests', 'images', 'meta']:
+                    self.db.execute(f'DROP TABLE {table}')
+                self.db.executescript(SCHEMA)
+                self.db.executemany('INSERT INTO meta VALUES (?, ?)', [('version', str(SCHEMA_VERSION)), ('result_dir', str(self.result_dir))])
+
+    def start(self, interval):
+        '''
+        Start refreshing the index in a background thread every interval seconds.
+        '''
+        def refresh_loop():
+            while True:
+                try:
+                    self.refresh()
+                except (OSError, sqlite3.Error) as e:
+                    print(f'Failed to refresh result index: {e}')
+                time.sleep(interval)
+        self.thread = threading.Thread(target=refresh_loop, name='result_index', daemon=True)
+        self.thread.start()
+
+    def is_ready(self):
+        '''
+        Return True if the index has been refreshed at least once.
+        '''
+        return self.refresh_count > 0
+
+    def refresh(self):
+        '''
+        Update the index from the result directory.
+        Returns a tuple containing the number of runs and tests that were (re)indexed.
+        '''
+        with self.refresh_mutex:
+            with self.mutex:
+                indexed_runs = { row['run_dir']: (row['mtime_ns'], row['size']) for row in self.db.execute('SELECT run_dir, mtime_ns, size FROM runs') }
+
+            run_count = 0
+            test_count = 0
+            found = set()
+            for run_report_file in self.result_dir.glob(self.run_glob):
+                run_dir = run_report_file.parent.relative_to(self.result_dir).as_posix()
+                st = file_stat(run_report_file)
+                if st == None:
+                    continue
+                found.add(run_dir)
+                if indexed_runs.get(run_dir, None) == st:
+                    continue
+                test_count += self.index_run(run_dir, run_report_file, st)
+                run_count += 1
+
+            removed = [run_dir for run_dir in indexed_runs if not run_dir in found]
+            if removed:
+                with self.mutex, self.db:
+                    for table in ['runs', 'tests', 'images']:
+                        self.db.executemany(f'DELETE FROM {table} WHERE run_dir = ?', [(run_dir,) for run_dir in removed])
+
+            self.refresh_count += 1
+            return run_count, test_count
+
+    def update_run(self, run_dir):
+        '''
+        Index a single run immediately (e.g. if it is requested before the next refresh).
+        '''
+        run_report_file = self.result_dir / run_dir / 'report.json'
+        st = file_stat(run_report_file)
+        if st != None:
+            with self.refresh_mutex:
+                self.index_run(run_dir, run_report_file, st)
+
+    def index_run(self, run_dir, run_report_file, st):
+        '''
+        Index a single run and its tests. Test reports are only parsed if they changed.
+        Returns the number of tests that were (re)indexed.
+        '''
+        run = load_json(run_report_file)
+        if not isinstance(run, dict):
+            return 0
+
+        run_path = self.result_dir / run_dir
+        if isinstance(run.get('tests', None), list):
+            test_report_files = [run_path / name / 'report.json' for name in run['tests']]
+        else:
+            test_report_files = list(run_path.glob('*/**/report.json'))
+
+        with self.mutex:
+            indexed_tests = { row['test_dir']: (row['mtime_ns'], row['size']) for row in self.db.execute('SELECT test_dir, mtime_ns, size FROM tests WHERE run_dir = ?', (run_dir,)) }
+
+        test_rows = []
+        image_rows = []
+        found = set()
+        for test_report_file in test_report_files:
+            test_st = file_stat(test_report_file)
+            if test_st == None:
+                continue
+            test_dir = test_report_file.parent.relative_to(run_path).as_posix()
+            found.add(test_dir)
+            if indexed_tests.get(test_dir, None) == test_st:
+                continue
+            test = load_json(test_report_file)
+            if not isinstance(test, dict):
+                continue
+            images = test.get('images', [])
+            errors = [image_error(i) for i in images if image_error(i) != None]
+            test_rows.append((
+                run_dir, test_dir, test_st[0], test_st[1],
+                test.get('name', test_dir), test.get('result', None), test.get('duration', None),
+                len(images), len([i for i in images if not i.get('success', False)]),
+                max(errors) if errors else None,
+                ',' + ','.join(test.get('tags', [])) + ',',
+                json.dumps(test)
+            ))
+            for image in images:
+                image_rows.append((run_dir, test_dir, image.get('name', ''), 1 if image.get('success', False) else 0, image_error(image), image.get('tolerance', None)))
+
+        removed = [test_dir for test_dir in indexed_tests if not test_dir in found]
+        changed = [(run_dir, row[1]) for row in test_rows] + [(run_dir, test_dir) for test_dir in removed]
+
+        with self.mutex, self.db:
+            self.db.executemany('DELETE FROM tests WHERE run_dir = ? AND test_dir = ?', changed)
+            self.db.executemany('DELETE FROM images WHERE run_dir = ? AND test_dir = ?', changed)
+            self.db.executemany('INSERT INTO tests VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)', test_rows)
+            self.db.executemany('INSERT OR REPLACE INTO images VALUES (?, ?, ?, ?, ?, ?)', image_rows)
+            self.db.execute('INSERT OR REPLACE INTO runs VALUES (?, ?, ?, ?, ?, ?, ?, ?)', (
+                run_dir, st[0], st[1], run.get('date', None), run.get('result', None), run.get('duration', None),
+                len(found), json.dumps(run)
+            ))
+
+        return len(test_rows)
+
+    def query(self, sql, params=()):
+        with self.mutex:
+            return self.db.execute(sql, params).fetchall()
+
+    def run(self, run_dir):
+        '''
+        Return the report of a run or None if it is not indexed.
+        '''
+        rows = self.query('SELECT report FROM runs WHERE run_dir = ?', (run_dir,))
+        return json.loads(rows[0]['report']) if rows else None
+
+    def tests(self, run_dir):
+        '''
+        Return the reports of all tests of a run (sorted by name).
+        '''
+        return [json.loads(row['report']) for row in self.query('SELECT report FROM tests WHERE run_dir = ? ORDER BY test_dir', (run_dir,))]
+
+    def query_page(self, table, columns, conditions, params, sort_column, descending, limit, offset):
+        '''
+        Query a page of rows from table.
+        Returns a tuple containing the total number of matching rows and the rows of the page.
+        '''
+        where = ' AND '.join(conditions) if conditions else '1'
+        order = 'DESC' if descending else 'ASC'
+        # Rows without a value (e.g. tests without images when sorting by error) are always listed last.
+        order_by = f'{sort_column} IS NULL, {sort_column} {order}, rowid'
+        with self.mutex:
+            total = self.db.execute(f'SELECT COUNT(*) FROM {table} WHERE {where}', params).fetchone()[0]
+            rows = self.db.execute(f'SELECT {columns} FROM {table} WHERE {where} ORDER BY {order_by} LIMIT ? OFFSET ?', list(params) + [limit, offset]).fetchall()
+        return total, rows
+
+    def query_runs(self, results=None, tags=None, name=None, sort='date', descending=True, limit=100, offset=0):
+        '''
+        Query a page of runs.
+        results is a list of results to include, tags maps indices of run directory components to values,
+        name is a regular expression searched in the run directory.
+        Returns a tuple containing the total number of matching runs and the rows of the page.
+        '''
+        conditions = []
+        params = []
+        if results:
+            conditions.append(f'result IN ({",".join("?" * len(results))})')
+            params += results
+        for index, value in (tags or {}).items():
+            conditions.append('PATH_PART(run_dir, ?) = ?')
+            params += [index, value]
+        if name:
+            conditions.append('run_dir REGEXP ?')
+            params.append(name)
+        columns = 'run_dir, date, result, duration, test_count'
+        return self.query_page('runs', columns, conditions, params, RUN_SORT_COLUMNS[sort], descending, limit, offset)
+
+    def query_tests(self, run_dir, results=None, tag=None, name=None, sort='name', descending=False, limit=100, offset=0):
+        '''
+        Query a page of the tests of a run.
+        results is a list of results to include, tag is a test tag, name is a regular expression searched in the test name.
+        Returns a tuple containing the total number of matching tests and the rows of the page.
+        '''
+        conditions = ['run_dir = ?']
+        params = [run_dir]
+        if results:
+            conditions.append(f'result IN ({",".join("?" * len(results))})')
+            params += results
+        if tag:
+            conditions.append('tags LIKE ?')
+            params.append(f'%,{tag},%')
+        if name:
+            conditions.append('name REGEXP ?')
+            params.append(name)
+        columns = 'test_dir, name, result, duration, image_count, failed_image_count, max_error, tags, report'
+        return self.query_page('tests', columns, conditions, params, TEST_SORT_COLUMNS[sort], descending, limit, offset)
+
+    def test_result_counts(self, run_dir):
+        '''
+        Return a dictionary mapping results to the number of tests of a run.
+        '''
+        return { row['result']: row['count'] for row in self.query('SELECT result, COUNT(*) AS count FROM tests WHERE run_dir = ? GROUP BY result', (run_dir,)) }
@@ -0,0 +1,143 @@
+'''
+Module for scheduling image tests.
+
+Tests are ordered longest first (LPT scheduling) based on the durations
+recorded in the reports of previous runs, which minimizes the risk of a long
+test starting late and dominating the total run time.
+
+Each test occupies a number of slots (its weight) while running. Tests are
+admitted in order as long as their weight fits into the free slots, lighter
+tests further back in the queue can fill up remaining slots. Exclusive tests
+(occupying all slots) are never overtaken, so they cannot be starved.
+
+Tests can also be partitioned into shards run on different machines. Shards
+are balanced using historical durations from a shared durations file, tests
+without a known duration are assigned by a stable hash of their name.
+'''
+
+import json
+import heapq
+import hashlib
+import statistics
+
+from . import config, helpers
+
+
+def load_durations(tests, result_dir):
+    '''
+    Load the durations of the previous runs of a set of tests from their reports in result_dir.
+    Returns a dictionary mapping test names to durations (tests without a report are omitted).
+    '''
+    durations = {}
+    for test in tests:
+        report_file = result_dir / test.test_dir / 'report.json'
+        try:
+            with open(report_file) as f:
+                report = json.load(f)
+            duration = report.get('duration', None)
+            if isinstance(duration, (int, float)) and duration > 0:
+                durations[test.name] = float(duration)
+        except (OSError, ValueError):
+            pass
+    return durations
+
+
+def estimate_durations(tests, durations):
+    '''
+    Estimate the duration of every test.
+    Tests without history are estimated using the median of the known durations
+    (or config.DEFAULT_DURATION_ESTIMATE if there is no history at all).
+    '''
+    default = statistics.median(durations.values()) if len(durations) > 0 else config.DEFAULT_DURATION_ESTIMATE
+    return { t.name: durations.get(t.name, default) for t in tests }
+
+
+def order_longest_first(tests, estimates):
+    '''
+    Return the tests ordered by decreasing estimated duration.
+    Ties are broken by name to get a deterministic order.
+    '''
+    return sorted(tests, key=lambda t: (-estimates[t.name], t.name))
+
+
+def next_admissible(pending, free_slots, weight):
+    '''
+    Return the first pending test whose weight fits into the free slots, or None.
+    Scanning stops at an exclusive test that does not fit, so that it cannot be starved.
+    '''
+    for test in pending:
+        if weight(test) <= free_slots:
+            return test
+        if test.exclusive:
+            return None
+    return None
+
+
+def predict_makespan(tests, estimates, weight, slot_count):
+    '''
+    Predict the total run time when running tests in the given order on slot_count parallel slots,
+    using the same admission policy as the test runner.
+    '''
+    pending = list(tests)
+    running = []
+    now = 0.0
+    free_slots = slot_count
+    while len(pending) > 0 or len(running) > 0:
+        while True:
+            test = next_admissible(pending, free_slots, weight)
+            if test == None:
+                break
+            pending.remove(test)
+            free_slots -= weight(test)
+            heapq.heappush(running, (now + estimates[test.name], test.name, weight(test)))
+        if len(running) == 0:
+            break
+        now, _, w = heapq.heappop(running)
+        free_slots += w
+    return now
+
+
+def load_duration_file(durations_file):
+    '''
+    Load a durations file (JSON dictionary mapping test names to durations).
+    Returns an empty dictionary if the file does not exist or is invalid.
+    '''
+    try:
+        with open(durations_file) as f:
+            durations = json.load(f)
+        return { name: float(d) for name, d in durations.items() if isinstance(d, (int, float)) and d > 0 }
+    except (OSError, ValueError, AttributeError):
+        return {}
+
+
+def write_duration_file(durations_file, durations):
+    '''
+    Write a durations file (JSON dictionary mapping test names to durations) atomically.
+    '''
+    helpers.write_json_file(durations_file, { name: round(d, 3) for name, d in sorted(durations.items()) }, indent=4)
+
+
+def stable_hash(name):
+    '''
+    Return a hash of a test name that is stable across processes and machines.
+    '''
+    return int.from_bytes(hashlib.blake2b(name.encode('utf-8'), digest_size=8).digest(), 'little')
+
+
+def shard_tests(tests, durations, index, count):
+    '''
+    Partition tests into count shards and return the tests in shard index (0-based), keeping the order of tests.
+    Tests with known durations are assigned longest first to the shard with the lowest total duration,
+    the remaining tests are assigned by a stable hash of their name.
+    The partition only depends on the test names and durations, so it is the same on every machine.
+    '''
+    shards = {}
+    loads = [0.0] * count
+    for test in sorted([t for t in tests if t.name in durations], key=lambda t: (-durations[t.name], t.name)):
+        shard = min(range(count), key=lambda i: (loads[i], i))
+        loads[shard] += durations[test.name]
+        shards[test.name] = shard
+    for test in tests:
+        if not test.name in shards:
+            shards[test.name] = stable_hash(test.name) % count
+    return [t for t in tests if shards[t.name] == index]
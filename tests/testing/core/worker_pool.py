@@ -0,0 +1,276 @@
+'''
+Module implementing a pool of persistent Mogwai worker processes.
+
+Starting Mogwai (device creation, plugin loading, shader cache warmup) is
+expensive compared to running many small image tests. The pool keeps a number
+of long-lived Mogwai processes running the mogwai_worker.py script and sends
+them jobs over a local socket (see mogwai_worker.py for the protocol).
+Workers that crash or time out are killed and replaced by new ones on demand.
+'''
+
+import os
+import json
+import itertools
+import socket
+import secrets
+import threading
+import subprocess
+import time
+from pathlib import Path
+
+from . import config, resources, output
+
+
+class WorkerError(Exception):
+    '''
+    Raised if a worker fails to start, crashes or times out.
+    '''
+    pass
+
+
+class WorkerTimeout(WorkerError):
+    '''
+    Raised if a worker does not finish a job within the timeout.
+    '''
+    pass
+
+
+class Worker:
+    '''
+    A single persistent worker process.
+    '''
+
+    def __init__(self, args, device_type, cwd, capture, startup_timeout, add_process=None):
+        '''
+        The output of the worker process is read by capture (see output.OutputCapture).
+        '''
+        self.device_type = device_type
+        self.job_count = 0
+        self.conn = None
+
+        listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        listener.bind(('127.0.0.1', 0))
+        listener.listen(1)
+        port = listener.getsockname()[1]
+        token = secrets.token_hex(16)
+
+        env = os.environ.copy()
+        env[config.WORKER_ADDRESS_ENV] = f'127.0.0.1:{port}:{token}'
+
+        self.capture = capture
+        self.process = subprocess.Popen(args, cwd=cwd, env=env, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        self.capture.start(self.process)
+
+        try:
+            if add_process and not add_process(self.process):
+                raise WorkerError('Process killed due to global exit')
+
+            # Wait for the worker to connect, checking that the process is still alive.
+            deadline = time.time() + startup_timeout
+            listener.settimeout(0.5)
+            while self.conn == None:
+                try:
+                    self.conn, _ = listener.accept()
+                except socket.timeout:
+                    if self.process.poll() != None:
+                        raise WorkerError(f'Worker exited during startup with return code {self.process.returncode}')
+                    if time.time() > deadline:
+                        raise WorkerError('Worker did not connect within startup timeout')
+
+            self.reader = self.conn.makefile('r', encoding='utf-8')
+            self.writer = self.conn.makefile('w', encoding='utf-8')
+            self.conn.settimeout(startup_timeout)
+            hello = self.receive()
+            if hello.get('hello', None) != token:
+                raise WorkerError('Worker sent invalid handshake')
+        except (WorkerError, OSError, ValueError) as e:
+            self.kill()
+            raise e if isinstance(e, WorkerError) else WorkerError(f'Worker failed to start ({e})')
+        finally:
+            listener.close()
+
+    def send(self, message):
+        self.writer.write(json.dumps(message) + '\n')
+        self.writer.flush()
+
+    def receive(self):
+        line = self.reader.readline()
+        if line == '':
+            raise EOFError()
+        return json.loads(line)
+
+    def run(self, job, timeout):
+        '''
+        Run a job on the worker and return the response.
+        Raises WorkerError if the worker crashes or does not respond within the timeout.
+        The worker is killed in that case and must not be used anymore.
+        '''
+        try:
+            self.conn.settimeout(timeout)
+            self.send(job)
+            response = self.receive()
+            if response.get('id', None) != job['id']:
+                raise ValueError('Unexpected response')
+        except socket.timeout:
+            self.kill()
+            raise WorkerTimeout('Process killed due to timeout')
+        except (OSError, EOFError, ValueError):
+            # Give a crashed process a moment to exit to report its return code.
+            try:
+                self.process.wait(timeout=5)
+            except subprocess.TimeoutExpired:
+                pass
+            self.kill()
+            raise WorkerError(f'Worker process crashed (return code {self.process.returncode})')
+        self.job_count += 1
+        return response
+
+    def is_alive(self):
+        return self.process.poll() == None
+
+    def close(self, timeout=10):
+        '''
+        Ask the worker to exit and wait for it (killing it if it does not exit in time).
+        '''
+        try:
+            self.send({ 'exit': True })
+            self.process.wait(timeout=timeout)
+        except (OSError, subprocess.TimeoutExpired):
+            pass
+        self.kill()
+
+    def kill(self):
+        if self.process.poll() == None:
+            self.process.kill()
+            self.process.wait()
+        if self.conn:
+            self.conn.close()
+        self.capture.join(timeout=5)
+
+
+class WorkerPool:
+    '''
+    Pool of persistent worker processes, one set of workers per device type.
+    '''
+
+    def __init__(self, make_args, size, cwd, log_dir, startup_timeout=config.WORKER_STARTUP_TIMEOUT, max_jobs=config.WORKER_MAX_JOBS, add_process=None, output_tail=None, on_timeout=None):
+        '''
+        make_args is a function returning the command line for starting a worker for a given device type.
+        The output of workers is written to log_dir. If output_tail is given, it is called with the name of
+        a worker and returns a function receiving the lines of output of the worker (see output.OutputCapture).
+        If on_timeout is given, it is called whenever a job times out.
+        '''
+        self.make_args = make_args
+        self.size = size
+        self.cwd = cwd
+        self.log_dir = Path(log_dir)
+        self.startup_timeout = startup_timeout
+        self.max_jobs = max_jobs
+        self.add_process = add_process
+        self.output_tail = output_tail
+        self.on_timeout = on_timeout
+
+        self.cond = threading.Condition()
+        self.idle = []
+        self.worker_count = 0
+        self.started_count = 0
+        self.job_ids = itertools.count(1)
+        self.is_shutdown = False
+
+    def acquire(self, device_type):
+        '''
+        Acquire an idle worker for the given device type, starting a new one if possible.
+        '''
+        retired = None
+        with self.cond:
+            while True:
+                if self.is_shutdown:
+                    raise WorkerError('Worker pool is shut down')
+                for worker in self.idle:
+                    if worker.device_type == device_type:
+                        self.idle.remove(worker)
+                        return worker
+                if self.worker_count < self.size:
+                    break
+                # Replace an idle worker of a different device type.
+                if len(self.idle) > 0:
+                    retired = self.idle.pop(0)
+                    break
+                self.cond.wait()
+            if retired == None:
+                self.worker_count += 1
+            self.started_count += 1
+            index = self.started_count
+
+        if retired:
+            retired.close()
+
+        try:
+            name = f'worker_{index}_{device_type}'
+            capture = output.OutputCapture(self.log_dir, prefix=f'{name}.', tail=self.output_tail(name) if self.output_tail else None)
+            return Worker(self.make_args(device_type), device_type, self.cwd, capture, self.startup_timeout, self.add_process)
+        except WorkerError:
+            self.discard()
+            raise
+
+    def release(self, worker):
+        '''
+        Return a worker to the pool (recycling it if it reached the maximum number of jobs).
+        '''
+        if worker.job_count >= self.max_jobs or not worker.is_alive():
+            worker.close()
+            self.discard()
+            return
+        with self.cond:
+            self.idle.append(worker)
+            self.cond.notify()
+
+    def discard(self):
+        '''
+        Account for a worker that has been killed.
+        '''
+        with self.cond:
+            self.worker_count -= 1
+            self.cond.notify()
+
+    def run_job(self, device_type, job, timeout):
+        '''
+        Run a job on a worker of the given device type.
+        Returns a tuple containing a success flag, a list of error messages and the resource usage of the job.
+        The usage is measured on the worker process (Linux only, None otherwise) and its peak resident set
+        size covers the lifetime of the worker.
+        '''
+        job = dict(job, id=next(self.job_ids))
+        try:
+            worker = self.acquire(device_type)
+        except WorkerError as e:
+            return False, [str(e)], None
+
+        usage_before = resources.process_usage(worker.process.pid)
+        # Only report stderr written during this job (workers run many jobs).
+        error_mark = worker.capture.mark()
+        try:
+            response = worker.run(job, timeout)
+        except WorkerError as e:
+            self.discard()
+            if isinstance(e, WorkerTimeout) and self.on_timeout:
+                self.on_timeout()
+            return False, worker.capture.errors(error_mark) + [str(e)], None
+        usage = resources.usage_delta(usage_before, resources.process_usage(worker.process.pid))
+
+        self.release(worker)
+        if not response['success']:
+            return False, (response['error'] or 'Unknown error').splitlines(), usage
+        return True, [], usage
+
+    def shutdown(self):
+        '''
+        Terminate all workers.
+        '''
+        with self.cond:
+            self.is_shutdown = True
+            workers = self.idle
+            self.idle = []
+            self.cond.notify_all()
+        for worker in workers:
+            worker.close()
@@ -0,0 +1,255 @@
+'''
+Module implementing a multi-threaded WSGI server using only the standard library (used by view_image_tests).
+
+Connections are handled by a fixed pool of worker threads, so that slow
+transfers (e.g. large EXR images) do not block other clients. The server
+speaks HTTP/1.1 with persistent connections: responses without a known length
+are sent using chunked transfer encoding, and idle connections are closed after
+a timeout so that they do not occupy workers indefinitely. Text responses (HTML,
+JSON, CSS, JavaScript) are gzip compressed if the client accepts it, and files
+returned through wsgi.file_wrapper are sent using socket.sendfile().
+'''
+
+import io
+import sys
+import gzip
+import socket
+import socketserver
+import concurrent.futures
+from http.server import BaseHTTPRequestHandler
+from urllib.parse import unquote
+
+from . import config
+
+# Content types that are compressed.
+COMPRESSIBLE_TYPES = ['text/html', 'text/plain', 'text/css', 'text/javascript', 'application/javascript', 'application/json']
+
+# Minimum size (in bytes) of compressed responses.
+MIN_COMPRESS_SIZE = 1024
+
+# Size (in bytes) of blocks read from files when sendfile() is not available and of chunks read from request bodies.
+BLOCK_SIZE = 256 * 1024
+
+
+class FileWrapper:
+    '''
+    Wrapper for file-like objects returned by applications (wsgi.file_wrapper).
+    Iterating the wrapper reads the file in blocks, the server sends it using sendfile() if possible.
+    '''
+
+    def __init__(self, file, block_size=BLOCK_SIZE):
+        self.file = file
+        self.block_size = block_size
+
+    def __iter__(self):
+        return iter(lambda: self.file.read(self.block_size), b'')
+
+    def close(self):
+        if hasattr(self.file, 'close'):
+            self.file.close()
+
+
+class InputReader(io.RawIOBase):
+    '''
+    Reader for the body of a request, limited to its Content-Length (wsgi.input).
+    '''
+
+    def __init__(self, rfile, length):
+        self.rfile = rfile
+        self.remaining = length
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        size = min(len(buffer), self.remaining)
+        if size <= 0:
+            return 0
+        data = self.rfile.read(size)
+        buffer[0:len(data)] = data
+        self.remaining -= len(data)
+        return len(data)
+
+    def drain(self):
+        while self.remaining > 0 and self.read(BLOCK_SIZE):
+            pass
+
+
+class WSGIRequestHandler(BaseHTTPRequestHandler):
+    '''
+    Handles the requests of a single (persistent) connection.
+    '''
+    protocol_version = 'HTTP/1.1'
+    server_version = 'FalcorViewer/1.0'
+
+    def setup(self):
+        self.timeout = self.server.keep_alive_timeout
+        super().setup()
+
+    def log_message(self, format, *args):
+        if not self.server.quiet:
+            super().log_message(format, *args)
+
+    def make_environ(self, input):
+        path, _, query = self.path.partition('?')
+        environ = {
+            'REQUEST_METHOD': self.command,
+            'SCRIPT_NAME': '',
+            'PATH_INFO': unquote(path, 'iso-8859-1'),
+            'QUERY_STRING': query,
+            'CONTENT_TYPE': self.headers.get('Content-Type', ''),
+            'CONTENT_LENGTH': self.headers.get('Content-Length', ''),
+            'REMOTE_ADDR': self.client_address[0],
+            'SERVER_NAME': self.server.server_name,
+            'SERVER_PORT': str(self.server.server_port),
+            'SERVER_PROTOCOL': self.request_version,
+            'wsgi.version': (1, 0),
+            'wsgi.url_scheme': 'http',
+            'wsgi.input': input,
+            'wsgi.errors': sys.stderr,
+            'wsgi.multithread': True,
+            'wsgi.multiprocess': False,
+            'wsgi.run_once': False,
+            'wsgi.file_wrapper': FileWrapper
+        }
+        for name, value in self.headers.items():
+            name = 'HTTP_' + name.upper().replace('-', '_')
+            if not name in ['HTTP_CONTENT_TYPE', 'HTTP_CONTENT_LENGTH']:
+                environ[name] = environ[name] + ',' + value if name in environ else value
+        return environ
+
+    def handle_request(self):
+        try:
+            length = int(self.headers.get('Content-Length', 0) or 0)
+        except ValueError:
+            self.send_error(400, 'Invalid Content-Length')
+            return
+        input = InputReader(self.rfile, length)
+        environ = self.make_environ(io.BufferedReader(input))
+
+        response = {}
+        def start_response(status, headers, exc_info=None):
+            if exc_info and response.get('sent', False):
+                raise exc_info[1].with_traceback(exc_info[2])
+            response['status'] = status
+            response['headers'] = headers
+            return lambda data: response.setdefault('written', []).append(data)
+
+        result = self.server.app(environ, start_response)
+        try:
+            # Read the rest of the request body to keep the connection usable.
+            input.drain()
+            self.send_result(environ, response, result)
+        finally:
+            if hasattr(result, 'close'):
+                result.close()
+
+    do_GET = do_HEAD = do_POST = do_PUT = do_DELETE = do_PATCH = do_OPTIONS = handle_request
+
+    def send_result(self, environ, response, result):
+        status = response['status']
+        code = int(status.split(' ', 1)[0])
+        headers = [(k, v) for k, v in response['headers'] if k.lower() not in ['connection', 'transfer-encoding']]
+        header_dict = { k.lower(): v for k, v in headers }
+        has_body = self.command != 'HEAD' and code >= 200 and not code in [204, 304]
+        written = response.get('written', [])
+
+        # Compress text responses (buffering them, they are small).
+        content_type = header_dict.get('content-type', '').split(';')[0].strip().lower()
+        accept_encoding = environ.get('HTTP_ACCEPT_ENCODING', '')
+        if content_type in COMPRESSIBLE_TYPES and not 'content-encoding' in header_dict:
+            # Responses differ by Accept-Encoding (also matters for 304 responses and uncompressed clients).
+            vary = [v.strip() for v in header_dict.get('vary', '').split(',') if v.strip()]
+            if not 'accept-encoding' in [v.lower() for v in vary]:
+                headers = [(k, v) for k, v in headers if k.lower() != 'vary'] + [('Vary', ', '.join(vary + ['Accept-Encoding']))]
+            if has_body and code == 200 and 'gzip' in accept_encoding:
+                body = b''.join(written) + b''.join(result)
+                headers = [(k, v) for k, v in headers if k.lower() != 'content-length']
+                if len(body) >= MIN_COMPRESS_SIZE:
+                    body = gzip.compress(body, config.VIEWER_GZIP_LEVEL)
+                    headers.append(('Content-Encoding', 'gzip'))
+                headers.append(('Content-Length', str(len(body))))
+                written = [body]
+                result = []
+            header_dict = { k.lower(): v for k, v in headers }
+
+        chunked = has_body and not 'content-length' in header_dict
+        if chunked and self.request_version != 'HTTP/1.1':
+            # HTTP/1.0 clients do not support chunked encoding, end the response by closing the connection.
+            chunked = False
+            self.close_connection = True
+        if self.close_connection:
+            headers.append(('Connection', 'close'))
+        elif self.request_version == 'HTTP/1.0':
+            headers.append(('Connection', 'keep-alive'))
+        if chunked:
+            headers.append(('Transfer-Encoding', 'chunked'))
+
+        response['sent'] = True
+        self.send_response_only(code, status.split(' ', 1)[1] if ' ' in status else '')
+        self.send_header('Server', self.version_string())
+        self.send_header('Date', self.date_time_string())
+        for name, value in headers:
+            self.send_header(name, value)
+        self.end_headers()
+
+        if not has_body:
+            return
+        if isinstance(result, FileWrapper) and not written and not chunked and hasattr(result.file, 'fileno'):
+            self.send_file(result.file, int(header_dict['content-length']))
+            return
+        for data in written + [result]:
+            for block in ([data] if isinstance(data, bytes) else data):
+                if not block:
+                    continue
+                if chunked:
+                    self.wfile.write(f'{len(block):x}\r\n'.encode() + block + b'\r\n')
+                else:
+                    self.wfile.write(block)
+        if chunked:
+            self.wfile.write(b'0\r\n\r\n')
+
+    def send_file(self, file, length):
+        self.wfile.flush()
+        try:
+            offset = file.tell()
+            self.connection.sendfile(file, offset, length)
+        except (AttributeError, io.UnsupportedOperation):
+            for block in iter(lambda: file.read(BLOCK_SIZE), b''):
+                self.wfile.write(block)
+
+
+class ThreadPoolWSGIServer(socketserver.TCPServer):
+    '''
+    WSGI server handling connections on a pool of worker threads.
+    '''
+    allow_reuse_address = True
+
+    def __init__(self, host, port, app, workers=config.VIEWER_SERVER_WORKERS, keep_alive_timeout=config.VIEWER_KEEP_ALIVE_TIMEOUT, quiet=True):
+        self.app = app
+        self.keep_alive_timeout = keep_alive_timeout
+        self.quiet = quiet
+        self.executor = concurrent.futures.ThreadPoolExecutor(workers, thread_name_prefix='wsgi')
+        super().__init__((host, port), WSGIRequestHandler)
+        self.server_name = socket.getfqdn(host)
+        self.server_port = self.server_address[1]
+
+    def process_request(self, request, client_address):
+        self.executor.submit(self.process_request_thread, request, client_address)
+
+    def process_request_thread(self, request, client_address):
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+
+    def handle_error(self, request, client_address):
+        # Clients closing connections early are expected (e.g. cancelled image downloads).
+        if not isinstance(sys.exc_info()[1], (ConnectionError, socket.timeout)):
+            super().handle_error(request, client_address)
+
+    def server_close(self):
+        super().server_close()
+        self.executor.shutdown(wait=False)
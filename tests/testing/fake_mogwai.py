@@ -0,0 +1,100 @@
+'''
+Stand-in for Mogwai used to exercise the test harness (persistent workers,
+scene batches) without a GPU.
+
+It accepts the Mogwai command line arguments used by the test harness and runs
+the given script with a minimal fake 'm' object and 'falcor' module. Fake test
+scripts can call m.frameCapture.capture() to write a small gray PNG image, and
+use os._exit() or time.sleep() to simulate crashes and hangs, e.g.:
+
+  pool = WorkerPool(lambda device_type: [sys.executable, 'fake_mogwai.py', '--script', 'mogwai_worker.py'], ...)
+'''
+
+import os
+import sys
+import zlib
+import types
+import struct
+import argparse
+from pathlib import Path
+
+
+class FakeFrameCapture:
+    def __init__(self):
+        self.outputDir = '.'
+        self.baseFilename = 'Mogwai'
+
+    def capture(self):
+        path = Path(self.outputDir) / f'{self.baseFilename}.fake.png'
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_bytes(gray_png(4, 4))
+
+
+def gray_png(width, height):
+    '''
+    Encode a gray 8-bit PNG image.
+    '''
+    def chunk(tag, data):
+        return struct.pack('>I', len(data)) + tag + data + struct.pack('>I', zlib.crc32(tag + data))
+    rows = b''.join(b'\x00' + b'\x80' * width for _ in range(height))
+    header = struct.pack('>IIBBBBB', width, height, 8, 0, 0, 0, 0)
+    return b'\x89PNG\r\n\x1a\n' + chunk(b'IHDR', header) + chunk(b'IDAT', zlib.compress(rows)) + chunk(b'IEND', b'')
+
+
+class FakeMogwai:
+    def __init__(self, namespace):
+        self.namespace = namespace
+        self.frameCapture = FakeFrameCapture()
+        self.activeGraph = None
+        self.scene = None
+
+    def script(self, path):
+        # Mogwai reports script errors as RuntimeError.
+        try:
+            run_script(path, self.namespace)
+        except Exception as e:
+            raise RuntimeError(f'Error when loading configuration file: {path}\n{e}')
+
+    def loadScene(self, path, buildFlags=None):
+        self.scene = path
+
+    def removeGraph(self, graph):
+        self.activeGraph = None
+
+    def unloadScene(self):
+        self.scene = None
+
+
+def run_script(path, namespace):
+    with open(path) as f:
+        code = compile(f.read(), str(path), 'exec')
+    # Mogwai sets __file__ while running a script file.
+    namespace['__file__'] = os.path.abspath(path)
+    try:
+        exec(code, namespace)
+    finally:
+        namespace['__file__'] = None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('-s', '--script', type=str, action='store', required=True)
+    parser.add_argument('-d', '--device-type', type=str, action='store')
+    parser.add_argument('-l', '--logfile', type=str, action='store')
+    parser.add_argument('--headless', action='store_true')
+    parser.add_argument('--precise', action='store_true')
+    args = parser.parse_args()
+
+    falcor = types.ModuleType('falcor')
+    falcor.exit = lambda errorCode=0: sys.exit(errorCode)
+    falcor.Logger = types.SimpleNamespace(log_file_path=args.logfile)
+    sys.modules['falcor'] = falcor
+
+    # Mogwai imports the falcor module into the global namespace.
+    namespace = { '__name__': '__main__', 'falcor': falcor, 'exit': falcor.exit }
+    namespace['m'] = FakeMogwai(namespace)
+    run_script(args.script, namespace)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,142 @@
+'''
+Frontend for merging the reports of image test runs split into shards.
+
+Every shard run (see run_image_tests --shard) writes its own result directory
+containing a run report and the reports and images of its tests. This tool
+combines the shard result directories into a single run directory that can be
+browsed with view_image_tests, and optionally merges the XML reports and
+updates the durations file used for balancing shards.
+'''
+
+import sys
+import json
+import shutil
+import argparse
+from pathlib import Path
+from xml.etree import ElementTree as ET
+
+from core import config, scheduling, reports
+
+project_dir = Path(__file__).parents[2].resolve()
+
+
+def load_json(path):
+    '''
+    Load a JSON file or return None if not successful.
+    '''
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def merge_compare_stats(stats_list):
+    '''
+    Merge image comparison statistics by summing up all values.
+    '''
+    merged = {}
+    for stats in stats_list:
+        for key, value in stats.items():
+            merged[key] = merged.get(key, 0) + value
+    return merged
+
+
+def merge_run_dirs(shard_dirs, output_dir):
+    '''
+    Merge the result directories of shard runs into output_dir.
+    Returns the merged run report or None if a shard run report is missing.
+    '''
+    shard_reports = []
+    for shard_dir in shard_dirs:
+        report = load_json(shard_dir / 'report.json')
+        if report == None:
+            print(f'Run report "{shard_dir / "report.json"}" is missing or invalid.')
+            return None
+        shard_reports.append(report)
+
+    output_dir.mkdir(parents=True, exist_ok=True)
+
+    # Copy test results.
+    test_names = []
+    for shard_dir, report in zip(shard_dirs, shard_reports):
+        for name in report['tests']:
+            if name in test_names:
+                print(f'Test "{name}" is contained in multiple shards, using results from "{shard_dir}".')
+            else:
+                test_names.append(name)
+            src_dir = shard_dir / name
+            if src_dir.exists() and src_dir.resolve() != (output_dir / name).resolve():
+                shutil.copytree(src_dir, output_dir / name, dirs_exist_ok=True)
+
+    # Shards run in parallel, so the duration of the merged run is the longest shard duration.
+    merged = {
+        'date': min(r['date'] for r in shard_reports),
+        'result': 'PASSED' if all(r['result'] == 'PASSED' for r in shard_reports) else 'FAILED',
+        'tests': test_names,
+        'duration': max(r['duration'] for r in shard_reports),
+        'compare_stats': merge_compare_stats([r['compare_stats'] for r in shard_reports if 'compare_stats' in r]),
+        'reused_tests': sum(r.get('reused_tests', 0) for r in shard_reports),
+        'shards': [{ 'shard': r.get('shard', None), 'result': r['result'], 'duration': r['duration'], 'tests': len(r['tests']) } for r in shard_reports]
+    }
+
+    reports.write_json(output_dir / 'report.json', merged)
+
+    return merged
+
+
+def merge_xml_reports(xml_files, output_file):
+    '''
+    Merge XML (JUnit) reports into a single test suite.
+    '''
+    testcases = []
+    for xml_file in xml_files:
+        testcases += ET.parse(xml_file).getroot().iter('testcase')
+    reports.write_xml_testsuite(output_file, testcases)
+
+
+def collect_durations(run_dir, test_names):
+    '''
+    Collect the durations of tests from their reports in a run directory.
+    '''
+    durations = {}
+    for name in test_names:
+        report = load_json(run_dir / name / 'report.json')
+        if report and isinstance(report.get('duration', None), (int, float)) and report.get('result', None) != 'SKIPPED':
+            durations[name] = report['duration']
+    return durations
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('shard_dirs', type=str, nargs='+', help='Result directories of the shard runs')
+    parser.add_argument('-o', '--output', type=str, action='store', required=True, help='Result directory of the merged run')
+    parser.add_argument('--xml-reports', type=str, nargs='*', help='XML report files of the shard runs', default=[])
+    parser.add_argument('-x', '--xml-report', type=str, action='store', help='Merged XML report output file')
+    parser.add_argument('--update-durations', type=str, nargs='?', const=config.SHARD_DURATIONS_FILE, help=f'Update durations file used for balancing shards with the durations of the merged run (default: {config.SHARD_DURATIONS_FILE})')
+    args = parser.parse_args()
+
+    shard_dirs = [Path(d) for d in args.shard_dirs]
+    output_dir = Path(args.output)
+
+    merged = merge_run_dirs(shard_dirs, output_dir)
+    if merged == None:
+        sys.exit(1)
+    print(f'Merged {len(merged["tests"])} tests from {len(shard_dirs)} shards into {output_dir} ({merged["result"]}).')
+
+    if args.xml_report:
+        merge_xml_reports(args.xml_reports, args.xml_report)
+        print(f'Merged {len(args.xml_reports)} XML reports into {args.xml_report}.')
+
+    if args.update_durations:
+        durations_file = project_dir / args.update_durations
+        durations = scheduling.load_duration_file(durations_file)
+        durations.update(collect_durations(output_dir, merged['tests']))
+        scheduling.write_duration_file(durations_file, durations)
+        print(f'Updated durations of {len(merged["tests"])} tests in {durations_file}.')
+
+    sys.exit(0 if merged['result'] == 'PASSED' else 1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,118 @@
+'''
+Module for running image test scripts as jobs inside a Mogwai process.
+
+This module is imported by scripts running inside Mogwai (mogwai_worker.py and
+the scripts generated for scene batches) and must only depend on falcor and the
+standard library.
+
+A job is a dictionary containing the working directory ("cwd"), the script to
+run ("script"), the log file ("log_file") and the run only flag ("run_only").
+Test scripts call exit() when done, which is intercepted to only abort the
+current job. After each job the Mogwai state (render graphs, scene), the python
+globals, sys.path and all modules imported by the job are reset, so that jobs
+do not observe each other's state.
+'''
+
+import os
+import sys
+import json
+import time
+import traceback
+import falcor
+
+
+class JobExit(Exception):
+    pass
+
+
+class JobRunner:
+    '''
+    Runs jobs in the global namespace of a Mogwai process.
+    '''
+
+    def __init__(self, renderer, namespace):
+        self.renderer = renderer
+        self.namespace = namespace
+        self.exited = False
+
+        # Replace exit() with a function aborting the current job only.
+        self.original_exit = falcor.exit
+        falcor.exit = self.exit
+        namespace['exit'] = self.exit
+
+        self.initial_globals = dict(namespace)
+        self.initial_modules = set(sys.modules.keys())
+        self.initial_path = list(sys.path)
+        self.initial_cwd = os.getcwd()
+
+    def exit(self, errorCode=0):
+        self.exited = True
+        raise JobExit()
+
+    def run(self, job):
+        '''
+        Run a job.
+        Returns a tuple containing the error message (None on success) and the duration.
+        '''
+        start_time = time.time()
+        error = None
+        self.exited = False
+
+        try:
+            falcor.Logger.log_file_path = job['log_file']
+            os.chdir(job['cwd'])
+            sys.path.insert(0, job['cwd'])
+            if job.get('run_only', False):
+                falcor.__dict__['IMAGE_TEST_RUN_ONLY'] = True
+            self.renderer.script(job['script'])
+        except JobExit:
+            pass
+        except Exception as e:
+            # Mogwai reports exceptions raised by scripts as RuntimeError, including JobExit.
+            if not self.exited:
+                error = ''.join(traceback.format_exception_only(type(e), e)).strip()
+
+        self.reset()
+        try:
+            while self.renderer.activeGraph:
+                self.renderer.removeGraph(self.renderer.activeGraph)
+            self.renderer.unloadScene()
+        except Exception as e:
+            error = error or f'Failed to reset Mogwai state: {e}'
+
+        return error, time.time() - start_time
+
+    def reset(self):
+        '''
+        Reset the python state to the state before the first job.
+        '''
+        falcor.__dict__.pop('IMAGE_TEST_RUN_ONLY', None)
+        falcor.exit = self.exit
+        for name in set(self.namespace.keys()) - set(self.initial_globals.keys()):
+            del self.namespace[name]
+        self.namespace.update(self.initial_globals)
+        for name in set(sys.modules.keys()) - self.initial_modules:
+            del sys.modules[name]
+        sys.path[:] = self.initial_path
+        os.chdir(self.initial_cwd)
+
+    def close(self):
+        '''
+        Restore the original exit() function.
+        '''
+        falcor.exit = self.original_exit
+        self.namespace['exit'] = self.original_exit
+
+
+def run_batch(renderer, namespace, jobs):
+    '''
+    Run a list of jobs in sequence.
+    Each job has an additional "result_file" entry. The result of the job is written to that file
+    as soon as the job finishes, so that results can be attributed to jobs if the process dies.
+    '''
+    runner = JobRunner(renderer, namespace)
+    for job in jobs:
+        error, duration = runner.run(job)
+        with open(job['result_file'], 'w') as f:
+            json.dump({ 'success': error == None, 'error': error, 'duration': duration }, f)
+    runner.close()
@@ -0,0 +1,50 @@
+'''
+Script run inside a persistent Mogwai process to execute image test jobs.
+
+The script connects to the address given in the FALCOR_TEST_WORKER environment
+variable (host:port:token) and processes jobs until it is told to exit.
+Messages are JSON objects, one per line, in both directions:
+
+  worker -> harness: { "hello": <token>, "pid": <pid> }
+  harness -> worker: { "id": <id>, "cwd": <dir>, "script": <file>, "log_file": <file>, "run_only": <bool> }
+  worker -> harness: { "id": <id>, "success": <bool>, "error": <message or null>, "duration": <seconds> }
+  harness -> worker: { "exit": true }
+
+Jobs are run using mogwai_jobs.JobRunner, which resets the Mogwai and python
+state between jobs. Jobs run in the same global namespace as this script, so
+the worker only relies on local variables.
+'''
+
+def worker_main():
+    import os
+    import sys
+    import json
+    import socket
+
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    import mogwai_jobs
+
+    host, port, token = os.environ['FALCOR_TEST_WORKER'].rsplit(':', 2)
+    conn = socket.create_connection((host, int(port)))
+    reader = conn.makefile('r', encoding='utf-8')
+    writer = conn.makefile('w', encoding='utf-8')
+
+    def send(message):
+        writer.write(json.dumps(message) + '\n')
+        writer.flush()
+
+    send({ 'hello': token, 'pid': os.getpid() })
+
+    runner = mogwai_jobs.JobRunner(m, globals())
+
+    for line in reader:
+        job = json.loads(line)
+        if job.get('exit', False):
+            break
+        error, duration = runner.run(job)
+        send({ 'id': job['id'], 'success': error == None, 'error': error, 'duration': duration })
+
+    conn.close()
+
+
+worker_main()
@@ -5,10 +5,14 @@ Frontend for running image tests.
 import os
 import sys
 import re
+import ast
 import json
 import time
 import datetime
 import argparse
+import queue
+import itertools
+import fnmatch
 import subprocess
 import shutil
 from pathlib import Path
@@ -18,9 +22,11 @@ import concurrent.futures
 import multiprocessing
 import signal
 import threading
-from xml.etree import ElementTree as ET
 
-from core import Environment, helpers, config
+from core import Environment, helpers, config, image_compare
+from core import incremental as core_incremental
+from core import concurrency as core_concurrency
+from core import dependencies, scheduling, worker_pool, batching, pipeline, reports, resources, output, refstore, mirror, metric_maps
 from core.environment import find_most_recent_build_config
 from core.termcolor import colored
 
@@ -32,9 +38,14 @@ class ProcessController:
     all_processes = {}
     thread_count = 1
 
-    def __init__(self, thread_count):
+    def __init__(self, thread_count, verbose=False):
 
         self.thread_count = thread_count
+        self.verbose = verbose
+        self.used_slots = 0
+        self.busy_time = 0.0
+        self.worker_pool = None
+        self.concurrency = None
 
         def signal_handler(signum, frame):
             with self.all_processes_mutex:
@@ -64,34 +75,85 @@ class ProcessController:
             self.all_processes[name] = p
             return True
 
+    def free_slots(self):
+        return self.thread_count - self.used_slots
+
+    def record_timeout(self):
+        if self.concurrency:
+            self.concurrency.timed_out()
+
+    def output_tail(self, name):
+        '''
+        Return a function printing the output of a process live in verbose mode (None otherwise).
+        '''
+        if not self.verbose:
+            return None
+        def tail(stream, line):
+            with print_mutex:
+                print(f'    [{name}] ' + (colored(line, 'red') if stream == 'stderr' else line))
+        return tail
+
+    def run_parallel(self, tests, func):
+        '''
+        Run func(test) for a list of tests in parallel.
+        The number of slots (thread_count) is the budget, and each test occupies as many slots as its weight.
+        Tests are admitted in the given order while their total weight fits the budget.
+        Yields the results in order of completion. The time slots are occupied is accumulated in busy_time.
+        The time each test waited for free slots is stored in its queue_time attribute.
+        With adaptive concurrency (--parallel auto), the number of slots is updated by the controller
+        while tests are running.
+        '''
+        queue_start_time = time.time()
+        pending = list(tests)
+        running = {}
+        max_threads = self.concurrency.max_slots if self.concurrency else self.thread_count
+        with concurrent.futures.ThreadPoolExecutor(max_threads) as executor:
+            try:
+                while len(pending) > 0 or len(running) > 0:
+                    # Admit tests fitting into the free slots.
+                    while not self.is_interrupted():
+                        test = scheduling.next_admissible(pending, self.free_slots(), lambda t: t.slot_weight(self.thread_count))
+                        if test == None:
+                            break
+                        pending.remove(test)
+                        test.queue_time = time.time() - queue_start_time
+                        weight = test.slot_weight(self.thread_count)
+                        self.used_slots += weight
+                        running[executor.submit(func, test)] = (test, time.time(), weight)
+                    if self.is_interrupted():
+                        pending = []
+                    if len(running) == 0:
+                        break
+
+                    # Wake up periodically to let the controller adjust the number of slots.
+                    done, _ = concurrent.futures.wait(running, timeout=1 if self.concurrency else None, return_when=concurrent.futures.FIRST_COMPLETED)
+                    for future in done:
+                        test, start_time, weight = running.pop(future)
+                        self.used_slots -= weight
+                        self.busy_time += (time.time() - start_time) * weight
+                        if self.concurrency:
+                            self.concurrency.completed(len(test.tests) if isinstance(test, TestBatch) else 1)
+                        yield future.result()
+                    if self.concurrency:
+                        self.thread_count = self.concurrency.update()
+            except KeyboardInterrupt:
+                self.interrupt_and_exit()
+                raise
+
 def read_header(script_file):
     '''
-    Check if script has a IMAGE_TEST dictionary defined at the top and return it's content.
-    '''
-    with open(script_file) as f:
-        script = f.read()
-        # Find IMAGE_TEST={} at the top of the script
-        m = re.match(r'IMAGE_TEST\s*=\s*({.*})', script, re.DOTALL)
-        if m:
-            header = None
-            # Match curly braces
-            depth = 0
-            for i, c in enumerate(m.group(1)):
-                if c == '{':
-                    depth += 1
-                if c == '}':
-                    depth -= 1
-                    if depth == 0:
-                        header = m.group(1)[0:i+1]
-                        break
-            if depth != 0:
-                raise Exception(f'Failed to parse script header in {script_file} (curly braces do not match)')
-            # Evaluate dictionary
-            if header:
-                try:
-                    return eval(header)
-                except Exception as e:
-                    raise Exception(f'Failed to parse script header in {script_file} ({e})')
+    Check if script has a IMAGE_TEST dictionary defined as its first assignment and return it's content.
+    The dictionary is evaluated as a literal, so it cannot contain any expressions.
+    '''
+    try:
+        tree = ast.parse(Path(script_file).read_bytes(), filename=str(script_file))
+        for node in tree.body:
+            if isinstance(node, ast.Assign):
+                if len(node.targets) == 1 and isinstance(node.targets[0], ast.Name) and node.targets[0].id == 'IMAGE_TEST':
+                    return ast.literal_eval(node.value)
+                break
+    except (SyntaxError, ValueError) as e:
+        raise Exception(f'Failed to parse script header in {script_file} ({e})')
 
     return {}
 
@@ -140,12 +202,40 @@ class Test:
         # Get tolerance.
         self.tolerance = self.header.get('tolerance', config.DEFAULT_TOLERANCE)
 
+        # Get options for statistical comparison of noisy images (None if disabled).
+        statistical = self.header.get('statistical', False)
+        if statistical == True:
+            statistical = {}
+        self.statistical = dict(config.STATISTICAL_COMPARE_DEFAULTS, **statistical) if statistical != False else None
+        if self.statistical and not isinstance(self.statistical['outputs'], list):
+            self.statistical['outputs'] = [self.statistical['outputs']]
+
         # Get timeout.
         self.timeout = self.header.get('timeout', config.DEFAULT_TIMEOUT)
 
+        # Get resource weight (number of parallel slots occupied) and exclusive flag.
+        self.weight = self.header.get('weight', config.DEFAULT_WEIGHT)
+        if not isinstance(self.weight, int) or isinstance(self.weight, bool) or self.weight < 1:
+            raise Exception(f'Invalid weight {self.weight!r} in script header in {script_file} (expected a positive integer)')
+        self.exclusive = self.header.get('exclusive', False)
+
+        # Resource usage of the last image generation and time spent waiting for slots and comparison threads.
+        self.usage = None
+        self.queue_time = 0.0
+        self.compare_queue_time = 0.0
+
     def __repr__(self):
         return f'Test(name={self.name},script_file={self.script_file})'
 
+    def slot_weight(self, slot_count):
+        '''
+        Return the number of slots the test occupies given the total number of slots.
+        Exclusive tests occupy all slots, the weight of other tests is clamped to the number of slots.
+        '''
+        if self.exclusive:
+            return slot_count
+        return min(self.weight, slot_count)
+
     def matches_tags(self, tags):
         '''
         Check if the test's tags matches any of the given tags.
@@ -155,6 +245,17 @@ class Test:
                 return True
         return False
 
+    def statistical_options(self, image):
+        '''
+        Return the options of the statistical comparison of an image or None if the image is compared
+        against the tolerance (statistical comparison is disabled or the image matches none of the output patterns).
+        '''
+        if self.statistical == None:
+            return None
+        if not any(fnmatch.fnmatchcase(Path(image).name, pattern) for pattern in self.statistical['outputs']):
+            return None
+        return self.statistical
+
     def collect_images(self, image_dir):
         '''
         Collect all reference and result images in a directory.
@@ -163,22 +264,15 @@ class Test:
         files = image_dir.iterdir()
         files = map(lambda f: f.relative_to(image_dir), files)
         files = filter(lambda f: not str(f).endswith(config.ERROR_IMAGE_SUFFIX), files)
+        files = filter(lambda f: not f.stem.endswith((config.VARIANCE_IMAGE_SUFFIX, config.SECOND_CAPTURE_SUFFIX)), files)
         files = filter(lambda f: f.suffix.lower() in config.IMAGE_EXTENSIONS, files)
         return list(files)
 
-    def generate_images(self, output_dir, mogwai_exe, run_only=False):
+    def prepare_run(self, output_dir, mogwai_exe, run_only):
         '''
-        Run Mogwai to generate a set of images and store them in output_dir.
-        Returns a tuple containing the result code and a list of messages.
+        Write the helper script for running the test to output_dir (the full output directory of the test).
+        Returns a tuple containing the working directory, the helper script and the command line for running Mogwai.
         '''
-        # Bail out if test is skipped.
-        if self.skipped:
-            return Test.Result.SKIPPED, [self.skip_message] if self.skip_message != '' else [], {}
-
-        # Determine full output directory.
-        output_dir = output_dir / self.test_dir
-        output_dir.mkdir(parents=True, exist_ok=True)
-
         # In order to simplify module imports in test scripts, we run Mogwai with
         # a working directory set to the directory the test script resides in.
         # The working directory also specifies the python search path.
@@ -197,7 +291,6 @@ class Test:
             f.write(f'm.frameCapture.outputDir = r"{output_dir}"\n')
             f.write(f'm.script(r"{relative_to_cwd(self.script_file)}")\n')
 
-        # Run Mogwai to generate images.
         args = [
             str(mogwai_exe),
             '--device-type', str(self.device_type),
@@ -206,22 +299,56 @@ class Test:
             '--headless',
             '--precise'
         ]
+        return cwd, generate_file, args
+
+    def generate_images(self, output_dir, mogwai_exe, run_only=False):
+        '''
+        Run Mogwai to generate a set of images and store them in output_dir.
+        Returns a tuple containing the result code and a list of messages.
+        '''
+        # Bail out if test is skipped.
+        if self.skipped:
+            return Test.Result.SKIPPED, [self.skip_message] if self.skip_message != '' else [], {}
+
+        # Determine full output directory.
+        output_dir = output_dir / self.test_dir
+        output_dir.mkdir(parents=True, exist_ok=True)
+
+        # Write helper script and run Mogwai to generate images.
+        cwd, generate_file, args = self.prepare_run(output_dir, mogwai_exe, run_only)
         rerun_env = {}
         rerun_env["cwd"] = str(cwd)
         rerun_env["args"] = args[1:]
+        self.usage = None
+
+        # Run job on a persistent worker if available.
+        pool = self.process_controller.worker_pool
+        if pool:
+            job = { 'cwd': str(cwd), 'script': str(generate_file), 'log_file': str(output_dir / 'log.txt'), 'run_only': run_only }
+            success, errors, self.usage = pool.run_job(self.device_type, job, self.timeout)
+            if not success:
+                return Test.Result.FAILED, errors, rerun_env
+            if not run_only and len(self.collect_images(output_dir)) == 0:
+                return Test.Result.FAILED, ['Test did not generate any images.'], rerun_env
+            return Test.Result.PASSED, [], rerun_env
+
+        # Stream stdout/stderr to log files in the output directory, only keeping the last lines of stderr.
         p = subprocess.Popen(args, cwd=cwd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
         if not self.process_controller.add_process(self.name + ":run", p):
             return Test.Result.FAILED, ['Process killed due to global exit'], rerun_env
+        capture = output.OutputCapture(output_dir, tail=self.process_controller.output_tail(self.name))
         try:
-            outs, errs = p.communicate(timeout=self.timeout)
+            _, _, self.usage = resources.communicate(p, self.timeout, capture)
         except subprocess.TimeoutExpired:
             p.kill()
-            return Test.Result.FAILED, ['Process killed due to timeout'], rerun_env
+            p.wait()
+            capture.join(timeout=5)
+            self.process_controller.record_timeout()
+            return Test.Result.FAILED, capture.errors() + ['Process killed due to timeout'], rerun_env
 
         # Check for success.
         if p.returncode != 0:
-            # Generate list of errors from stderr.
-            errors = list(map(lambda l: l.rstrip(), errs.decode('utf-8').splitlines()))
+            errors = capture.errors()
             return Test.Result.FAILED, errors + [f'{mogwai_exe} exited with return code {p.returncode}'], rerun_env
 
         # Bail out if no images have been generated.
@@ -230,9 +357,9 @@ class Test:
 
         return Test.Result.PASSED, [], rerun_env
 
-    def compare_images(self, ref_dir, result_dir, image_compare_exe):
+    def compare_images(self, ref_dir, result_dir, image_comparator):
         '''
-        Run ImageCompare on a set of images in ref_dir and result_dir.
+        Compare a set of images in ref_dir and result_dir using the image comparator.
         Checks if error between reference and result image is within a given tolerance.
         Returns a tuple containing the result code, a list of messages and a list of image reports.
         '''
@@ -263,7 +390,8 @@ class Test:
         image_reports = []
 
         # Compare every result image with the corresponding reference image and report missing references.
-        processes = {}
+        images = []
+        jobs = []
         for image in result_images:
             if not image in ref_images:
                 result = Test.Result.FAILED
@@ -272,31 +400,46 @@ class Test:
 
             ref_file = ref_dir / image
             result_file = result_dir / image
-            error_file = result_dir / (str(image) + config.ERROR_IMAGE_SUFFIX)
+            # Error images are not written when comparisons stop early.
+            error_file = result_dir / (str(image) + config.ERROR_IMAGE_SUFFIX) if not image_comparator.early_exit else None
 
-            args = [str(image_compare_exe), '-m', 'mse', '-t', str(self.tolerance), str(ref_file), str(result_file)]
-            if error_file:
-                args += ['-e', str(error_file)]
-            processes[image] = subprocess.Popen(args, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
-            if not self.process_controller.add_process(self.name + ":image:" + str(image), processes[image]):
-                return Test.Result.FAILED, ['Process killed due to global exit']
+            images.append(image)
+            jobs.append((ref_file, result_file, self.tolerance, error_file, self.statistical_options(image)))
 
-        for image, process in processes.items():
+        add_process = lambda p: self.process_controller.add_process(self.name + ":image:" + str(p.pid), p)
+        compare_results = image_comparator.compare_batch(jobs, add_process=add_process)
 
-            output = process.communicate()[0]
-            compare_success =  process.returncode == 0
-            compare_error = float(output.strip())
+        for image, job, compare_result in zip(images, jobs, compare_results):
+            compare_success = compare_result['success']
+            compare_error = compare_result['error']
 
             if not compare_success:
                 result = Test.Result.FAILED
-                messages.append(f'Test image "{image}" failed with error {compare_error}.')
-
-            image_reports.append({
+                if compare_result['message']:
+                    messages.append(f'Test image "{image}" failed to compare ({compare_result["message"]}).')
+                elif compare_result['method'] == 'statistical':
+                    messages.append(f'Test image "{image}" differs significantly in {compare_result["rejected_tiles"]} of {compare_result["tiles"]} tiles (max z-score {compare_error:.2f}).')
+                elif compare_result.get('early_exit', False):
+                    messages.append(f'Test image "{image}" failed with error of at least {compare_error} (comparison stopped early).')
+                else:
+                    messages.append(f'Test image "{image}" failed with error {compare_error}.')
+
+            image_report = {
                 'name': str(image),
                 'success': compare_success,
                 'error': compare_error,
-                'tolerance': self.tolerance
-            })
+                'tolerance': self.tolerance,
+                'backend': compare_result['backend'],
+                'method': compare_result['method'],
+                'compare_time': compare_result['time']
+            }
+            if 'worst_tiles' in compare_result:
+                image_report['worst_tiles'] = compare_result['worst_tiles']
+            if compare_result.get('early_exit', False):
+                image_report['early_exit'] = True
+            if compare_result['method'] == 'statistical' and compare_result['error'] != None:
+                image_report['statistical'] = dict(job[4], tiles=compare_result['tiles'], rejected_tiles=compare_result['rejected_tiles'], min_p_value=compare_result['min_p_value'])
+            image_reports.append(image_report)
 
         # Report missing result images for existing reference images.
         for image in ref_images:
@@ -306,17 +449,22 @@ class Test:
 
         return result, messages, image_reports
 
-    def run(self, run_only, compare_only, ref_dir, result_dir, mogwai_exe, image_compare_exe):
+    def run(self, run_only, compare_only, ref_dir, result_dir, mogwai_exe, image_comparator, fingerprint=None, generated=None):
         '''
         Run the image test.
-        First, result images are generated (unless compare_only is True).
+        First, result images are generated (unless compare_only is True or the images have already
+        been generated in a scene batch, in which case generated contains the result of generate_images()
+        and the time spent generating the images).
         Second, result images are compared against reference images.
         Third, writes a JSON report to the result_dir containing details on the test run.
+        The report contains the resource usage of the Mogwai process and the time spent in each phase,
+        the phase timings including writing the report are also stored in self.timings.
         Returns a tuple containing the result code and a list of messages.
         '''
         # Setup report.
         report = {
             'name': self.name,
+            'tags': self.tags,
             'ref_dir': str(ref_dir / self.test_dir),
             'images': []
         }
@@ -327,46 +475,199 @@ class Test:
         rerun_env = {}
 
         # Generate results images.
-        if not compare_only:
+        generate_time = 0.0
+        if generated:
+            result, messages, rerun_env, generate_time = generated
+            start_time -= generate_time
+        elif not compare_only:
             result, messages, rerun_env = self.generate_images(result_dir, mogwai_exe, run_only)
+            generate_time = time.time() - start_time
 
         # Compare to references.
+        compare_start_time = time.time()
         if not run_only and result == Test.Result.PASSED:
-            result, messages, report['images'] = self.compare_images(ref_dir, result_dir, image_compare_exe)
+            result, messages, report['images'] = self.compare_images(ref_dir, result_dir, image_comparator)
+        compare_time = time.time() - compare_start_time
 
         # Finish report.
         report['result'] = Test.RESULT_STRING[result]
         report['messages'] = messages
         report['duration'] = time.time() - start_time
         report['rerun_env'] = rerun_env
+        if fingerprint:
+            report['fingerprint'] = fingerprint
+
+        # Record resource usage (not available when only comparing) and time spent waiting versus running.
+        usage = self.usage if not compare_only else None
+        report['resources'] = {
+            'peak_rss': usage['peak_rss'] if usage else None,
+            'user_time': usage['user_time'] if usage else None,
+            'system_time': usage['system_time'] if usage else None,
+            'queue_time': self.queue_time,
+            'compare_queue_time': self.compare_queue_time,
+            'run_time': generate_time + compare_time,
+            'phases': { 'generate': generate_time, 'compare': compare_time }
+        }
+        if usage and 'batch' in usage:
+            report['resources']['batch'] = usage['batch']
+
+        self.report = report
 
         # Write JSON report.
+        report_start_time = time.time()
         report_dir = result_dir / self.test_dir
         report_dir.mkdir(parents=True, exist_ok=True)
         report_file = report_dir / 'report.json'
         with open(report_file, 'w') as f:
             json.dump(report, f, indent=4)
 
+        self.timings = { 'generate': generate_time, 'compare': compare_time, 'report': time.time() - report_start_time }
+
         return result, messages
 
-def generate_ref(env, test, ref_dir, process_controller):
+class TestBatch:
+    '''
+    Represents a batch of image tests loading the same scenes, run in a single Mogwai process.
+    '''
+
+    def __init__(self, name, tests):
+        self.name = name
+        self.tests = tests
+        self.device_type = tests[0].device_type
+
+        # The batch occupies the slots of its heaviest test and runs until all tests have timed out.
+        self.weight = max(t.weight for t in tests)
+        self.exclusive = any(t.exclusive for t in tests)
+        self.timeout = sum(t.timeout for t in tests)
+        self.queue_time = 0.0
+
+    def __repr__(self):
+        return f'TestBatch(name={self.name},tests={[t.name for t in self.tests]})'
+
+    def slot_weight(self, slot_count):
+        return max(t.slot_weight(slot_count) for t in self.tests)
+
+    def generate_images(self, output_dir, mogwai_exe, batch_dir, process_controller, run_only=False):
+        '''
+        Run Mogwai once to generate the images of all tests in the batch, storing them in output_dir.
+        Test scripts are run in sequence by a generated script, each writing to its own output directory and log.
+        Returns a dictionary mapping test names to tuples containing the result code, a list of messages,
+        the environment for rerunning the test individually and the duration of the test.
+        If the process fails, the test running at that time is reported as failed and the tests not
+        run yet are omitted from the dictionary.
+        '''
+        jobs = []
+        rerun_envs = {}
+        for test in self.tests:
+            test_output_dir = output_dir / test.test_dir
+            test_output_dir.mkdir(parents=True, exist_ok=True)
+            result_file = test_output_dir / config.BATCH_RESULT_FILE
+            if result_file.exists():
+                result_file.unlink()
+
+            cwd, generate_file, args = test.prepare_run(test_output_dir, mogwai_exe, run_only)
+            rerun_envs[test.name] = { 'cwd': str(cwd), 'args': args[1:] }
+            jobs.append({ 'cwd': str(cwd), 'script': str(generate_file), 'log_file': str(test_output_dir / 'log.txt'), 'run_only': run_only, 'result_file': str(result_file) })
+
+        # Write batch script running all jobs in sequence.
+        batch_dir.mkdir(parents=True, exist_ok=True)
+        batch_file = batch_dir / f'{self.name}.py'
+        with open(batch_file, 'w') as f:
+            f.write('import sys\n')
+            f.write(f'sys.path.insert(0, r"{Path(__file__).parent}")\n')
+            f.write('import mogwai_jobs\n')
+            f.write(f'mogwai_jobs.run_batch(m, globals(), {jobs!r})\n')
+            f.write('exit()\n')
+
+        args = [
+            str(mogwai_exe),
+            '--device-type', str(self.device_type),
+            '--script', str(batch_file),
+            '--logfile', str(batch_dir / f'{self.name}.log'),
+            '--headless',
+            '--precise'
+        ]
+
+        errors = []
+        usage = None
+        p = subprocess.Popen(args, cwd=batch_dir, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        if not process_controller.add_process(self.name + ":run", p):
+            errors = ['Process killed due to global exit']
+        else:
+            capture = output.OutputCapture(batch_dir, prefix=f'{self.name}.', tail=process_controller.output_tail(self.name))
+            try:
+                _, _, usage = resources.communicate(p, self.timeout, capture)
+                if p.returncode != 0:
+                    errors = capture.errors() + [f'{mogwai_exe} exited with return code {p.returncode}']
+            except subprocess.TimeoutExpired:
+                p.kill()
+                p.wait()
+                capture.join(timeout=5)
+                process_controller.record_timeout()
+                errors = capture.errors() + ['Process killed due to timeout']
+
+        # The resource usage of the batch process is shared by all its tests.
+        for test in self.tests:
+            test.usage = dict(usage, batch=self.name) if usage else None
+
+        # Attribute results to tests. The first test without a result was running when the process failed.
+        results = {}
+        for test, job in zip(self.tests, jobs):
+            rerun_env = rerun_envs[test.name]
+            try:
+                with open(job['result_file']) as f:
+                    job_result = json.load(f)
+            except (OSError, ValueError):
+                errors = errors or ['Process exited without running test']
+                results[test.name] = (Test.Result.FAILED, errors + [f'Test was running in scene batch "{self.name}"'], rerun_env, 0.0)
+                break
+
+            duration = job_result['duration']
+            if not job_result['success']:
+                results[test.name] = (Test.Result.FAILED, (job_result['error'] or 'Unknown error').splitlines(), rerun_env, duration)
+            elif not run_only and len(test.collect_images(output_dir / test.test_dir)) == 0:
+                results[test.name] = (Test.Result.FAILED, ['Test did not generate any images.'], rerun_env, duration)
+            else:
+                results[test.name] = (Test.Result.PASSED, [], rerun_env, duration)
+
+        return results
+
+def generate_ref(env, test, ref_dir, process_controller, generated=None):
     if process_controller.is_interrupted():
         return
     with print_mutex:
         print(f'  {test.name:<60} : STARTED')
     test.process_controller = process_controller
     start_time = time.time()
-    result, messages, rerun_env = test.generate_images(ref_dir, env.mogwai_exe)
+    if generated:
+        result, messages, rerun_env, generate_time = generated
+        start_time -= generate_time
+    else:
+        result, messages, rerun_env = test.generate_images(ref_dir, env.mogwai_exe)
     elapsed_time = time.time() - start_time
     return {"name": test.name, "elapsed_time": elapsed_time, "result": result, "messages": messages, "rerun_env": rerun_env}
 
+def generate_batch_refs(env, batch, ref_dir, process_controller):
+    '''
+    Generates references for a scene batch.
+    Tests that have not been run due to a failure of the batch process are run individually.
+    Returns a list of run results.
+    '''
+    if process_controller.is_interrupted():
+        return []
+    with print_mutex:
+        print(f'  {batch.name:<60} : STARTED ({len(batch.tests)} tests)')
+    generated = batch.generate_images(ref_dir, env.mogwai_exe, batch_dir(env), process_controller)
+    return [generate_ref(env, test, ref_dir, process_controller, generated.get(test.name, None)) for test in batch.tests]
 
-def generate_refs(env, tests, ref_dir, process_controller):
+def generate_refs(env, tests, ref_dir, process_controller, batch_scenes=False):
     '''
     Computes references for a set of tests and stores them into ref_dir.
     '''
     print(f'Reference directory: {ref_dir}')
     print(f'Generating references for {len(tests)} tests on {process_controller.thread_count} processes')
+    if process_controller.concurrency:
+        process_controller.concurrency.start()
     if process_controller.thread_count > 1:
         print(colored('Test timings (both indidivual and total) are unreliable when running tests in parallel.', 'red'))
 
@@ -374,34 +675,30 @@ def generate_refs(env, tests, ref_dir, process_controller):
     if ref_dir.exists():
         shutil.rmtree(ref_dir, ignore_errors=True)
 
+    units = make_batches(env, tests, batch_scenes)
+
     success = True
     total_elapsed_time = 0
 
     try:
-        with concurrent.futures.ThreadPoolExecutor(process_controller.thread_count) as executor:
-            futures = {executor.submit(generate_ref, env, test, ref_dir, process_controller) for test in tests}
-            try:
-                for future in concurrent.futures.as_completed(futures):
-                    run_result   = future.result()
-                    if run_result == None:
-                        continue
-                    test_name    = run_result["name"]
-                    elapsed_time = run_result["elapsed_time"]
-                    result       = run_result["result"]
-                    messages     = run_result["messages"]
-
-                    if result == Test.Result.FAILED:
-                        success = False
-
-                    # Print result and messages.
-                    status = Test.COLORED_RESULT_STRING[result]
-                    with print_mutex:
-                        print(f'  {test_name:<60} : {status} ({elapsed_time:.1f} s)')
-                        for message in messages:
-                            print(f'    {message}')
-            except KeyboardInterrupt:
-                process_controller.interrupt_and_exit()
-                raise
+        generate_func = lambda unit: generate_batch_refs(env, unit, ref_dir, process_controller) if isinstance(unit, TestBatch) else [generate_ref(env, unit, ref_dir, process_controller)]
+        for run_result in itertools.chain.from_iterable(process_controller.run_parallel(units, generate_func)):
+            if run_result == None:
+                continue
+            test_name    = run_result["name"]
+            elapsed_time = run_result["elapsed_time"]
+            result       = run_result["result"]
+            messages     = run_result["messages"]
+
+            if result == Test.Result.FAILED:
+                success = False
+
+            # Print result and messages.
+            status = Test.COLORED_RESULT_STRING[result]
+            with print_mutex:
+                print(f'  {test_name:<60} : {status} ({elapsed_time:.1f} s)')
+                for message in messages:
+                    print(f'    {message}')
     except KeyboardInterrupt:
         return False
 
@@ -412,7 +709,12 @@ def generate_refs(env, tests, ref_dir, process_controller):
 
     return success
 
-def run_test(env, test, run_only, compare_only, ref_dir, result_dir, min_tolerance, process_controller):
+def generate_test(env, test, run_only, compare_only, ref_dir, result_dir, min_tolerance, process_controller, incremental, generated=None, fingerprints={}):
+    '''
+    Runs the generation stage of a test (unless compare_only is True or the images have already been generated in a scene batch).
+    Fingerprints already computed by the caller (dictionary mapping test names to fingerprints) are not computed again.
+    Returns the run result if the results of a previous run are reused, or a job for the comparison stage otherwise.
+    '''
     if process_controller.is_interrupted():
         return
     with print_mutex:
@@ -420,58 +722,303 @@ def run_test(env, test, run_only, compare_only, ref_dir, result_dir, min_toleran
     test.tolerance = max(test.tolerance, min_tolerance)
     test.process_controller = process_controller
     start_time = time.time()
-    result, messages = test.run(run_only, compare_only, ref_dir, result_dir, env.mogwai_exe, env.image_compare_exe)
-    elapsed_time = time.time() - start_time
-    return {"name": test.name, "elapsed_time": elapsed_time, "result": result, "messages": messages}
 
-def run_tests(env, tests, run_only, compare_only, ref_dir, result_dir, min_tolerance, xml_report, process_controller):
+    # Reuse results of the last passing run if the fingerprint has not changed.
+    fingerprint = None
+    if incremental:
+        fingerprinter, index = incremental
+        fingerprint = fingerprints[test.name] if test.name in fingerprints else fingerprinter.fingerprint(test, ref_dir)
+        previous = index.lookup(test, fingerprint)
+        if previous:
+            report, previous_dir = previous
+            core_incremental.reuse_results(previous_dir, result_dir / test.test_dir)
+            index.record(test, fingerprint, result_dir / test.test_dir)
+            elapsed_time = time.time() - start_time
+            return {"name": test.name, "elapsed_time": elapsed_time, "result": Test.Result.PASSED, "messages": ['Reused results of previous run (fingerprint unchanged).'], "images": report['images'], "reused": True}
+
+    if not compare_only and not generated:
+        result, messages, rerun_env = test.generate_images(result_dir, env.mogwai_exe, run_only)
+        generated = (result, messages, rerun_env, time.time() - start_time)
+    return {"test": test, "fingerprint": fingerprint, "generated": generated, "queued_at": time.time()}
+
+def compare_test(env, job, run_only, compare_only, ref_dir, result_dir, image_comparator, incremental):
+    '''
+    Runs the comparison stage of a test, comparing the generated images and writing the report.
+    Returns the run result.
+    '''
+    test = job["test"]
+    generated = job["generated"]
+    start_time = time.time()
+    test.compare_queue_time = start_time - job["queued_at"]
+    result, messages = test.run(run_only, compare_only, ref_dir, result_dir, env.mogwai_exe, image_comparator, job["fingerprint"], generated)
+    if incremental and result == Test.Result.PASSED:
+        incremental[1].record(test, job["fingerprint"], result_dir / test.test_dir)
+    elapsed_time = time.time() - start_time + (generated[3] if generated else 0.0)
+    return {"name": test.name, "elapsed_time": elapsed_time, "result": result, "messages": messages, "images": test.report['images'], "reused": False, "resources": test.report['resources'], "timings": test.timings}
+
+def generate_batch(env, batch, run_only, ref_dir, result_dir, min_tolerance, process_controller, incremental):
+    '''
+    Runs the generation stage of a scene batch, generating the images of all tests in a single Mogwai process.
+    Tests with reusable results (incremental mode) are excluded from the batch, and tests that have
+    not been run due to a failure of the batch process are run individually.
+    Returns a list of run results and jobs for the comparison stage.
+    '''
+    if process_controller.is_interrupted():
+        return []
+    tests = batch.tests
+    for test in tests:
+        test.queue_time = batch.queue_time
+    # Fingerprint tests once (including the minimum tolerance) for excluding reusable tests and reusing their results.
+    fingerprints = {}
+    if incremental:
+        fingerprinter, index = incremental
+        for test in tests:
+            test.tolerance = max(test.tolerance, min_tolerance)
+            fingerprints[test.name] = fingerprinter.fingerprint(test, ref_dir)
+        tests = [t for t in tests if not index.lookup(t, fingerprints[t.name])]
+
+    generated = {}
+    if len(tests) > 1:
+        with print_mutex:
+            print(f'  {batch.name:<60} : STARTED ({len(tests)} tests)')
+        generated = TestBatch(batch.name, tests).generate_images(result_dir, env.mogwai_exe, batch_dir(env), process_controller, run_only)
+
+    items = [generate_test(env, test, run_only, False, ref_dir, result_dir, min_tolerance, process_controller, incremental, generated.get(test.name, None), fingerprints) for test in batch.tests]
+    return [item for item in items if item != None]
+
+def compare_stats(run_results):
+    '''
+    Compute statistics on which comparison method (hash or metric) was used for the images of a run.
+    '''
+    images = [image for run_result in run_results for image in run_result["images"] if 'method' in image]
+    hash_images = [image for image in images if image['method'] == 'hash']
+    metric_images = [image for image in images if image['method'] == 'metric']
+    hash_time = sum(image['compare_time'] for image in hash_images)
+    metric_time = sum(image['compare_time'] for image in metric_images)
+
+    # Estimate time saved by assuming hashed images would have taken the average metric comparison time.
+    saved_time = 0.0
+    if len(hash_images) > 0 and len(metric_images) > 0:
+        saved_time = max(0.0, len(hash_images) * metric_time / len(metric_images) - hash_time)
+
+    return {
+        'images': len(images),
+        'hash_images': len(hash_images),
+        'metric_images': len(metric_images),
+        'hash_time': hash_time,
+        'metric_time': metric_time,
+        'estimated_saved_time': saved_time
+    }
+
+def resource_totals(run_results, run_report_time):
+    '''
+    Compute the total time spent in each phase and the total resource usage of the tests of a run.
+    Tests of a scene batch share the usage of the batch process, which is only counted once.
+    '''
+    totals = {
+        'generate_time': 0.0,
+        'compare_time': 0.0,
+        'report_time': 0.0,
+        'run_report_time': run_report_time,
+        'queue_time': 0.0,
+        'user_time': 0.0,
+        'system_time': 0.0,
+        'peak_rss': None,
+        'peak_rss_test': None
+    }
+    batches = set()
+    for run_result in run_results:
+        timings = run_result.get("timings", None)
+        if timings:
+            totals['generate_time'] += timings['generate']
+            totals['compare_time'] += timings['compare']
+            totals['report_time'] += timings['report']
+        usage = run_result.get("resources", None)
+        if not usage:
+            continue
+        totals['queue_time'] += usage['queue_time']
+        if usage['peak_rss'] == None or usage.get('batch', None) in batches:
+            continue
+        if 'batch' in usage:
+            batches.add(usage['batch'])
+        totals['user_time'] += usage['user_time']
+        totals['system_time'] += usage['system_time']
+        if totals['peak_rss'] == None or usage['peak_rss'] > totals['peak_rss']:
+            totals['peak_rss'] = usage['peak_rss']
+            totals['peak_rss_test'] = usage.get('batch', run_result["name"])
+    return totals
+
+def dump_run_result(run_result):
+    '''
+    Convert a run result to a JSON serializable dictionary.
+    '''
+    return dict(run_result, result=Test.RESULT_STRING[run_result["result"]])
+
+def load_run_result(data):
+    '''
+    Convert a dictionary loaded from the result log to a run result.
+    '''
+    return dict(data, result=Test.Result[data["result"]])
+
+def run_tests(env, tests, run_only, compare_only, ref_dir, result_dir, min_tolerance, xml_report, process_controller, image_comparator, incremental=None, batch_scenes=False, shard=None, resume=False):
     '''
     Runs a set of tests, stores them into result_dir and compares them to ref_dir.
+    Results are appended to the result log as soon as they are available, and the run report and
+    XML report are rewritten after every test. If resume is True, tests with a result in the result log
+    of a previous (interrupted) run are not run again.
     '''
     print(f'Result directory: {result_dir}')
     print(f'Reference directory: {ref_dir}')
-    print(f'Running {len(tests)} tests on {process_controller.thread_count} processes')
+    if process_controller.concurrency:
+        concurrency = process_controller.concurrency
+        print(f'Running {len(tests)} tests on {concurrency.slots} processes (adapting between {concurrency.min_slots} and {concurrency.max_slots})')
+    else:
+        print(f'Running {len(tests)} tests on {process_controller.thread_count} processes')
+    if not run_only:
+        print(f'Comparing images using {image_comparator.backend} backend on {image_comparator.thread_count} threads')
     if process_controller.thread_count > 1:
         print(colored('Test timings (both indidivual and total) are unreliable when running tests in parallel.', 'red'))
 
-    success = True
+    # Load results of the previous run when resuming, otherwise start a new result log.
+    result_log = reports.ResultLog(result_dir / config.RESULT_LOG_FILE)
+    previous_results = []
+    pending_tests = tests
+    if resume:
+        logged_results = result_log.load()
+        previous_results = [load_run_result(logged_results[t.name]) for t in tests if t.name in logged_results]
+        pending_tests = [t for t in tests if not t.name in logged_results]
+        print(f'Resuming previous run, skipping {len(previous_results)} of {len(tests)} tests with results')
+    else:
+        result_log.clear()
+
+    # Group tests into scene batches. Images are not generated when only comparing.
+    units = make_batches(env, pending_tests, batch_scenes and not compare_only)
+
+    # Order tests longest first based on durations of previous runs.
+    durations = scheduling.load_durations(pending_tests, result_dir)
+    estimates = scheduling.estimate_durations(pending_tests, durations)
+    for unit in units:
+        if isinstance(unit, TestBatch):
+            estimates[unit.name] = sum(estimates[t.name] for t in unit.tests)
+    units = scheduling.order_longest_first(units, estimates)
+    makespan = scheduling.predict_makespan(units, estimates, lambda t: t.slot_weight(process_controller.thread_count), process_controller.thread_count)
+    print(f'Scheduling longest tests first ({len(durations)} of {len(pending_tests)} tests with previous durations), predicted run time {makespan:.1f} s')
+
+    success = all(r["result"] != Test.Result.FAILED for r in previous_results)
     run_date = datetime.datetime.now()
     run_start_time = time.time()
-    run_results = []
+    run_results = list(previous_results)
     total_elapsed_time = 0
+    report_write_time = 0.0
+    last_report_time = 0.0
+
+    def write_reports(result, extra={}):
+        nonlocal report_write_time, last_report_time
+        start_time = time.time()
+        last_report_time = start_time
+        report = {
+            'date': run_date.isoformat(),
+            'result': result,
+            'tests': [t.name for t in tests],
+            'duration': time.time() - run_start_time
+        }
+        report.update(extra)
+        if shard:
+            report['shard'] = shard
+        reports.write_json(result_dir / 'report.json', report)
+        if xml_report:
+            reports.write_xml_report(xml_report, [dump_run_result(r) for r in run_results])
+        report_write_time += time.time() - start_time
+
+    # Reports of an incomplete run are available from the start.
+    write_reports('INCOMPLETE')
+
+    # Images are generated in process slots and pushed to the comparison stage, which compares
+    # the images of a test on a separate pool of threads while the next tests are generated.
+    results = queue.Queue()
+    compare_func = lambda job: compare_test(env, job, run_only, compare_only, ref_dir, result_dir, image_comparator, incremental)
+    compare_stage = pipeline.Stage('compare', image_comparator.thread_count, compare_func, results)
+    process_controller.busy_time = 0.0
+    if process_controller.concurrency:
+        process_controller.concurrency.start(result_dir / config.CONCURRENCY_LOG_FILE)
+
+    # Exceptions raised while generating (e.g. OSError) are re-raised after the generation thread finished.
+    generate_errors = []
+
+    def generate_all():
+        generate_func = lambda unit: generate_batch(env, unit, run_only, ref_dir, result_dir, min_tolerance, process_controller, incremental) if isinstance(unit, TestBatch) else [generate_test(env, unit, run_only, compare_only, ref_dir, result_dir, min_tolerance, process_controller, incremental)]
+        try:
+            for item in itertools.chain.from_iterable(process_controller.run_parallel(units, generate_func)):
+                if item == None:
+                    continue
+                if "test" in item:
+                    compare_stage.put(item)
+                else:
+                    results.put(item)
+        except Exception as e:
+            generate_errors.append(e)
+        finally:
+            try:
+                compare_stage.close()
+            except Exception:
+                # Comparison errors are kept in compare_stage.errors.
+                pass
+            finally:
+                results.put(None)
+
+    generate_thread = threading.Thread(target=generate_all, name='generate', daemon=True)
+    generate_thread.start()
+
+    reports_pending = False
 
     try:
-        # Run tests on #CPU - 2 (to retain some performance control)
-        with concurrent.futures.ThreadPoolExecutor(process_controller.thread_count) as executor:
-            futures = {executor.submit(run_test, env, test, run_only, compare_only, ref_dir, result_dir, min_tolerance, process_controller) for test in tests}
+        while True:
+            # Poll with a timeout to stay responsive to keyboard interrupts.
             try:
-                for future in concurrent.futures.as_completed(futures):
-                    run_result   = future.result()
-                    if run_result == None:
-                        continue
-
-                    run_results.append(run_result)
-
-                    test_name    = run_result["name"]
-                    elapsed_time = run_result["elapsed_time"]
-                    result       = run_result["result"]
-                    messages     = run_result["messages"]
-
-                    if result == Test.Result.FAILED:
-                        success = False
-
-                    # Print result and messages.
-                    status = Test.COLORED_RESULT_STRING[result]
-                    with print_mutex:
-                        print(f'  {test_name:<60} : {status} ({elapsed_time:.1f} s)')
-                        for message in messages:
-                            print(f'    {message}')
-            except KeyboardInterrupt:
-                process_controller.interrupt_and_exit()
-                raise
+                run_result = results.get(timeout=1)
+            except queue.Empty:
+                # Write reports held back by the throttling while waiting for the next result.
+                if reports_pending and time.time() - last_report_time >= config.REPORT_WRITE_INTERVAL:
+                    write_reports('INCOMPLETE')
+                    reports_pending = False
+                continue
+            if run_result == None:
+                break
+
+            run_results.append(run_result)
+
+            test_name    = run_result["name"]
+            elapsed_time = run_result["elapsed_time"]
+            result       = run_result["result"]
+            messages     = run_result["messages"]
+
+            if result == Test.Result.FAILED:
+                success = False
+
+            # Log result and update reports (results of tests killed due to an interrupt are not logged).
+            # Rewriting the reports is linear in the number of results, so it is throttled.
+            if not process_controller.is_interrupted():
+                result_log.append(dump_run_result(run_result))
+                reports_pending = time.time() - last_report_time < config.REPORT_WRITE_INTERVAL
+                if not reports_pending:
+                    write_reports('INCOMPLETE')
+
+            # Print result and messages.
+            status = Test.COLORED_RESULT_STRING[result]
+            with print_mutex:
+                print(f'  {test_name:<60} : {status} ({elapsed_time:.1f} s)')
+                for message in messages:
+                    print(f'    {message}')
     except KeyboardInterrupt:
+        process_controller.interrupt_and_exit()
         return False
 
+    generate_thread.join()
+    if len(generate_errors) > 0:
+        raise generate_errors[0]
+    if len(compare_stage.errors) > 0:
+        raise compare_stage.errors[0]
+
     total_elapsed_time = time.time() - run_start_time
 
     status = colored('PASSED', 'green') if success else colored('FAILED', 'red')
@@ -479,35 +1026,67 @@ def run_tests(env, tests, run_only, compare_only, ref_dir, result_dir, min_toler
     if process_controller.thread_count > 1:
         print(colored('Test timings (both indidivual and total) are unreliable when running tests in parallel.','red'))
 
-    # Setup report.
+    reused_count = len([r for r in run_results if r["reused"]])
+    if incremental:
+        incremental[0].digest_cache.save()
+        incremental[1].save()
+        print(f'Reused results of {reused_count} of {len(run_results)} tests with unchanged fingerprints.')
+
+    # With adaptive concurrency, utilization is relative to the average number of slots.
+    slot_count = process_controller.concurrency.average_slots() if process_controller.concurrency else process_controller.thread_count
+    generate_stats = {
+        'slots': slot_count,
+        'busy_time': process_controller.busy_time,
+        'utilization': process_controller.busy_time / (slot_count * total_elapsed_time) if total_elapsed_time > 0 else 0.0
+    }
+    if process_controller.concurrency:
+        generate_stats['concurrency_changes'] = len(process_controller.concurrency.changes)
+        generate_stats['final_slots'] = process_controller.concurrency.slots
+    stage_stats = { 'generate': generate_stats, 'compare': compare_stage.stats(total_elapsed_time) }
+    limiting_stage = 'generation' if generate_stats['utilization'] >= stage_stats['compare']['utilization'] else 'comparison'
+    print(f'Stage utilization: generate {generate_stats["utilization"] * 100:.0f}% of {generate_stats["slots"]:.3g} slots, compare {stage_stats["compare"]["utilization"] * 100:.0f}% of {stage_stats["compare"]["threads"]} threads (average queue wait {stage_stats["compare"]["average_wait_time"]:.1f} s), run is limited by {limiting_stage}.')
+
+    stats = compare_stats([r for r in run_results if not r["reused"]])
+    if stats['images'] > 0:
+        print(f'Compared {stats["images"]} images: {stats["hash_images"]} identical by hash ({stats["hash_time"]:.1f} s), {stats["metric_images"]} by metric ({stats["metric_time"]:.1f} s), estimated {stats["estimated_saved_time"]:.1f} s saved.')
+    if image_comparator.decoded_cache:
+        stats['decoded_cache_hits'] = image_comparator.decoded_cache.hits
+        stats['decoded_cache_misses'] = image_comparator.decoded_cache.misses
+        print(f'Decoded reference cache: {stats["decoded_cache_hits"]} hits, {stats["decoded_cache_misses"]} misses.')
+
+    totals = resource_totals(run_results, report_write_time)
+    print(f'Phase totals: generate {totals["generate_time"]:.1f} s, compare {totals["compare_time"]:.1f} s, report writing {totals["report_time"]:.1f} s (tests) + {totals["run_report_time"]:.1f} s (run).')
+    if totals['peak_rss'] != None:
+        print(f'Mogwai resource usage: {totals["user_time"]:.1f} s user, {totals["system_time"]:.1f} s system CPU time, max peak RSS {totals["peak_rss"] / 2**20:.0f} MB ({totals["peak_rss_test"]}), total queue wait {totals["queue_time"]:.1f} s.')
+
+    # Write final reports.
     report = {
-        'date': run_date.isoformat(),
-        'result': 'PASSED' if success else 'FAILED',
-        'tests': [t.name for t in tests],
-        'duration': time.time() - run_start_time
+        'compare_stats': stats,
+        'stage_stats': stage_stats,
+        'resource_totals': totals,
+        'reused_tests': reused_count
     }
-
-    # Write JSON report.
-    report_file = result_dir / 'report.json'
-    with open(report_file, 'w') as f:
-        json.dump(report, f, indent=4)
-
-    # Write XML report.
-    if xml_report:
-        testsuites = ET.Element("testsuites")
-        suite = ET.SubElement(testsuites, "testsuite", name="Image Tests")
-        for run_result in run_results:
-            testcase = ET.SubElement(suite, "testcase", name=run_result["name"], time="%.3f" % run_result["elapsed_time"])
-            if run_result["result"] == Test.Result.SKIPPED:
-                ET.SubElement(testcase, "skipped")
-            elif run_result["result"] == Test.Result.FAILED:
-                ET.SubElement(testcase, "failure", message="\n".join(run_result["messages"]))
-
-        tree = ET.ElementTree(testsuites)
-        tree.write(xml_report)
+    write_reports('PASSED' if success else 'FAILED', report)
 
     return success
 
+def batch_dir(env):
+    '''
+    Return the directory containing the scripts and logs of scene batches.
+    '''
+    return env.project_dir / config.CACHE_DIR / 'batches'
+
+def make_batches(env, tests, batch_scenes):
+    '''
+    Group tests loading the same scenes into scene batches (if batch_scenes is True).
+    Returns a list of tests and test batches to run.
+    '''
+    if not batch_scenes:
+        return list(tests)
+    batches, singles = batching.group_tests(tests, env.project_dir, config.BATCH_MAX_TESTS)
+    print(f'Grouped {sum(len(b) for _, b in batches)} tests into {len(batches)} scene batches')
+    return [TestBatch(name, batch_tests) for name, batch_tests in batches] + singles
+
 def list_tests(tests):
     '''
     Print a list of tests.
@@ -516,10 +1095,11 @@ def list_tests(tests):
     for test in tests:
         print(f'  {test.name}')
 
-def collect_tests(root_dir, filter_regex, tags):
+def collect_tests(root_dir, filter_regex, tags, header_cache=None):
     '''
     Collect a list of all tests found in root_dir that are matching the filter_regex and tags.
     A test script needs to be named test_*.py to be detected.
+    If a header cache is given, script headers are only parsed for new or modified scripts.
     '''
     # Find all script files.
     script_files = list(root_dir.glob('**/test_*.py'))
@@ -527,11 +1107,15 @@ def collect_tests(root_dir, filter_regex, tags):
     # Create tests.
     tests = []
     for script_file in script_files:
-        try:
-            header = read_header(script_file)
-        except Exception as e:
-            print(e)
-            sys.exit(1)
+        header = header_cache.get(script_file) if header_cache else None
+        if header == None:
+            try:
+                header = read_header(script_file)
+            except Exception as e:
+                print(e)
+                sys.exit(1)
+            if header_cache and is_json_serializable(header):
+                header_cache.put(script_file, header)
 
         # Check if test is enabled for current platform.
         platforms = header.get("platforms", config.DEFAULT_PLATFORMS)
@@ -543,7 +1127,11 @@ def collect_tests(root_dir, filter_regex, tags):
         device_types = header.get("device_types", ["d3d12"])
         device_types = [d for d in device_types if d in config.SUPPORTED_DEVICE_TYPES]
         for device_type in device_types:
-            tests.append(Test(script_file, root_dir, device_type, header))
+            try:
+                tests.append(Test(script_file, root_dir, device_type, header))
+            except Exception as e:
+                print(e)
+                sys.exit(1)
 
     # Filter using regex.
     if filter_regex != '':
@@ -554,30 +1142,141 @@ def collect_tests(root_dir, filter_regex, tags):
     tags = tags.split(',')
     tests = list(filter(lambda t: t.matches_tags(tags), tests))
 
+    if header_cache:
+        header_cache.save()
+
     return tests
 
+def is_json_serializable(value):
+    try:
+        json.dumps(value)
+        return True
+    except (TypeError, ValueError):
+        return False
+
+def select_changed_tests(env, tests, ref):
+    '''
+    Select the tests affected by the files changed since a git ref, using the static dependency index.
+    '''
+    try:
+        changed_files = helpers.get_git_changed_files(env.project_dir, ref)
+    except RuntimeError as e:
+        print(e)
+        sys.exit(1)
+
+    index = dependencies.DependencyIndex(env.project_dir, tests)
+    affected, global_files = index.affected_tests(changed_files)
+
+    print(f'Found {len(changed_files)} files changed since {ref}')
+    if len(global_files) > 0:
+        print(f'Selecting all tests due to changes in: {", ".join(global_files[0:5])}{" ..." if len(global_files) > 5 else ""}')
+    dynamic_tests = [name for name in index.dynamic if name in affected]
+    if len(dynamic_tests) > 0 and len(global_files) == 0:
+        print(f'Selecting {len(dynamic_tests)} tests with dynamic loads that cannot be analyzed statically:')
+        for name in dynamic_tests:
+            print(f'  {name}: {index.dynamic[name][0]}')
+
+    selected = [t for t in tests if t.name in affected]
+    print(f'Selected {len(selected)} of {len(tests)} tests affected by changes')
+    return selected
+
+def select_shard(tests, shard, durations_file):
+    '''
+    Select the tests of a shard given as K/N (1-based).
+    '''
+    m = re.fullmatch(r'(\d+)/(\d+)', shard)
+    if not m or not 1 <= int(m[1]) <= int(m[2]):
+        print(f'Invalid shard "{shard}" (expected K/N with 1 <= K <= N).')
+        sys.exit(1)
+    index, count = int(m[1]), int(m[2])
+
+    durations = scheduling.load_duration_file(durations_file)
+    selected = scheduling.shard_tests(tests, durations, index - 1, count)
+    known_count = len([t for t in tests if t.name in durations])
+    print(f'Selected {len(selected)} of {len(tests)} tests for shard {index}/{count} ({known_count} tests with durations from {durations_file})')
+    return selected
+
 def push_refs(ref_dir, remote_ref_dir):
     '''
     Pushes reference images from ref_dir to remote_ref_dir.
     '''
     print(f'Pushing reference images to {remote_ref_dir} : ', end='', flush=True)
-    success, log = helpers.mirror_folders(ref_dir, remote_ref_dir)
+    success, log = mirror.mirror_folders(ref_dir, remote_ref_dir)
     print(colored('OK', 'green') if success else colored('FAILED', 'red'))
-    if not success:
-        print(log)
+    print(log)
     return success
 
-def pull_refs(remote_ref_dir, ref_dir):
+def pull_refs(env, remote_ref_dir, ref_dir, ref_store=None):
     '''
     Pulls reference images from remote_ref_dir to ref_dir.
+    If a reference store is given, only images not contained in the store are transferred.
     '''
     print(f'Pulling reference images from {remote_ref_dir} : ', end='', flush=True)
-    success, log = helpers.mirror_folders(remote_ref_dir, ref_dir)
+    if ref_store:
+        try:
+            digest_cache = helpers.FileCache(env.project_dir / config.CACHE_DIR / config.REF_STORE_DIGESTS_FILE)
+            image_count, transferred_count = ref_store.pull_tree(remote_ref_dir, ref_dir, digest_cache)
+            digest_cache.save()
+        except OSError as e:
+            print(colored('FAILED', 'red'))
+            print(e)
+            return False
+        print(colored('OK', 'green') + f' ({transferred_count} of {image_count} images transferred)')
+        return True
+    success, log = mirror.mirror_folders(remote_ref_dir, ref_dir)
     print(colored('OK', 'green') if success else colored('FAILED', 'red'))
-    if not success:
-        print(log)
+    print(log)
     return success
 
+def precompute_metric_maps(env, result_dir):
+    '''
+    Computes the metric maps of failed images for the compare view of view_image_tests.
+    '''
+    if not metric_maps.is_available():
+        print('NumPy is not available, skipping metric maps.')
+        return
+    start_time = time.time()
+    cache = metric_maps.MetricMapCache(env.project_dir / config.CACHE_DIR / config.METRIC_CACHE_DIR)
+    count, errors = metric_maps.precompute_run(cache, result_dir)
+    print(f'Computed metric maps of {count} failed images ({time.time() - start_time:.1f} s).')
+    for error in errors:
+        print(f'  {error}')
+
+def open_ref_store(env):
+    '''
+    Open the content-addressed reference store of the environment or return None if not configured.
+    '''
+    if not env.image_tests_ref_objects_dir:
+        return None
+    return refstore.ObjectStore(env.resolve_image_dir(env.image_tests_ref_objects_dir, env.branch, 'unknown'))
+
+def store_refs(env, ref_store, ref_dir):
+    '''
+    Moves the reference images in ref_dir into the reference store, replacing them with links.
+    '''
+    print(f'Storing reference images in {ref_store.objects_dir} : ', end='', flush=True)
+    try:
+        digest_cache = helpers.FileCache(env.project_dir / config.CACHE_DIR / config.REF_STORE_DIGESTS_FILE)
+        image_count, new_count = ref_store.store_tree(ref_dir, digest_cache)
+        digest_cache.save()
+    except OSError as e:
+        print(colored('FAILED', 'red'))
+        print(e)
+        return False
+    print(colored('OK', 'green') + f' ({new_count} of {image_count} images added)')
+    return True
+
+def gc_refs(ref_store):
+    '''
+    Removes objects from the reference store that are not referenced by any reference directory.
+    '''
+    if not ref_store:
+        print('Reference store is not configured for this environment.')
+        return False
+    removed_count, removed_bytes = ref_store.gc()
+    print(f'Removed {removed_count} unreferenced objects ({removed_bytes / 2**20:.1f} MB) from {ref_store.objects_dir}.')
+    return True
+
 def main():
     default_config = find_most_recent_build_config()
     default_processes_count = min(config.DEFAULT_PROCESS_COUNT, multiprocessing.cpu_count())
@@ -590,13 +1289,30 @@ def main():
     parser.add_argument('-l', '--list', action='store_true', help='List available tests')
     parser.add_argument('-t', '--tags', type=str, action='store', help='Comma separated list of tags for filtering tests to run', default='default')
     parser.add_argument('-f', '--filter', type=str, action='store', help='Regular expression for filtering tests to run')
+    parser.add_argument('--changed-since', type=str, action='store', help='Only run tests affected by files changed since the given git ref')
+    parser.add_argument('--shard', type=str, action='store', help='Only run shard K of N (given as K/N) of the tests, balanced by historical durations')
+    parser.add_argument('--shard-durations', type=str, action='store', help=f'Durations file used for balancing shards (default: {config.SHARD_DURATIONS_FILE})')
     parser.add_argument('-x', '--xml-report', type=str, action='store', help='XML report output file')
     parser.add_argument('-b', '--ref-branch', help='Reference branch to compare against (defaults to master branch)', default='master')
     parser.add_argument('--run-only', action='store_true', help='Run tests without comparing images')
     parser.add_argument('--compare-only', action='store_true', help='Compare previous results against references without generating new images')
     parser.add_argument('--tolerance', type=float, action='store', help='Override tolerance to be at least this value.', default=config.DEFAULT_TOLERANCE)
-    parser.add_argument('--parallel', type=int, action='store', help='Set the number of Mogwai processes to be used in parallel', default=default_processes_count)
+    parser.add_argument('--parallel', type=str, action='store', help='Set the number of Mogwai processes to be used in parallel, or "auto" to adapt it to the throughput and host load', default=str(default_processes_count))
+    parser.add_argument('--parallel-min', type=int, action='store', help=f'Minimum number of Mogwai processes with --parallel auto (default: {config.PARALLEL_AUTO_MIN})', default=config.PARALLEL_AUTO_MIN)
+    parser.add_argument('--parallel-max', type=int, action='store', help='Maximum number of Mogwai processes with --parallel auto (default: number of CPUs)', default=config.PARALLEL_AUTO_MAX)
     parser.add_argument('--gen-refs', action='store_true', help='Generate reference images instead of running tests')
+    parser.add_argument('--gc-refs', action='store_true', help='Remove images from the reference store that are not used by any reference directory')
+    parser.add_argument('--resume', action='store_true', help='Resume an interrupted run, skipping tests that already have a result in the result log')
+    parser.add_argument('--batch-scenes', action='store_true', help='Run tests loading the same scenes in a single Mogwai process')
+    parser.add_argument('--workers', action='store_true', help='Run tests in persistent Mogwai worker processes instead of starting Mogwai for every test')
+    parser.add_argument('--incremental', action='store_true', help='Reuse results of tests whose inputs have not changed since their last passing run')
+    parser.add_argument('--compare-backend', type=str, action='store', choices=image_compare.BACKENDS, help='Image comparison backend (numpy runs in-process, exe runs ImageCompare)', default=config.DEFAULT_COMPARE_BACKEND)
+    parser.add_argument('--compare-threads', type=int, action='store', help='Set the number of threads used for comparing images', default=multiprocessing.cpu_count())
+    parser.add_argument('-v', '--verbose', action='store_true', help='Print the output of Mogwai processes while tests are running')
+    parser.add_argument('--no-hash-compare', action='store_true', help='Always compute the error metric instead of first checking for identical pixels by hash')
+    parser.add_argument('--no-decoded-cache', action='store_true', help='Decode reference images on every run instead of caching the decoded images')
+    parser.add_argument('--precompute-metrics', action='store_true', help='Compute the metric maps of failed images for view_image_tests after running tests')
+    parser.add_argument('--compare-early-exit', action='store_true', help='Stop comparing an image as soon as its error is known to exceed the tolerance (reports a lower bound of the error and writes no error images)')
 
     additional_group = parser.add_argument_group('extended arguments ', 'Additional options used for testing pipelines on TeamCity.')
     additional_group.add_argument('--pull-refs', action='store_true', help='Pull reference images from remote before running tests')
@@ -622,12 +1338,48 @@ def main():
         print(f"\nFailed to load environment: {env_error}")
         sys.exit(1)
 
+    ref_store = open_ref_store(env)
+
+    # Remove unused reference images.
+    if args.gc_refs:
+        sys.exit(0 if gc_refs(ref_store) else 1)
+
     # Collect tests to run.
-    tests = collect_tests(env.image_tests_dir, args.filter, args.tags)
+    header_cache = helpers.FileCache(env.project_dir / config.CACHE_DIR / 'test_headers.json')
+    tests = collect_tests(env.image_tests_dir, args.filter, args.tags, header_cache)
+    if args.changed_since:
+        tests = select_changed_tests(env, tests, args.changed_since)
+    if args.shard:
+        shard_durations = Path(args.shard_durations) if args.shard_durations else env.project_dir / config.SHARD_DURATIONS_FILE
+        tests = select_shard(tests, args.shard, shard_durations)
 
     # The number of processes on Windows is 61, which should be enough for anything, so just hard coding it capped here
-    args.parallel = min(args.parallel, 61)
-    process_controller = ProcessController(args.parallel)
+    concurrency = None
+    if args.parallel == 'auto':
+        def print_locked(message):
+            with print_mutex:
+                print(colored(message, 'cyan'))
+        concurrency = core_concurrency.AdaptiveConcurrency(default_processes_count, args.parallel_min, min(args.parallel_max or multiprocessing.cpu_count(), 61), print_func=print_locked)
+        args.parallel = concurrency.max_slots
+    else:
+        try:
+            args.parallel = min(int(args.parallel), 61)
+        except ValueError:
+            print(f'Invalid value for --parallel: {args.parallel}')
+            sys.exit(1)
+    process_controller = ProcessController(concurrency.slots if concurrency else args.parallel, args.verbose)
+    process_controller.concurrency = concurrency
+
+    if args.batch_scenes and args.workers:
+        print('Scene batches cannot be combined with --workers.')
+        sys.exit(1)
+
+    # Setup persistent Mogwai workers (started on demand).
+    if args.workers and not args.list:
+        worker_script = Path(__file__).parent / 'mogwai_worker.py'
+        make_args = lambda device_type: [str(env.mogwai_exe), '--device-type', device_type, '--script', str(worker_script), '--headless', '--precise']
+        add_process = lambda p: process_controller.add_process(f'worker:{p.pid}', p)
+        process_controller.worker_pool = worker_pool.WorkerPool(make_args, args.parallel, env.image_tests_dir, env.project_dir / config.CACHE_DIR / 'workers', add_process=add_process, output_tail=process_controller.output_tail, on_timeout=process_controller.record_timeout)
 
     if args.list:
         # List available tests.
@@ -635,7 +1387,13 @@ def main():
     elif args.gen_refs:
         # Generate references.
         ref_dir = env.resolve_image_dir(env.image_tests_ref_dir, env.branch, args.build_id)
-        if not generate_refs(env, tests, ref_dir, process_controller):
+        success = generate_refs(env, tests, ref_dir, process_controller, args.batch_scenes)
+        if process_controller.worker_pool:
+            process_controller.worker_pool.shutdown()
+        # Only move complete sets of references into the reference store.
+        if success and ref_store:
+            success = store_refs(env, ref_store, ref_dir)
+        if not success:
             sys.exit(1)
 
         # Push references to remote.
@@ -657,7 +1415,7 @@ def main():
                 print("Remote reference directory is not configured for this environment.")
                 sys.exit(1)
             remote_ref_dir = env.resolve_image_dir(env.image_tests_remote_ref_dir, args.ref_branch, args.build_id)
-            if not pull_refs(remote_ref_dir, ref_dir):
+            if not pull_refs(env, remote_ref_dir, ref_dir, ref_store):
                 sys.exit(1)
 
         # Give some instructions on how to acquire reference images if not available.
@@ -677,8 +1435,39 @@ def main():
             print('')
             sys.exit(1)
 
+        # Setup image comparator.
+        try:
+            digest_cache = helpers.FileCache(env.project_dir / config.CACHE_DIR / config.REFERENCE_DIGESTS_FILE)
+            decoded_cache = None
+            if not args.no_decoded_cache and image_compare.is_numpy_available():
+                decoded_cache = image_compare.DecodedImageCache(env.project_dir / config.CACHE_DIR / config.DECODED_CACHE_DIR)
+            image_comparator = image_compare.ImageComparator(env.image_compare_exe, args.compare_backend, args.compare_threads, digest_cache, not args.no_hash_compare, args.compare_early_exit, decoded_cache)
+        except RuntimeError as e:
+            print(e)
+            sys.exit(1)
+
+        # Setup incremental mode.
+        incremental = None
+        if args.incremental:
+            if args.run_only or args.compare_only:
+                print('Incremental mode cannot be combined with --run-only or --compare-only.')
+                sys.exit(1)
+            cache_dir = env.project_dir / config.CACHE_DIR
+            fingerprinter = core_incremental.Fingerprinter(env, helpers.FileCache(cache_dir / config.INCREMENTAL_DIGESTS_FILE))
+            index = core_incremental.IncrementalIndex(cache_dir / f'incremental-{env.build_config}.json')
+            incremental = (fingerprinter, index)
+
         # Run tests.
-        if not run_tests(env, tests, args.run_only, args.compare_only, ref_dir, result_dir, args.tolerance, args.xml_report, process_controller):
+        success = run_tests(env, tests, args.run_only, args.compare_only, ref_dir, result_dir, args.tolerance, args.xml_report, process_controller, image_comparator, incremental, args.batch_scenes, args.shard, args.resume)
+        image_comparator.shutdown()
+        if process_controller.worker_pool:
+            process_controller.worker_pool.shutdown()
+
+        # Precompute metric maps shown by view_image_tests.
+        if args.precompute_metrics and not args.run_only:
+            precompute_metric_maps(env, result_dir)
+
+        if not success:
             sys.exit(1)
 
     sys.exit(0)
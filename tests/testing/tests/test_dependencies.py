@@ -0,0 +1,88 @@
+import os
+import sys
+import unittest
+import tempfile
+from unittest import mock
+from types import SimpleNamespace
+from pathlib import Path
+
+sys.path.append(str(Path(__file__).resolve().parents[1]))
+from core import config, dependencies
+
+project_dir = Path(__file__).resolve().parents[3]
+
+
+def image_tests():
+    tests_dir = project_dir / config.IMAGE_TESTS_DIR
+    return [SimpleNamespace(name=f.relative_to(tests_dir).with_suffix('').as_posix(), script_file=f) for f in sorted(tests_dir.glob('**/test_*.py'))]
+
+
+class TestDependencies(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.tests = image_tests()
+        cls.index = dependencies.DependencyIndex(project_dir, cls.tests)
+
+    def test_all_tests_create_passes(self):
+        # Every image test renders a graph, so a test without passes indicates a load that is not followed.
+        for test in self.tests:
+            deps = dependencies.collect_dependencies(test.script_file)
+            self.assertTrue(len(deps['passes']) > 0 or len(deps['dynamic']) > 0, f'{test.name} creates no render passes')
+
+    def test_executed_scripts(self):
+        deps = dependencies.collect_dependencies(project_dir / config.IMAGE_TESTS_DIR / 'renderscripts/test_PathTracer.py')
+        self.assertIn((project_dir / 'scripts/PathTracer.py').resolve(), deps['scripts'])
+        self.assertIn('PathTracer', deps['passes'])
+
+    def test_affected_tests(self):
+        cases = {
+            'Source/RenderPasses/PathTracer/PathTracer.cpp': 'renderscripts/test_PathTracer',
+            'Source/RenderPasses/RTXDIPass/RTXDIPass.cpp': 'renderscripts/test_RTXDI',
+            'scripts/PathTracer.py': 'renderscripts/test_PathTracer',
+            'scripts/RTXDI.py': 'renderscripts/test_RTXDI',
+        }
+        for changed_file, test_name in cases.items():
+            affected, global_files = self.index.affected_tests([changed_file])
+            self.assertIn(test_name, affected, changed_file)
+            self.assertEqual(global_files, [])
+
+    def test_dynamic_loads(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            script_file = Path(tmp_dir) / 'test_dynamic.py'
+            script_file.write_text("import os\nexec(open(os.environ['GRAPH']).read())\n")
+            static_file = Path(tmp_dir) / 'test_static.py'
+            static_file.write_text("exec(open('graph.py').read())\n")
+            (Path(tmp_dir) / 'graph.py').write_text("g = createPass('ToneMapper')\n")
+
+            deps = dependencies.collect_dependencies(static_file)
+            self.assertEqual(deps['dynamic'], [])
+            self.assertEqual(deps['passes'], ['ToneMapper'])
+
+            tests = [SimpleNamespace(name='dynamic', script_file=script_file), SimpleNamespace(name='static', script_file=static_file)]
+            index = dependencies.DependencyIndex(project_dir, tests)
+            self.assertEqual(list(index.dynamic.keys()), ['dynamic'])
+            affected, _ = index.affected_tests(['Source/RenderPasses/TAA/TAA.cpp'])
+            self.assertEqual(affected, { 'dynamic' })
+            affected, _ = index.affected_tests(['README.md'])
+            self.assertEqual(affected, set())
+
+    def test_cache(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            script_file = Path(tmp_dir) / 'test_cached.py'
+            script_file.write_text("exec(open('graph.py').read())\n")
+            graph_file = Path(tmp_dir) / 'graph.py'
+            graph_file.write_text("g = createPass('ToneMapper')\n")
+            self.assertEqual(dependencies.collect_dependencies(script_file)['passes'], ['ToneMapper'])
+
+            # Unchanged scripts are not analyzed again.
+            with mock.patch.object(dependencies, 'analyze_script', side_effect=AssertionError('analyzed again')):
+                self.assertEqual(dependencies.collect_dependencies(script_file)['passes'], ['ToneMapper'])
+
+            # Changes to executed scripts invalidate the cache.
+            graph_file.write_text("g = createPass('AccumulatePass')\n")
+            os.utime(graph_file, ns=(0, 0))
+            self.assertEqual(dependencies.collect_dependencies(script_file)['passes'], ['AccumulatePass'])
+
+
+if __name__ == '__main__':
+    unittest.main()
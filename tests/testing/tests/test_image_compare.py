@@ -0,0 +1,166 @@
+import sys
+import unittest
+import tempfile
+from unittest import mock
+from pathlib import Path
+
+import numpy as np
+
+sys.path.append(str(Path(__file__).resolve().parents[1]))
+from core import image_compare
+
+
+def write_pfm(path, image):
+    '''
+    Write a float32 RGB image of shape (height, width, 3) as a little-endian PFM file.
+    '''
+    height, width = image.shape[0:2]
+    with open(path, 'wb') as f:
+        f.write(f'PF\n{width} {height}\n-1.0\n'.encode())
+        f.write(np.flipud(image).astype('<f4').tobytes())
+
+
+def reference_compare(metric, image_a, image_b, alpha):
+    '''
+    Port of the error loop of ImageCompare using scalar float (np.float32) and double (float) arithmetic.
+    Returns the total error and the per-pixel error map (stored as float).
+    '''
+    height, width = image_a.shape[0:2]
+    channels = 4 if alpha else 3
+    error_map = np.zeros((height, width), dtype=np.float32)
+    total = 0.0
+    for y in range(height):
+        for x in range(width):
+            error = 0.0
+            for c in range(channels):
+                a, b = image_a[y, x, c], image_b[y, x, c]
+                if metric == 'mse':
+                    error += float((a - b) * (a - b))
+                elif metric == 'rmse':
+                    error += float((a - b) * (a - b)) / (float(a * a) + 1e-3)
+                elif metric == 'mae':
+                    error += abs(float((a - b) * (a - b)))
+                elif metric == 'mape':
+                    error += abs(float(a - b) / (float(a) + 1e-3))
+            error = 100.0 * error / channels if metric == 'mape' else error / channels
+            error_map[y, x] = error
+            total += error
+    return total / (width * height), error_map
+
+
+class TestImageCompare(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.dir = Path(self.tmp_dir.name)
+        self.rng = np.random.default_rng(1)
+        self.comparator = image_compare.ImageComparator(None, backend='numpy', thread_count=1)
+
+    def tearDown(self):
+        self.comparator.shutdown()
+        self.tmp_dir.cleanup()
+
+    def random_image(self, height, width):
+        return self.rng.random((height, width, 4), dtype=np.float32) * np.float32(2)
+
+    def write_image(self, name, image):
+        path = self.dir / name
+        write_pfm(path, image[:, :, 0:3])
+        return path
+
+    def test_matches_image_compare(self):
+        image_a = self.random_image(9, 7)
+        image_b = image_a + self.rng.normal(0, 0.1, image_a.shape).astype(np.float32)
+        for metric in image_compare.METRICS:
+            for alpha in [False, True]:
+                expected_error, expected_map = reference_compare(metric, image_a, image_b, alpha)
+                error_map = image_compare.compute_error_map(metric, image_a, image_b, alpha)
+                self.assertEqual(image_compare.compute_error(metric, error_map), expected_error, (metric, alpha))
+                np.testing.assert_array_equal(error_map.astype(np.float32), expected_map)
+                # Comparing in bands of tiles gives the identical total error.
+                success, error, _, _, _, stopped = image_compare.compare_tiled(metric, 1e6, image_a, image_b, 4, alpha=alpha)
+                self.assertEqual(error, expected_error, (metric, alpha))
+                self.assertTrue(success)
+                self.assertFalse(stopped)
+
+    def test_hash_fast_path(self):
+        image = self.random_image(8, 8)
+        ref_file = self.write_image('ref.pfm', image)
+        result_file = self.write_image('result.pfm', image)
+        result = self.comparator.compare(ref_file, result_file, 0.0)
+        self.assertEqual((result['success'], result['error'], result['method']), (True, 0.0, 'hash'))
+
+        # The reference is not decoded again once its digest is cached.
+        with mock.patch.object(image_compare, 'load_pfm', wraps=image_compare.load_pfm) as load_pfm:
+            self.assertEqual(self.comparator.compare(ref_file, result_file, 0.0)['method'], 'hash')
+        self.assertEqual(load_pfm.call_count, 1)
+
+        # Identical images with non-finite pixels always fail.
+        image[0, 0, 0] = np.nan
+        ref_file = self.write_image('ref_nan.pfm', image)
+        result_file = self.write_image('result_nan.pfm', image)
+        result = self.comparator.compare(ref_file, result_file, 0.0)
+        self.assertEqual((result['success'], result['method']), (False, 'metric'))
+
+    def test_worst_tiles_and_early_exit(self):
+        tile_size = image_compare.config.COMPARE_TILE_SIZE
+        image_a = self.random_image(4 * tile_size, 3 * tile_size)
+        image_b = image_a.copy()
+        image_b[tile_size + 2, 2 * tile_size + 5, 0:3] += 1
+        ref_file = self.write_image('ref.pfm', image_a)
+        result_file = self.write_image('result.pfm', image_b)
+        result = self.comparator.compare(ref_file, result_file, 0.0)
+        self.assertFalse(result['success'])
+        self.assertFalse(result['early_exit'])
+        self.assertEqual(len(result['worst_tiles']), 1)
+        tile = result['worst_tiles'][0]
+        self.assertEqual((tile['x'], tile['y'], tile['width'], tile['height']), (2 * tile_size, tile_size, tile_size, tile_size))
+        self.assertAlmostEqual(tile['mean_error'], tile['max_error'] / tile_size ** 2)
+
+        # With early exit, the comparison stops after the band containing the difference.
+        success, error, error_map, tile_means, _, stopped = image_compare.compare_tiled('mse', 0.0, image_a, image_b, tile_size, early_exit=True)
+        self.assertFalse(success)
+        self.assertTrue(stopped)
+        self.assertEqual(error_map.shape, (2 * tile_size, 3 * tile_size))
+        self.assertEqual(tile_means.shape, (2, 3))
+        self.assertLessEqual(error, result['error'])
+        self.assertGreater(error, 0.0)
+
+    def test_decoded_cache(self):
+        cache = image_compare.DecodedImageCache(self.dir / 'cache')
+        image = self.random_image(5, 6)
+        path = self.write_image('ref.pfm', image)
+        decoded = cache.load(path)
+        cached = cache.load(path)
+        self.assertEqual((cache.misses, cache.hits), (1, 1))
+        self.assertIsInstance(cached, np.memmap)
+        np.testing.assert_array_equal(cached, decoded)
+
+        # Changed files are decoded again.
+        image[0, 0, 0] += 1
+        write_pfm(path, image[:, :, 0:3])
+        np.testing.assert_array_equal(cache.load(path), image_compare.load_image(path))
+        self.assertEqual((cache.misses, cache.hits), (2, 1))
+
+    def test_malformed_pfm(self):
+        ref_file = self.write_image('ref.pfm', self.random_image(4, 4))
+        result_file = self.dir / 'result.pfm'
+        result_file.write_bytes(b'PF\nfoo 4\n-1.0\n')
+        with self.assertRaises(image_compare.UnsupportedImageError):
+            image_compare.load_pfm(result_file)
+
+        # The comparison fails instead of raising (malformed images are left to ImageCompare if not compared statistically).
+        result = self.comparator.compare(ref_file, result_file, 0.0, statistical={ 'variance': 'capture', 'tile_size': 4, 'fdr': 0.01 })
+        self.assertEqual((result['success'], result['method']), (False, 'statistical'))
+        exe_result = { 'success': False, 'error': None, 'backend': 'exe', 'method': 'metric', 'message': 'Cannot read image' }
+        with mock.patch.object(self.comparator, 'compare_exe', return_value=exe_result) as compare_exe:
+            self.assertFalse(self.comparator.compare(ref_file, result_file, 0.0)['success'])
+        compare_exe.assert_called_once()
+
+        # Errors of other decoders fail the comparison as well.
+        with mock.patch.object(image_compare, 'load_image', side_effect=ValueError('bad image')):
+            result = self.comparator.compare(ref_file, result_file, 0.0)
+        self.assertEqual((result['success'], result['message']), (False, 'Cannot load image (bad image).'))
+
+
+if __name__ == '__main__':
+    unittest.main()
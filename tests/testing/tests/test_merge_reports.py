@@ -0,0 +1,59 @@
+import sys
+import json
+import unittest
+import tempfile
+from pathlib import Path
+from xml.etree import ElementTree as ET
+
+sys.path.append(str(Path(__file__).resolve().parents[1]))
+import merge_reports
+from core import reports
+
+
+def result(name, result, messages=[]):
+    return { 'name': name, 'elapsed_time': 1.5, 'result': result, 'messages': messages }
+
+
+class TestMergeReports(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.dir = Path(self.tmp_dir.name)
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def write_shard(self, index, results):
+        shard_dir = self.dir / f'shard_{index}'
+        for r in results:
+            (shard_dir / r['name']).mkdir(parents=True)
+            (shard_dir / r['name'] / 'report.json').write_text(json.dumps({ 'name': r['name'], 'result': r['result'], 'duration': r['elapsed_time'] }))
+        reports.write_json(shard_dir / 'report.json', {
+            'date': f'2024-01-01T00:00:0{index}', 'result': 'FAILED' if any(r['result'] == 'FAILED' for r in results) else 'PASSED',
+            'tests': [r['name'] for r in results], 'duration': 10.0 + index, 'shard': index
+        })
+        reports.write_xml_report(self.dir / f'shard_{index}.xml', results)
+        return shard_dir
+
+    def test_merge(self):
+        shard_dirs = [
+            self.write_shard(0, [result('test_a', 'PASSED'), result('test_b', 'FAILED', ['error'])]),
+            self.write_shard(1, [result('test_c', 'SKIPPED'), result('test_d', 'PASSED')])
+        ]
+        output_dir = self.dir / 'merged'
+        merged = merge_reports.merge_run_dirs(shard_dirs, output_dir)
+        self.assertEqual(merged['result'], 'FAILED')
+        self.assertEqual(merged['tests'], ['test_a', 'test_b', 'test_c', 'test_d'])
+        self.assertEqual(merged['duration'], 11.0)
+        self.assertEqual(json.loads((output_dir / 'report.json').read_text()), merged)
+        self.assertTrue((output_dir / 'test_d' / 'report.json').exists())
+
+        xml_file = self.dir / 'merged.xml'
+        merge_reports.merge_xml_reports([self.dir / 'shard_0.xml', self.dir / 'shard_1.xml'], xml_file)
+        suite = ET.parse(xml_file).getroot().find('testsuite')
+        self.assertEqual([t.get('name') for t in suite.iter('testcase')], ['test_a', 'test_b', 'test_c', 'test_d'])
+        self.assertEqual((suite.get('tests'), suite.get('failures'), suite.get('errors'), suite.get('skipped')), ('4', '1', '0', '1'))
+        self.assertEqual([p.name for p in self.dir.iterdir() if p.name.endswith('.tmp')], [])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,107 @@
+import os
+import sys
+import json
+import unittest
+import tempfile
+from unittest import mock
+from pathlib import Path
+
+sys.path.append(str(Path(__file__).resolve().parents[1]))
+from core import config, mirror
+
+
+class TestMirror(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.src = Path(self.tmp_dir.name) / 'src'
+        self.dst = Path(self.tmp_dir.name) / 'dst'
+        self.src.mkdir()
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def write(self, path, data, mtime=1_600_000_000):
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_bytes(data)
+        os.utime(path, (mtime, mtime))
+
+    def write_manifest(self, dir, manifest):
+        self.write(dir / config.REF_MANIFEST_FILE, json.dumps(manifest).encode())
+
+    def mirror(self):
+        success, log = mirror.mirror_folders(self.src, self.dst, threads=4)
+        self.assertTrue(success, log)
+        return log
+
+    def files(self, dir):
+        return sorted(p.relative_to(dir).as_posix() for p in dir.rglob('*') if p.is_file())
+
+    def test_copy(self):
+        self.write(self.src / 'a.png', b'aaaa')
+        self.write(self.src / 'sub/dir/b.png', b'bb')
+        log = self.mirror()
+        self.assertIn('2 files copied', log)
+        self.assertEqual(self.files(self.dst), ['a.png', 'sub/dir/b.png'])
+        self.assertEqual((self.dst / 'sub/dir/b.png').read_bytes(), b'bb')
+        self.assertEqual((self.dst / 'a.png').stat().st_mtime_ns, (self.src / 'a.png').stat().st_mtime_ns)
+        # Mirroring again copies nothing.
+        self.assertIn('0 files copied (0.0 MB), 2 unchanged', self.mirror())
+
+    def test_mtime_tolerance(self):
+        self.write(self.src / 'a.png', b'aaaa')
+        self.write(self.src / 'b.png', b'bbbb')
+        # Same size and modification time within the tolerance: unchanged (even though the contents differ).
+        self.write(self.dst / 'a.png', b'xxxx', mtime=1_600_000_000 + config.MIRROR_MTIME_TOLERANCE / 2)
+        # Modification time outside the tolerance: copied.
+        self.write(self.dst / 'b.png', b'xxxx', mtime=1_600_000_000 + config.MIRROR_MTIME_TOLERANCE * 2)
+        self.assertIn('1 files copied (0.0 MB), 1 unchanged', self.mirror())
+        self.assertEqual((self.dst / 'a.png').read_bytes(), b'xxxx')
+        self.assertEqual((self.dst / 'b.png').read_bytes(), b'bbbb')
+
+    def test_manifest_digests(self):
+        self.write(self.src / 'a.png', b'aaaa')
+        self.write(self.src / 'b.png', b'bbbb')
+        self.write_manifest(self.src, { 'a.png': 'digest_a', 'b.png': 'digest_b' })
+        # Same digest: unchanged regardless of the modification time.
+        self.write(self.dst / 'a.png', b'aaaa', mtime=1_700_000_000)
+        # Different digest: copied even though size and modification time match.
+        self.write(self.dst / 'b.png', b'xxxx')
+        self.write_manifest(self.dst, { 'a.png': 'digest_a', 'b.png': 'digest_old' })
+        self.mirror()
+        self.assertEqual((self.dst / 'a.png').stat().st_mtime, 1_700_000_000)
+        self.assertEqual((self.dst / 'b.png').read_bytes(), b'bbbb')
+        self.assertEqual(json.loads((self.dst / config.REF_MANIFEST_FILE).read_text())['b.png'], 'digest_b')
+
+    def test_delete_extraneous(self):
+        self.write(self.src / 'a.png', b'aaaa')
+        self.write(self.dst / 'a.png', b'aaaa')
+        self.write(self.dst / 'old.png', b'old')
+        self.write(self.dst / 'old_dir/c.png', b'c')
+        self.write(self.dst / 'old_dir/.hidden', b'h')
+        log = self.mirror()
+        self.assertIn('2 extraneous files deleted', log)
+        self.assertEqual(self.files(self.dst), ['a.png'])
+        self.assertFalse((self.dst / 'old_dir').exists())
+
+    def test_interrupted_copy(self):
+        self.write(self.src / 'a.png', b'aaaa' * 1024)
+        self.write(self.dst / 'a.png', b'old')
+        def interrupted_copy(src, dst):
+            Path(dst).write_bytes(b'aa')
+            raise KeyboardInterrupt()
+        with mock.patch.object(mirror.shutil, 'copy2', interrupted_copy):
+            with self.assertRaises(KeyboardInterrupt):
+                mirror.mirror_folders(self.src, self.dst, threads=4)
+        # The destination keeps the old file and no temporary file is left behind.
+        self.assertEqual(self.files(self.dst), ['a.png'])
+        self.assertEqual((self.dst / 'a.png').read_bytes(), b'old')
+
+        # Temporary files of runs killed during a copy are deleted by the next run.
+        self.write(self.dst / ('.a.png.tmp1234' + mirror.TMP_SUFFIX), b'aa')
+        self.mirror()
+        self.assertEqual(self.files(self.dst), ['a.png'])
+        self.assertEqual((self.dst / 'a.png').read_bytes(), b'aaaa' * 1024)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,47 @@
+import sys
+import unittest
+import tempfile
+from pathlib import Path
+
+import numpy as np
+
+sys.path.append(str(Path(__file__).resolve().parents[1]))
+from core import previews
+from test_image_compare import write_pfm
+
+
+class TestPreviews(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.dir = Path(self.tmp_dir.name)
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def test_ldr(self):
+        # Images that are not downsampled keep their pixel values.
+        values = np.arange(256, dtype=np.uint8)
+        data = np.stack([values, values[::-1], values, np.full(256, 255, dtype=np.uint8)], axis=-1).reshape(16, 16, 4)
+        path = self.dir / 'image.png'
+        previews.PILImage.fromarray(data, 'RGBA').save(path)
+        np.testing.assert_array_equal(previews.make_preview(path, 16), data)
+
+        # Blocks are averaged in linear space: black and white average to linear 0.5 (188 in sRGB).
+        data = np.zeros((2, 2, 4), dtype=np.uint8)
+        data[:, :, 3] = 255
+        data[0, :, 0:3] = 255
+        previews.PILImage.fromarray(data, 'RGBA').save(path)
+        np.testing.assert_array_equal(previews.make_preview(path, 1), [[[188, 188, 188, 255]]])
+
+    def test_hdr_non_finite(self):
+        image = np.full((2, 2, 3), 0.5, dtype=np.float32)
+        image[0, 0] = [np.nan, np.inf, -np.inf]
+        path = self.dir / 'image.pfm'
+        write_pfm(path, image)
+        preview = previews.make_preview(path, 2)
+        np.testing.assert_array_equal(preview[0, 0], [0, 255, 0, 255])
+        np.testing.assert_array_equal(preview[1, 1], [188, 188, 188, 255])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,92 @@
+import io
+import sys
+import json
+import unittest
+import tempfile
+import multiprocessing
+from unittest import mock
+from pathlib import Path
+
+sys.path.append(str(Path(__file__).resolve().parents[1]))
+from core import config, helpers, refstore
+
+
+def register_trees(objects_dir, trees):
+    store = refstore.ObjectStore(objects_dir)
+    for tree in trees:
+        store.register_tree(tree)
+
+
+class TestRefStore(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.dir = Path(self.tmp_dir.name)
+        self.store = refstore.ObjectStore(self.dir / 'objects', link_mode='symlink')
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def write(self, path, data):
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_bytes(data)
+
+    def test_store_and_gc(self):
+        tree = self.dir / 'refs/a'
+        self.write(tree / 'test_a/frame.png', b'a')
+        self.write(tree / 'test_b/frame.png', b'a')
+        self.assertEqual(self.store.store_tree(tree), (2, 1))
+        self.assertTrue((tree / 'test_a/frame.png').is_symlink())
+        self.assertEqual(self.store.gc(), (0, 0))
+        # Objects only referenced by a tree without manifest are removed.
+        (tree / config.REF_MANIFEST_FILE).unlink()
+        self.assertEqual(self.store.gc(), (1, 1))
+        self.assertEqual(json.loads(self.store.trees_file.read_text()), [])
+        self.assertEqual(list(self.store.objects_dir.glob('*/*')), [])
+
+    def test_concurrent_registration(self):
+        # Registrations of processes sharing a store are never lost.
+        trees = [[str(self.dir / f'tree_{i}_{j}') for j in range(20)] for i in range(4)]
+        processes = [multiprocessing.Process(target=register_trees, args=(self.store.objects_dir, t)) for t in trees]
+        for p in processes:
+            p.start()
+        for p in processes:
+            p.join()
+        self.assertEqual(len(self.store.load_trees()), 80)
+        self.assertEqual([p.name for p in self.store.objects_dir.iterdir() if p.name.endswith('.tmp')], [])
+
+    def test_pull_without_manifest(self):
+        remote = self.dir / 'remote'
+        tree = self.dir / 'refs/a'
+        self.write(remote / 'test_a/frame.png', b'a')
+        self.write(remote / 'test_b/frame.png', b'b')
+        self.write(remote / 'test_b/log.txt', b'log')
+        self.write(tree / 'test_c/frame.png', b'c')
+        digest_cache = helpers.FileCache()
+
+        reads = []
+        def counting_open(path, *args, **kwargs):
+            if Path(path).parent.parent == remote and refstore.is_image(Path(path)):
+                reads.append(Path(path).relative_to(remote).as_posix())
+            return io.open(path, *args, **kwargs)
+
+        with mock.patch('builtins.open', counting_open):
+            self.assertEqual(self.store.pull_tree(remote, tree, digest_cache), (2, 2))
+        # Images are read once (hashed while copying).
+        self.assertEqual(sorted(reads), ['test_a/frame.png', 'test_b/frame.png'])
+        self.assertEqual((tree / 'test_b/frame.png').read_bytes(), b'b')
+        self.assertEqual((tree / 'test_b/log.txt').read_bytes(), b'log')
+        # Extraneous files are deleted including their directories.
+        self.assertFalse((tree / 'test_c').exists())
+        self.assertEqual(refstore.load_manifest(tree)['test_a/frame.png'], helpers.file_digest(remote / 'test_a/frame.png'))
+
+        # Unchanged remote images are not read again.
+        reads.clear()
+        self.write(remote / 'test_a/frame.png', b'aa')
+        with mock.patch('builtins.open', counting_open):
+            self.assertEqual(self.store.pull_tree(remote, tree, digest_cache), (2, 1))
+        self.assertEqual(reads, ['test_a/frame.png'])
+        self.assertEqual((tree / 'test_a/frame.png').read_bytes(), b'aa')
+
+
+if __name__ == '__main__':
+    unittest.main()
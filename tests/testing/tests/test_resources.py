@@ -0,0 +1,56 @@
+import os
+import sys
+import time
+import signal
+import unittest
+import tempfile
+import subprocess
+from unittest import mock
+from pathlib import Path
+
+sys.path.append(str(Path(__file__).resolve().parents[1]))
+from core import config, output, resources
+
+# Starts a process inheriting stdout/stderr that outlives the parent and writes its pid to a file.
+SCRIPT = '''
+import sys, subprocess
+sys.stderr.write('parent output\\n')
+child = subprocess.Popen([sys.executable, '-c', 'import time; time.sleep(60)'])
+open(sys.argv[1], 'w').write(str(child.pid))
+'''
+
+
+class TestCommunicate(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.dir = Path(self.tmp_dir.name)
+        self.pid_file = self.dir / 'child.pid'
+
+    def tearDown(self):
+        if self.pid_file.exists():
+            try:
+                os.kill(int(self.pid_file.read_text()), signal.SIGTERM)
+            except OSError:
+                pass
+        self.tmp_dir.cleanup()
+
+    def start(self):
+        return subprocess.Popen([sys.executable, '-c', SCRIPT, str(self.pid_file)], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+
+    @mock.patch.object(config, 'OUTPUT_PIPE_TIMEOUT', 0.5)
+    def test_inherited_pipes(self):
+        start_time = time.time()
+        resources.communicate(self.start(), timeout=30)
+        self.assertLess(time.time() - start_time, 10)
+
+    @mock.patch.object(config, 'OUTPUT_PIPE_TIMEOUT', 0.5)
+    def test_inherited_pipes_capture(self):
+        capture = output.OutputCapture(self.dir / 'logs')
+        start_time = time.time()
+        resources.communicate(self.start(), timeout=30, output=capture)
+        self.assertLess(time.time() - start_time, 10)
+        self.assertIn('parent output', capture.errors())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,58 @@
+import sys
+import random
+import unittest
+from types import SimpleNamespace
+from pathlib import Path
+
+sys.path.append(str(Path(__file__).resolve().parents[1]))
+from core import scheduling
+
+
+def make_tests(count):
+    return [SimpleNamespace(name=f'renderpasses/test_{i:03d}_vulkan') for i in range(count)]
+
+
+class TestShardTests(unittest.TestCase):
+    def shards(self, tests, durations, count):
+        return [scheduling.shard_tests(tests, durations, i, count) for i in range(count)]
+
+    def test_partition(self):
+        tests = make_tests(50)
+        durations = { t.name: float(i % 7 + 1) for i, t in enumerate(tests[0:30]) }
+        shards = self.shards(tests, durations, 4)
+        # Every test is in exactly one shard, and shards keep the order of tests.
+        self.assertEqual(sorted(t.name for s in shards for t in s), [t.name for t in tests])
+        for shard in shards:
+            self.assertEqual(shard, [t for t in tests if t in shard])
+
+    def test_deterministic(self):
+        tests = make_tests(50)
+        durations = { t.name: float(i % 5 + 1) for i, t in enumerate(tests) }
+        shards = self.shards(tests, durations, 3)
+        # The partition does not depend on the order of tests or durations.
+        shuffled = list(tests)
+        random.Random(1).shuffle(shuffled)
+        shuffled_durations = dict(reversed(list(durations.items())))
+        for shard, shuffled_shard in zip(shards, self.shards(shuffled, shuffled_durations, 3)):
+            self.assertEqual(sorted(t.name for t in shard), sorted(t.name for t in shuffled_shard))
+
+    def test_balance(self):
+        tests = make_tests(40)
+        rng = random.Random(2)
+        durations = { t.name: rng.uniform(1.0, 100.0) for t in tests }
+        loads = [sum(durations[t.name] for t in shard) for shard in self.shards(tests, durations, 4)]
+        # Longest processing time first is within a factor of 4/3 of the optimum, which is at least the mean load.
+        self.assertLessEqual(max(loads), 4 / 3 * sum(loads) / len(loads))
+
+    def test_hash_fallback(self):
+        tests = make_tests(20)
+        # Tests without durations are assigned by a stable hash of their name, independent of other tests.
+        shards = self.shards(tests, {}, 3)
+        for i, shard in enumerate(shards):
+            for test in shard:
+                self.assertEqual(scheduling.stable_hash(test.name) % 3, i)
+        self.assertIn(tests[5], scheduling.shard_tests(tests[5:6], {}, scheduling.stable_hash(tests[5].name) % 3, 3))
+
+
+if __name__ == '__main__':
+    unittest.main()
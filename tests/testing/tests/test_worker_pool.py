@@ -0,0 +1,89 @@
+import sys
+import time
+import unittest
+import tempfile
+from pathlib import Path
+
+testing_dir = Path(__file__).resolve().parents[1]
+sys.path.append(str(testing_dir))
+from core import worker_pool
+
+SCRIPTS = {
+    'ok': "m.frameCapture.baseFilename = 'ok'\nm.frameCapture.capture()\nexit()\n",
+    'noise': "import sys\nsys.stderr.write('noise from earlier job\\n')\nsys.stderr.flush()\n",
+    'error': "raise ValueError('script failed')\n",
+    'crash': "import os, sys\nsys.stderr.write('crashing now\\n')\nsys.stderr.flush()\nos._exit(3)\n",
+    'hang': "import time\ntime.sleep(60)\n",
+}
+
+
+class TestWorkerPool(unittest.TestCase):
+    '''
+    Runs the worker pool against fake_mogwai.py, which stands in for Mogwai without a GPU.
+    '''
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.dir = Path(self.tmp_dir.name)
+        for name, script in SCRIPTS.items():
+            (self.dir / f'{name}.py').write_text(script)
+        self.timeouts = 0
+        make_args = lambda device_type: [sys.executable, str(testing_dir / 'fake_mogwai.py'), '--script', str(testing_dir / 'mogwai_worker.py'), '--device-type', device_type]
+        self.pool = worker_pool.WorkerPool(make_args, 1, self.dir, self.dir / 'logs', startup_timeout=30, max_jobs=3, on_timeout=self.on_timeout)
+
+    def tearDown(self):
+        self.pool.shutdown()
+        self.tmp_dir.cleanup()
+
+    def on_timeout(self):
+        self.timeouts += 1
+
+    def run_job(self, name, timeout=30):
+        job = { 'cwd': str(self.dir), 'script': str(self.dir / f'{name}.py'), 'log_file': str(self.dir / f'{name}.log'), 'run_only': False }
+        return self.pool.run_job('vulkan', job, timeout)
+
+    def test_ok(self):
+        success, errors, _ = self.run_job('ok')
+        self.assertTrue(success, errors)
+        self.assertEqual(errors, [])
+        self.assertTrue((self.dir / 'ok.fake.png').exists())
+
+    def test_error(self):
+        success, errors, _ = self.run_job('error')
+        self.assertFalse(success)
+        self.assertTrue(any('script failed' in e for e in errors), errors)
+        # The worker survives script errors.
+        self.assertEqual(self.pool.started_count, 1)
+        self.assertTrue(self.run_job('ok')[0])
+        self.assertEqual(self.pool.started_count, 1)
+
+    def test_crash(self):
+        self.assertTrue(self.run_job('noise')[0])
+        # Let the output reader consume the stderr of the previous job.
+        time.sleep(0.5)
+        success, errors, _ = self.run_job('crash')
+        self.assertFalse(success)
+        self.assertIn('crashing now', errors)
+        self.assertNotIn('noise from earlier job', errors)
+        self.assertTrue(any('return code 3' in e for e in errors), errors)
+        # A new worker replaces the crashed one.
+        self.assertTrue(self.run_job('ok')[0])
+        self.assertEqual(self.pool.started_count, 2)
+
+    def test_timeout(self):
+        success, errors, _ = self.run_job('hang', timeout=1)
+        self.assertFalse(success)
+        self.assertIn('Process killed due to timeout', errors)
+        self.assertEqual(self.timeouts, 1)
+        self.assertTrue(self.run_job('ok')[0])
+        self.assertEqual(self.pool.started_count, 2)
+
+    def test_recycle(self):
+        for _ in range(4):
+            self.assertTrue(self.run_job('ok')[0])
+        # Workers are recycled after max_jobs (3) jobs.
+        self.assertEqual(self.pool.started_count, 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
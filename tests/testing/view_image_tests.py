@@ -2,6 +2,7 @@
 Script for viewing image test results.
 '''
 
+import os
 import sys
 import time
 import datetime
@@ -13,9 +14,9 @@ import webbrowser
 from pathlib import Path
 
 import libs.bottle as bottle
-from libs.bottle import route, view, request, run, template, static_file
+from libs.bottle import route, view, request, run, template, static_file, HTTPResponse
 
-from core import Environment, config, helpers
+from core import Environment, config, helpers, result_index, previews, metric_maps, wsgi_server
 
 # Directory containing viewer files.
 VIEWER_DIR = Path(__file__).parent / 'viewer'
@@ -48,9 +49,35 @@ MIME_TYPES = {
     '.wasm': 'application/wasm',
 }
 
+# Interval (in seconds) for saving and pruning the image preview and metric map caches.
+CACHE_SAVE_INTERVAL = 60
+
+class ThreadedServer(bottle.ServerAdapter):
+    '''
+    Server adapter for the thread pool based server (see core/wsgi_server.py).
+    '''
+    def run(self, handler):
+        server = wsgi_server.ThreadPoolWSGIServer(self.host, self.port, handler, workers=self.options.get('workers', config.VIEWER_SERVER_WORKERS), quiet=self.quiet)
+        try:
+            server.serve_forever()
+        finally:
+            server.server_close()
+
+# Servers that can be used for running the viewer.
+SERVERS = {
+    'wsgiref': bottle.WSGIRefServer,
+    'threaded': ThreadedServer
+}
+
 # Global database instance.
 database = None
 
+# Global image preview cache (None if previews are not available).
+preview_cache = None
+
+# Global metric map cache (None if metric maps are not available).
+metric_cache = None
+
 class Database:
     '''
     Helper for accessing image test results.
@@ -83,6 +110,7 @@ class Database:
         self.ref_dir = Path(ref_dir)
         self.run_tags = run_tags
         self.run_glob = run_glob
+        self.index = result_index.ResultIndex(env.project_dir / config.CACHE_DIR / config.VIEWER_INDEX_FILE, self.result_dir, run_glob)
 
     def run_report_file(self, run_dir):
         '''
@@ -96,45 +124,28 @@ class Database:
         '''
         return self.result_dir / run_dir / test_dir / 'report.json'
 
-    def load_runs(self):
+    def run_tags_of(self, run_dir):
         '''
-        Load list of all runs (not including reports of individual tests).
+        Return the tags of a run (extracted from the run directory).
         '''
-        runs = []
-
-        for run_report_file in self.result_dir.glob(self.run_glob):
-            run = self.load_run(run_report_file, load_tests=False)
-            if run:
-                runs.append(run)
-
-        # Sort by date.
-        runs.sort(key=lambda r: r['date'], reverse=True)
+        return { k:v for [k, v] in zip(self.run_tags, run_dir.split('/'))}
 
-        return runs
-
-    def load_run(self, run_report_file, load_tests=True):
+    def load_run(self, run_dir, load_tests=True):
         '''
-        Load a single run (including reports of individual tests by default).
+        Load a single run from the index (including reports of individual tests by default).
         '''
-        run_dir = run_report_file.parent.relative_to(self.result_dir).as_posix()
-        run = load_json(run_report_file)
+        run = self.index.run(run_dir)
+        if run == None and self.run_report_file(run_dir).exists():
+            self.index.update_run(run_dir)
+            run = self.index.run(run_dir)
         if not run:
             return None
 
-        run_values = str(run_dir).split('/')
-        run_tags = { k:v for [k, v] in zip(self.run_tags, run_values)}
-        run['run_dir'] = str(run_dir)
-        run['run_tags'] = run_tags
+        run['run_dir'] = run_dir
+        run['run_tags'] = self.run_tags_of(run_dir)
 
         if load_tests:
-            tests = []
-
-            for test_report_file in (self.result_dir / run_dir).glob('*/**/report.json'):
-                test = self.load_test(test_report_file, load_log=False)
-                if test:
-                    tests.append(test)
-
-            run['tests'] = tests
+            run['tests'] = self.index.tests(run_dir)
 
         return run
 
@@ -164,16 +175,16 @@ def load_json(path):
     except:
         return None
 
-def run_stats(run):
+def run_stats(result_counts):
     '''
-    Compute stats bar data for a run.
+    Compute stats bar data for a run (given the number of tests per result).
     '''
-    total_count = len(run['tests'])
+    total_count = sum(result_counts.values())
     if total_count == 0:
         return []
     stats = []
     for result, color in zip(['PASSED', 'SKIPPED', 'FAILED'], ['#32b643', '#ffb700', '#e85600']):
-        count = len(list(filter(lambda test: test['result'] == result, run['tests'])))
+        count = result_counts.get(result, 0)
         stats.append({
             'title': result,
             'percentage': round(100 * count / total_count, 1),
@@ -198,9 +209,10 @@ def test_stats(test):
         })
     return stats
 
-def create_jeri_data(result_image, ref_image, error_image, extra_metrics=['L1', 'L2', 'MAPE', 'MRSE', 'SMAPE', 'SSIM']):
+def create_jeri_data(result_image, ref_image, error_image, extra_metrics=['L1', 'L2', 'MAPE', 'MRSE', 'SMAPE', 'SSIM'], metric_images=None):
     '''
     Create a jeri config object for comparing two images.
+    If metric_images is given (mapping metrics to precomputed map images), the maps are not computed by jeri.
     '''
     jeri_data = {
         'title': 'root',
@@ -222,17 +234,26 @@ def create_jeri_data(result_image, ref_image, error_image, extra_metrics=['L1',
     }
 
     for metric in extra_metrics:
-        jeri_data['children'].append(
-            {
-                'title': metric,
-                'lossMap': {
-                    'function': metric,
-                    'imageA': str(ref_image),
-                    'imageB': str(result_image)
-                },
-                'tonemapGroup': 'metric'
-            }
-        )
+        if metric_images:
+            jeri_data['children'].append(
+                {
+                    'title': metric,
+                    'image': str(metric_images[metric]),
+                    'tonemapGroup': 'metric'
+                }
+            )
+        else:
+            jeri_data['children'].append(
+                {
+                    'title': metric,
+                    'lossMap': {
+                        'function': metric,
+                        'imageA': str(ref_image),
+                        'imageB': str(result_image)
+                    },
+                    'tonemapGroup': 'metric'
+                }
+            )
 
     return jeri_data
 
@@ -295,10 +316,172 @@ def result_image(path):
 def result_image(path):
     return static_file(path, database.ref_dir)
 
+def page_params(sort_columns, default_sort, default_descending):
+    '''
+    Parse the paging, sorting and filtering parameters of an API request.
+    Aborts the request if a parameter is invalid.
+    '''
+    try:
+        limit = int(request.query.get('limit', config.VIEWER_PAGE_SIZE))
+        offset = int(request.query.get('offset', 0))
+    except ValueError:
+        bottle.abort(400, 'Invalid limit or offset.')
+    if limit < 1 or limit > config.VIEWER_MAX_PAGE_SIZE or offset < 0:
+        bottle.abort(400, f'Limit needs to be within [1, {config.VIEWER_MAX_PAGE_SIZE}] and offset needs to be positive.')
+    sort = request.query.get('sort', default_sort)
+    if not sort in sort_columns:
+        bottle.abort(400, f'Invalid sort key "{sort}" (valid keys: {", ".join(sort_columns.keys())}).')
+    order = request.query.get('order', 'desc' if default_descending else 'asc')
+    if not order in ['asc', 'desc']:
+        bottle.abort(400, f'Invalid order "{order}" (valid orders: asc, desc).')
+    name = request.query.get('name', '')
+    try:
+        re.compile(name)
+    except re.error as e:
+        bottle.abort(400, f'Invalid name regex: {e}')
+    results = [r.upper() for r in request.query.get('result', '').split(',') if r != '']
+    return dict(results=results, name=name or None, sort=sort, descending=order == 'desc', limit=limit, offset=offset)
+
+def page_response(total, items, params):
+    return { 'total': total, 'offset': params['offset'], 'limit': params['limit'], 'items': items }
+
+@route('/api/runs')
+def api_runs():
+    params = page_params(result_index.RUN_SORT_COLUMNS, 'date', True)
+    tags = { index: request.query[tag] for index, tag in enumerate(database.run_tags) if request.query.get(tag, '') != '' }
+    total, rows = database.index.query_runs(tags=tags, **params)
+    items = [{
+        'run_dir': row['run_dir'],
+        'run_tags': database.run_tags_of(row['run_dir']),
+        'date': row['date'],
+        'date_text': format_date(row['date']) if row['date'] else '',
+        'duration': row['duration'],
+        'duration_text': format_duration(row['duration']) if row['duration'] != None else '',
+        'result': row['result'],
+        'test_count': row['test_count']
+    } for row in rows]
+    return page_response(total, items, params)
+
+@route('/api/runs/<path:path>')
+def api_run_tests(path):
+    if not path.endswith('/tests'):
+        bottle.abort(404, 'Not found.')
+    run_dir = path[0:-len('/tests')]
+    if not database.load_run(run_dir, load_tests=False):
+        bottle.abort(404, f'Run "{run_dir}" does not exist.')
+    params = page_params(result_index.TEST_SORT_COLUMNS, 'name', False)
+    total, rows = database.index.query_tests(run_dir, tag=request.query.get('tag', '') or None, **params)
+    items = []
+    for row in rows:
+        report = json.loads(row['report'])
+        items.append({
+            'name': row['name'],
+            'test_dir': row['test_dir'],
+            'tags': [t for t in row['tags'].split(',') if t != ''],
+            'result': row['result'],
+            'duration': row['duration'],
+            'duration_text': format_duration(row['duration']) if row['duration'] != None else '',
+            'image_count': row['image_count'],
+            'failed_image_count': row['failed_image_count'],
+            'max_error': row['max_error'],
+            'messages': report.get('messages', [])
+        })
+    return page_response(total, items, params)
+
+@route('/preview/<kind>/<path:path>')
+def preview_image(kind, path):
+    '''
+    Serve a downsampled preview of a result or reference image.
+    Previews are revalidated by the browser using the ETag (derived from the image contents) or Last-Modified headers.
+    '''
+    roots = { 'result': database.result_dir, 'ref': database.ref_dir }
+    if preview_cache == None or not kind in roots:
+        bottle.abort(404, 'Not found.')
+    root = os.path.abspath(roots[kind]) + os.sep
+    source = os.path.abspath(os.path.join(root, path.strip('/\\')))
+    if not source.startswith(root):
+        bottle.abort(403, 'Access denied.')
+    if not os.path.isfile(source) or not Path(source).suffix.lower() in previews.PREVIEW_EXTENSIONS:
+        bottle.abort(404, 'Image does not exist.')
+
+    try:
+        size = min(max(int(request.query.get('size', config.PREVIEW_SIZE)), 16), config.PREVIEW_MAX_SIZE)
+    except ValueError:
+        bottle.abort(400, 'Invalid size.')
+    format = 'webp' if 'image/webp' in request.headers.get('Accept', '') and previews.is_webp_available() else 'png'
+
+    try:
+        preview_file, key = preview_cache.get(Path(source), size, format)
+    except (previews.UnsupportedImageError, OSError, ValueError) as e:
+        bottle.abort(415, f'Cannot generate preview: {e}')
+
+    return cached_file_response(preview_file, key, os.stat(source).st_mtime, previews.FORMATS[format], vary='Accept')
+
+@route('/metric/<metric>/<path:path>')
+def metric_image(metric, path):
+    '''
+    Serve a metric map (see core/metric_maps.py) of a result image.
+    Paths have the form <run_dir>/<test_dir>/<image>.exr.
+    '''
+    if metric_cache == None or not metric in metric_maps.METRICS or not path.endswith('.exr'):
+        bottle.abort(404, 'Not found.')
+    run_dir, rest = parse_path(path[0:-len('.exr')])
+    if not run_dir or not rest:
+        bottle.abort(404, 'Not found.')
+
+    # Test directories may contain slashes, so find the split between test directory and image name.
+    test = None
+    parts = rest.split('/')
+    for index in range(len(parts) - 1, 0, -1):
+        test_dir = '/'.join(parts[0:index])
+        image = '/'.join(parts[index:])
+        test = database.load_test(database.test_report_file(run_dir, test_dir), load_log=False)
+        if test:
+            break
+    if not test or not image in [i['name'] for i in test.get('images', [])]:
+        bottle.abort(404, 'Image does not exist.')
+
+    ref_file = Path(test['ref_dir']) / image
+    result_file = database.result_dir / run_dir / test_dir / image
+    try:
+        map_file, key = metric_cache.get(ref_file, result_file, metric)
+    except (metric_maps.UnsupportedImageError, OSError, ValueError) as e:
+        bottle.abort(415, f'Cannot compute metric map: {e}')
+
+    return cached_file_response(map_file, key, max(os.stat(ref_file).st_mtime, os.stat(result_file).st_mtime), 'image/x-exr')
+
+def cached_file_response(path, key, mtime, mimetype, vary=None):
+    '''
+    Return a response for a file generated from source files, handling conditional requests.
+    key identifies the contents (used as entity tag), mtime is the last modification time of the sources.
+    '''
+    headers = {
+        'ETag': f'"{key}"',
+        'Last-Modified': time.strftime("%a, %d %b %Y %H:%M:%S GMT", time.gmtime(mtime)),
+        'Cache-Control': 'no-cache'
+    }
+    if vary:
+        headers['Vary'] = vary
+    if_none_match = request.headers.get('If-None-Match', None)
+    if_modified_since = request.headers.get('If-Modified-Since', None)
+    if if_none_match != None:
+        not_modified = headers['ETag'] in [tag.strip() for tag in if_none_match.split(',')] or if_none_match.strip() == '*'
+    elif if_modified_since != None:
+        since = bottle.parse_date(if_modified_since.split(';')[0].strip())
+        not_modified = since != None and since >= int(mtime)
+    else:
+        not_modified = False
+    if not_modified:
+        return HTTPResponse(status=304, **headers)
+
+    headers['Content-Type'] = mimetype
+    headers['Content-Length'] = path.stat().st_size
+    body = '' if request.method == 'HEAD' else open(path, 'rb')
+    return HTTPResponse(body, **headers)
+
 @route('/')
 @view('index')
 def index_page():
-    runs = database.load_runs()
     nav = [
         { 'title': 'Home', 'link': '/'}
     ]
@@ -307,10 +490,10 @@ def index_page():
         tag_titles=TAG_TITLES,
         hostname=helpers.get_hostname(),
         result_dir=database.result_dir,
-        runs=runs,
+        indexing=not database.index.is_ready(),
         run_tags=database.run_tags,
-        format_date=format_date,
-        format_duration=format_duration
+        run_tags_json=json.dumps(database.run_tags),
+        page_size=config.VIEWER_PAGE_SIZE
     )
 
 @route('/<path:path>')
@@ -325,7 +508,7 @@ def catch_all(path):
 
     if run_dir and not test_dir:
         # Show run page.
-        run = database.load_run(database.run_report_file(run_dir))
+        run = database.load_run(run_dir, load_tests=False)
         if not run:
             return template('error', message=f'Run "{run_dir}" does not exist.')
 
@@ -333,12 +516,15 @@ def catch_all(path):
             { 'title': 'Home', 'link': '/'},
             { 'title': 'Run: ' + run_dir, 'link': '/' + run_dir }
         ]
-        stats = run_stats(run)
+        result_counts = database.index.test_result_counts(run_dir)
+        stats = run_stats(result_counts)
         return template(
             'run',
             nav=nav,
             tag_titles=TAG_TITLES,
             stats=stats,
+            test_count=sum(result_counts.values()),
+            page_size=config.VIEWER_PAGE_SIZE,
             run_dir=run_dir,
             run=run,
             run_tags=database.run_tags,
@@ -360,7 +546,10 @@ def catch_all(path):
             error_image = Path(str(result_image) + config.ERROR_IMAGE_SUFFIX)
             ref_dir = Path(test['ref_dir']).relative_to(database.ref_dir)
             ref_image = Path('/ref') / ref_dir / image
-            jeri_data = create_jeri_data(result_image, ref_image, error_image)
+            metric_images = None
+            if metric_cache:
+                metric_images = { metric: Path('/metric') / metric / run_dir / test_dir / (image + '.exr') for metric in metric_maps.METRICS }
+            jeri_data = create_jeri_data(result_image, ref_image, error_image, metric_images=metric_images)
             return template(
                 'compare',
                 image=str(image),
@@ -382,6 +571,8 @@ def catch_all(path):
                 test_dir=test_dir,
                 ref_dir=ref_dir,
                 test=test,
+                previews=preview_cache != None,
+                preview_size=config.PREVIEW_SIZE,
                 format_duration=format_duration
             )
     else:
@@ -397,6 +588,9 @@ def main():
     parser.add_argument('--port', type=int, action='store', help='Server port', default=8080)
     parser.add_argument('--debug', action='store_true', help='Debug mode')
     parser.add_argument('--no-browser', action='store_true', help='Do not open browser window')
+    parser.add_argument('--server', type=str, action='store', choices=SERVERS.keys(), help='Server implementation (default: wsgiref)', default='wsgiref')
+    parser.add_argument('--workers', type=int, action='store', help=f'Number of worker threads of the threaded server (default: {config.VIEWER_SERVER_WORKERS})', default=config.VIEWER_SERVER_WORKERS)
+    parser.add_argument('--refresh-interval', type=float, action='store', help=f'Interval in seconds for refreshing the index of results (default: {config.VIEWER_INDEX_REFRESH_INTERVAL})', default=config.VIEWER_INDEX_REFRESH_INTERVAL)
 
     args = parser.parse_args()
 
@@ -411,6 +605,21 @@ def main():
     # Create database.
     global database
     database = Database(env)
+    database.index.start(args.refresh_interval)
+
+    # Create image preview and metric map caches.
+    global preview_cache, metric_cache
+    if previews.is_available() and metric_maps.is_available():
+        preview_cache = previews.PreviewCache(env.project_dir / config.CACHE_DIR / config.PREVIEW_CACHE_DIR)
+        metric_cache = metric_maps.MetricMapCache(env.project_dir / config.CACHE_DIR / config.METRIC_CACHE_DIR)
+        def save_caches():
+            while True:
+                time.sleep(CACHE_SAVE_INTERVAL)
+                preview_cache.save()
+                metric_cache.save()
+        threading.Thread(target=save_caches, name='caches', daemon=True).start()
+    else:
+        print('NumPy is not available, image previews and metric maps are disabled.')
 
     url = f'http://{args.host}:{args.port}'
     print(f'Running server on {url}')
@@ -421,7 +630,8 @@ def main():
 
     # Trampoline function for running server.
     def run_server():
-        run(host=args.host, port=args.port, debug=args.debug, reloader=args.debug, quiet=not args.debug)
+        options = { 'workers': args.workers } if args.server == 'threaded' else {}
+        run(server=SERVERS[args.server], host=args.host, port=args.port, debug=args.debug, reloader=args.debug, quiet=not args.debug, **options)
 
     # Start server thread.
     server_thread = threading.Thread(target=run_server, name='server', daemon=True)
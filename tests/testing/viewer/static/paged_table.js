@@ -0,0 +1,135 @@
+'use strict';
+
+// Create a table cell containing text or a DOM node.
+function tableCell(content) {
+    const td = document.createElement('td');
+    if (content instanceof Node) {
+        td.appendChild(content);
+    } else {
+        td.textContent = content === null || content === undefined ? '' : String(content);
+    }
+    return td;
+}
+
+// Create a table row linking to a page.
+function tableRow(cells, link) {
+    const tr = document.createElement('tr');
+    tr.className = 'c-hand';
+    tr.addEventListener('click', () => { window.location = link; });
+    for (const content of cells) {
+        tr.appendChild(tableCell(content));
+    }
+    return tr;
+}
+
+// Create a label for a result (same as snippets/result.tpl).
+function resultLabel(result) {
+    const classes = { 'PASSED': 'label-success', 'FAILED': 'label-error', 'SKIPPED': 'label-warning' };
+    const span = document.createElement('span');
+    span.className = 'label ' + (classes[result] || '');
+    span.textContent = result;
+    return span;
+}
+
+// Create a list of lines.
+function lineList(lines) {
+    const div = document.createElement('div');
+    for (const line of lines) {
+        const span = document.createElement('span');
+        span.textContent = line;
+        div.appendChild(span);
+        div.appendChild(document.createElement('br'));
+    }
+    return div;
+}
+
+// Table whose rows are loaded page by page from a viewer API endpoint.
+// The query is built from the fields of a filter form, the table is reloaded whenever the form changes.
+// The next page is loaded when the "more" element becomes visible or is clicked.
+class PagedTable {
+    constructor(options) {
+        this.url = options.url;
+        this.form = options.form;
+        this.body = options.body;
+        this.status = options.status;
+        this.more = options.more;
+        this.renderRow = options.renderRow;
+        this.pageSize = options.pageSize || 100;
+        this.generation = 0;
+
+        this.form.addEventListener('submit', e => { e.preventDefault(); this.reset(); });
+        this.form.addEventListener('change', () => this.reset());
+        this.more.addEventListener('click', () => this.load());
+        if ('IntersectionObserver' in window) {
+            new IntersectionObserver(entries => {
+                if (entries.some(e => e.isIntersecting)) {
+                    this.load();
+                }
+            }).observe(this.more);
+        }
+        this.reset();
+    }
+
+    query() {
+        const params = new URLSearchParams();
+        for (const [key, value] of new FormData(this.form)) {
+            if (value !== '') {
+                params.set(key, value);
+            }
+        }
+        params.set('limit', this.pageSize);
+        params.set('offset', this.offset);
+        return params;
+    }
+
+    reset() {
+        this.generation++;
+        this.offset = 0;
+        this.total = null;
+        this.loading = false;
+        this.body.replaceChildren();
+        this.load();
+    }
+
+    isMoreVisible() {
+        return this.more.style.display !== 'none' && this.more.getBoundingClientRect().top < window.innerHeight;
+    }
+
+    async load() {
+        if (this.loading || (this.total !== null && this.offset >= this.total)) {
+            return;
+        }
+        this.loading = true;
+        const generation = this.generation;
+        this.status.textContent = 'Loading...';
+        try {
+            const response = await fetch(this.url + '?' + this.query());
+            if (!response.ok) {
+                throw new Error(response.status + ' ' + response.statusText);
+            }
+            const page = await response.json();
+            if (generation !== this.generation) {
+                return;
+            }
+            for (const item of page.items) {
+                this.body.appendChild(this.renderRow(item));
+            }
+            this.offset += page.items.length;
+            this.total = page.total;
+            this.status.textContent = this.total === 0 ? 'No entries found.' : `Showing ${this.offset} of ${this.total}.`;
+            this.more.style.display = this.offset < this.total ? '' : 'none';
+        } catch (e) {
+            if (generation === this.generation) {
+                this.status.textContent = 'Failed to load: ' + e.message;
+            }
+        } finally {
+            if (generation === this.generation) {
+                this.loading = false;
+                // Keep loading while the end of the table is visible (the observer only fires on changes).
+                if (this.isMoreVisible()) {
+                    setTimeout(() => this.load(), 0);
+                }
+            }
+        }
+    }
+}
@@ -6,6 +6,7 @@
     <script src="/react.min.js"></script>
     <script src="/react-dom.min.js"></script>
     <script src="/jeri.min.js"></script>
+    <script src="/paged_table.js"></script>
     <title>{{title or 'No title'}}</title>
 </head>
 
@@ -18,9 +18,31 @@
 <div class="divider"></div>
 <h5>Runs</h5>
 
-% if len(runs) == 0:
-<p>No runs found.</p>
-% else:
+% if indexing:
+<p>Indexing results, reload the page to see all runs.</p>
+% end
+<form id="filter" class="form-horizontal">
+    <div class="input-group">
+        <input class="form-input input-sm" type="text" name="name" placeholder="Run (regex)">
+        % for tag in run_tags:
+        <input class="form-input input-sm" type="text" name="{{tag}}" placeholder="{{tag_titles[tag]}}">
+        % end
+        <select class="form-select select-sm" name="result">
+            <option value="">All results</option>
+            <option value="PASSED">Passed</option>
+            <option value="FAILED">Failed</option>
+        </select>
+        <select class="form-select select-sm" name="sort">
+            <option value="date">Sort by date</option>
+            <option value="duration">Sort by duration</option>
+            <option value="name">Sort by run</option>
+        </select>
+        <select class="form-select select-sm" name="order">
+            <option value="desc">Descending</option>
+            <option value="asc">Ascending</option>
+        </select>
+    </div>
+</form>
 <table class="table table-striped table-hover">
     <thead>
         <tr>
@@ -33,20 +55,22 @@
             <th>Result</th>
         </tr>
     </thead>
-    <tbody>
-        % for run in runs:
-        <tr class="c-hand" onclick="window.location='{{run['run_dir']}}';">
-            <td>{{run['run_dir']}}</td>
-            <td>{{format_date(run['date'])}}</td>
-            % for tag in run_tags:
-            <td>{{run['run_tags'][tag]}}</td>
-            % end
-            <td>{{format_duration(run['duration'])}}</td>
-            <td>
-                % include('snippets/result', result=run['result'])
-            </td>
-        </tr>
-        % end
-    </tbody>
+    <tbody id="runs"></tbody>
 </table>
-% end
+<p id="status"></p>
+<button id="more" class="btn btn-sm">Load more</button>
+<script>
+    const runTags = {{!run_tags_json}};
+    new PagedTable({
+        url: '/api/runs',
+        form: document.getElementById('filter'),
+        body: document.getElementById('runs'),
+        status: document.getElementById('status'),
+        more: document.getElementById('more'),
+        pageSize: {{page_size}},
+        renderRow: run => tableRow(
+            [run.run_dir, run.date_text].concat(runTags.map(tag => run.run_tags[tag]), [run.duration_text, resultLabel(run.result)]),
+            '/' + run.run_dir
+        )
+    });
+</script>
@@ -30,10 +30,32 @@
 <div class="divider"></div>
 <h5>Tests</h5>
 
-% if len(run['tests']) == 0:
+% if test_count == 0:
 <p>No tests found.</p>
 % else:
 % include('snippets/stats', stats=stats)
+<form id="filter" class="form-horizontal">
+    <div class="input-group">
+        <input class="form-input input-sm" type="text" name="name" placeholder="Test (regex)">
+        <input class="form-input input-sm" type="text" name="tag" placeholder="Tag">
+        <select class="form-select select-sm" name="result">
+            <option value="">All results</option>
+            <option value="PASSED">Passed</option>
+            <option value="FAILED">Failed</option>
+            <option value="SKIPPED">Skipped</option>
+        </select>
+        <select class="form-select select-sm" name="sort">
+            <option value="name">Sort by name</option>
+            <option value="duration">Sort by duration</option>
+            <option value="error">Sort by error</option>
+            <option value="result">Sort by result</option>
+        </select>
+        <select class="form-select select-sm" name="order">
+            <option value="asc">Ascending</option>
+            <option value="desc">Descending</option>
+        </select>
+    </div>
+</form>
 <table class="table table-striped table-hover">
     <thead>
         <tr>
@@ -44,22 +66,22 @@
             <th>Result</th>
         </tr>
     </thead>
-    <tbody>
-        % for test in run['tests']:
-        <tr class="c-hand" onclick="window.location='/{{run_dir}}/{{test['name']}}';">
-            <td>{{test['name']}}</td>
-            <td>{{len(test['images'])}}</td>
-            <td>
-                % for message in test['messages']:
-                    <span>{{message}}</span><br>
-                % end
-            </td>
-            <td>{{format_duration(test['duration'])}}</td>
-            <td>
-                % include('snippets/result', result=test['result'])
-            </td>
-        </tr>
-        % end
-    </tbody>
+    <tbody id="tests"></tbody>
 </table>
+<p id="status"></p>
+<button id="more" class="btn btn-sm">Load more</button>
+<script>
+    new PagedTable({
+        url: '/api/runs/{{run_dir}}/tests',
+        form: document.getElementById('filter'),
+        body: document.getElementById('tests'),
+        status: document.getElementById('status'),
+        more: document.getElementById('more'),
+        pageSize: {{page_size}},
+        renderRow: test => tableRow(
+            [test.name, test.image_count, lineList(test.messages), test.duration_text, resultLabel(test.result)],
+            '/{{run_dir}}/' + test.name
+        )
+    });
+</script>
 %end
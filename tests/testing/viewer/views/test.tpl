@@ -32,8 +32,13 @@
     <thead>
         <tr>
             <th>Image</th>
+            % if previews:
+            <th>Result</th>
+            <th>Reference</th>
+            % end
             <th>Error</th>
             <th>Tolerance</th>
+            <th>Worst tiles</th>
             <th>Result</th>
         </tr>
     </thead>
@@ -41,8 +46,17 @@
     % for image in test['images']:
         <tr class="c-hand" onclick="window.location='/{{run_dir}}/{{test_dir}}?action=compare&image={{image['name']}}';">
             <td>{{image['name']}}</td>
+            % if previews:
+            <td><img src="/preview/result/{{run_dir}}/{{test_dir}}/{{image['name']}}?size={{preview_size}}" loading="lazy" alt="" style="max-width:{{preview_size}}px;max-height:{{preview_size}}px"></td>
+            <td><img src="/preview/ref/{{ref_dir}}/{{image['name']}}?size={{preview_size}}" loading="lazy" alt="" style="max-width:{{preview_size}}px;max-height:{{preview_size}}px"></td>
+            % end
             <td>{{image['error']}}</td>
             <td>{{image['tolerance']}}</td>
+            <td>
+                % for tile in image.get('worst_tiles', [])[0:3] if not image['success'] else []:
+                <span class="text-small">({{tile['x']}}, {{tile['y']}}) {{tile['width']}}x{{tile['height']}}</span><br>
+                % end
+            </td>
             <td>
                 % include('snippets/result', result='PASSED' if image['success'] else 'FAILED')
             </td>